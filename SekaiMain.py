@@ -15,7 +15,7 @@ from datetime import datetime, timedelta, date
 from weather import get_weather_for_city_json
 from sekai_wakeword_detection import SekaiWakeWordDetector
 
-from send_audio import transcribe_wav_file
+from send_audio import converse_wav_file, prewarm_connection, transcribe_wav_file
 import requests
 import os
 from typecast_api import text_to_speech_api
@@ -199,6 +199,9 @@ def activate_sekai(mode="touch", emotion=None):
     """
     global fsr_is_active, current_view
     
+    # Connect to the server while the greeting plays, so the upload skips the handshake
+    prewarm_connection()
+    
     print(f"\n{'🎯'*20}")
     print(f"🎯 SEKAI ACTIVATED via {mode.upper()}")
     print(f"{'🎯'*20}\n")
@@ -278,27 +281,17 @@ def start_recording():
         print(f"❌ Recording failed with code: {return_code}")
     
     
-    result = transcribe_wav_file("recorded_command.wav")
+    # Transcription, intent, reply and speech in a single round trip to the server
+    result = converse_wav_file("recorded_command.wav", current_mood)
     
     if result:
         print("Transcription:")
-        print(result)
-
-        API_KEY = "__pltMzLwjRtejoHYcjCEi984cBgKa6qMU6EiSkEs2Xne "  # Replace with your actual API key
-    
-        # Test text
-        #test_text = ai_response
-
-        ai_intent = getSekaiIntent(result)
+        print(result["transcript"])
 
-        print(ai_intent)
-        data = json.loads(ai_intent)  # Parse JSON string to dictionary
-        command_value = data["command"]  # Access the value
+        print(result["command"])
+        command_value = result["command"]["command"]  # Access the value
 
-        ai_response = getSekaiResponse(result, current_mood)
-
-        # Generate speech
-        audio_file = text_to_speech_api(ai_response, API_KEY)
+        audio_file = result["audio_file"]
         
         if audio_file and os.path.exists(audio_file):
             print(f"\n🎵 To play the audio on Raspberry Pi:")
@@ -311,8 +304,8 @@ def start_recording():
             except:
                 print("   Could not play audio automatically")
         
-        else:
-            print("Transcription failed.")
+    else:
+        print("Transcription failed.")
     # Deactivate Sekai after recording
     deactivate_sekai()
 
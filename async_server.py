@@ -0,0 +1,259 @@
+"""
+asyncio front end for the transcription server, on aiohttp.
+
+    python async_server.py        (instead of python audio_transcriber.py)
+
+The Flask app keeps one thread blocked per request for as long as the
+transcription takes, so the number of requests in flight is capped by
+threads rather than by the model. Here an upload is streamed into a spool
+file without blocking the event loop, decoding runs on a small thread pool,
+and a waiting request is just a future that the worker finishing its job
+resolves. Thousands of idle connections cost next to nothing.
+
+/transcribe, /converse, /jobs/<id> (long-poll included) and /test are
+served natively with the same contract as the Flask app, so send_audio.py
+works unchanged. Every other route is handed to the Flask app on a thread
+pool of its own, so /jobs uploads, /stream, /ready, /stats, /queue and
+/metrics keep working without tying up the threads native requests decode
+on. Workers, queue and cache are the ones audio_transcriber sets up when it
+is imported.
+"""
+import asyncio
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+import audio_transcriber as server
+
+# Uploads bigger than this spill from memory to a temp file while they arrive
+UPLOAD_SPOOL_BYTES = 4 * 1024 * 1024
+# Anything bigger is refused with 413
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", str(200 * 1024 * 1024)))
+# Threads for decoding uploads and queueing them
+ASYNC_THREADS = int(os.environ.get("ASYNC_THREADS", "8"))
+# Threads for requests handed to the Flask app, which block for as long as they run
+BRIDGE_THREADS = int(os.environ.get("BRIDGE_THREADS", "16"))
+
+executor = ThreadPoolExecutor(ASYNC_THREADS, thread_name_prefix="async-server")
+bridge_executor = ThreadPoolExecutor(BRIDGE_THREADS, thread_name_prefix="async-bridge")
+# converse_with() waits on its own intent/reply pool, so it gets threads apart from both
+converse_executor = ThreadPoolExecutor(server.CONVERSE_THREADS, thread_name_prefix="async-converse")
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+async def _spool(chunks):
+    """Copy an async stream of byte chunks into a spooled temp file"""
+    spool = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES)
+    size = 0
+    async for chunk in chunks:
+        size += len(chunk)
+        if size > MAX_UPLOAD_BYTES:
+            spool.close()
+            raise UploadError(f"Upload is larger than {MAX_UPLOAD_BYTES} bytes", 413)
+        spool.write(chunk)
+    spool.seek(0)
+    return spool
+
+
+async def _part_chunks(part):
+    while True:
+        chunk = await part.read_chunk(64 * 1024)
+        if not chunk:
+            return
+        yield chunk
+
+
+# Form fields longer than this are skipped rather than read into memory
+MAX_FIELD_BYTES = 64 * 1024
+
+
+async def read_upload(request, fields=None):
+    """
+    (spool, filename) like audio_transcriber.read_upload(); filename is None for raw PCM.
+    With a fields dict, the multipart form fields (e.g. /converse's mood) are added to it.
+    """
+    if request.content_type == "application/octet-stream":
+        return await _spool(request.content.iter_chunked(64 * 1024)), None
+
+    if not request.content_type.startswith("multipart/"):
+        raise UploadError("No file part")
+    reader = await request.multipart()
+    upload = None
+    async for part in reader:
+        # Like werkzeug, a part without a filename is a form field, not a file
+        if part.name == "file" and part.filename is not None and upload is None:
+            upload = await _spool(_part_chunks(part)), part.filename
+            if fields is None:
+                return upload
+        elif fields is not None and part.filename is None:
+            value = await part.read_chunk(MAX_FIELD_BYTES + 1)
+            if len(value) <= MAX_FIELD_BYTES:
+                fields[part.name] = value.decode("utf-8", "replace")
+            await part.release()
+        else:
+            await part.release()
+    if upload is None:
+        raise UploadError("No file part")
+    return upload
+
+
+def _decode_spool(spool, filename):
+    with spool:
+        return server.decode_upload(spool.read(), filename)
+
+
+async def wait_for(job):
+    """Await a TranscriptionJob without tying up a thread"""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve():
+        if not future.done():
+            future.set_result(None)
+
+    job.add_done_callback(lambda _: loop.call_soon_threadsafe(resolve))
+    await future
+
+
+async def submit(request, fields=None):
+    """
+    Read, decode and queue an upload like the Flask handlers do.
+    Returns (job, cache, decode_time, None), or (None, None, None, error response).
+    """
+    if server.startup_error:
+        error = web.json_response({"error": f"Model failed to load: {server.startup_error}"}, status=503)
+        return None, None, None, error
+
+    request_start = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    try:
+        options = server.parse_options(request.query)
+    except server.UnknownProfile as e:
+        return None, None, None, web.Response(text=str(e), status=400)
+    try:
+        spool, filename = await read_upload(request, fields)
+    except UploadError as e:
+        return None, None, None, web.Response(text=str(e), status=e.status)
+    audio, error = await loop.run_in_executor(executor, _decode_spool, spool, filename)
+    if error:
+        return None, None, None, web.Response(text=error[0], status=error[1])
+    decode_time = time.perf_counter() - request_start
+    server.decode_seconds.observe(decode_time)
+
+    # Hashing for the transcript cache touches every sample; keep it off the loop too
+    device = request.headers.get("X-Device-Id") or request.remote or "unknown"
+    try:
+        job, cache = await loop.run_in_executor(
+            executor, server.submit_upload,
+            audio, options, request.headers.get("Idempotency-Key"), device,
+        )
+    except server.QueueFull as e:
+        body, status, headers = server.rejection(e)
+        return None, None, None, web.json_response(body, status=status, headers=headers)
+    return job, cache, decode_time, None
+
+
+async def transcribe(request):
+    request_start = time.perf_counter()
+    job, cache, decode_time, error = await submit(request)
+    if error is not None:
+        return error
+
+    await wait_for(job)
+    body, status, headers = server.transcription_response(job, cache, decode_time, request_start)
+    return web.Response(text=body, status=status, headers=headers)
+
+
+async def converse(request):
+    request_start = time.perf_counter()
+    fields = {}
+    job, cache, decode_time, error = await submit(request, fields)
+    if error is not None:
+        return error
+    mood = fields.get("mood") or request.query.get("mood") or "happy"
+
+    await wait_for(job)
+    if job.status != "done":
+        body, status, headers = server.transcription_response(job, cache, decode_time, request_start)
+        return web.Response(text=body, status=status, headers=headers)
+    data, headers = await asyncio.get_running_loop().run_in_executor(
+        converse_executor, server.converse_response, job, cache, mood, request_start,
+    )
+    return web.json_response(data, headers=headers)
+
+
+async def job_status(request):
+    # With the shared queue, looking up a job can mean a SQLite read
+    job = await asyncio.get_running_loop().run_in_executor(executor, server.get_job, request.match_info["job_id"])
+    if job is None:
+        return web.json_response({"error": "Unknown job"}, status=404)
+
+    # Long-poll: ?wait=<seconds> holds the request (not a thread) until the job finishes
+    try:
+        wait_seconds = float(request.query.get("wait", 0))
+    except ValueError:
+        return web.json_response({"error": "wait must be a number"}, status=400)
+    if wait_seconds > 0:
+        try:
+            await asyncio.wait_for(wait_for(job), min(wait_seconds, server.MAX_LONG_POLL))
+        except asyncio.TimeoutError:
+            pass
+    return web.json_response(job.to_dict(), status=200 if job.is_done() else 202)
+
+
+async def test_connection(request):
+    # Liveness only: the process is up, the model may still be loading (see /ready)
+    return web.Response(text="Server is running")
+
+
+# Hop-by-hop and length headers are recomputed on each side of the bridge
+_SKIP_HEADERS = {"content-length", "transfer-encoding", "connection"}
+
+
+async def forward_to_flask(request):
+    """Serve any other route with the Flask app, on the bridge's thread pool"""
+    body = await request.read()
+    headers = [(k, v) for k, v in request.headers.items() if k.lower() not in _SKIP_HEADERS]
+
+    def call():
+        response = server.app.test_client().open(
+            request.path, method=request.method, query_string=request.query_string,
+            headers=headers, data=body, environ_base={"REMOTE_ADDR": request.remote or ""},
+        )
+        return response.status_code, response.get_data(), [
+            (k, v) for k, v in response.headers.items() if k.lower() not in _SKIP_HEADERS
+        ]
+
+    status, data, response_headers = await asyncio.get_running_loop().run_in_executor(bridge_executor, call)
+    response = web.Response(body=data, status=status)
+    for key, value in response_headers:
+        response.headers.add(key, value)
+    return response
+
+
+async def advertise_upload_formats(request, response):
+    # Same header the Flask app adds, for the routes served natively here
+    response.headers["X-Accept-Audio"] = server.ACCEPT_AUDIO
+
+
+def make_app():
+    app = web.Application(client_max_size=MAX_UPLOAD_BYTES)
+    app.on_response_prepare.append(advertise_upload_formats)
+    app.router.add_post("/transcribe", transcribe)
+    app.router.add_post("/converse", converse)
+    app.router.add_get("/jobs/{job_id}", job_status)
+    app.router.add_get("/test", test_connection)
+    app.router.add_route("*", "/{tail:.*}", forward_to_flask)
+    return app
+
+
+if __name__ == "__main__":
+    web.run_app(make_app(), host="0.0.0.0", port=5000)
@@ -0,0 +1,165 @@
+import io
+import os
+import subprocess
+import wave
+
+import numpy as np
+
+# Whisper's input format, and what start_recording() asks arecord for:
+# arecord -f S16_LE -t wav -r 16000 -c 1
+SAMPLE_RATE = 16000
+
+
+def pcm16_to_float32(data):
+    """Raw little-endian 16-bit mono PCM -> float32 in [-1, 1)"""
+    if len(data) % 2:
+        raise ValueError("PCM body must be 16-bit samples (even number of bytes)")
+    return np.frombuffer(data, dtype="<i2").astype(np.float32) / 32768.0
+
+
+def parse_wav_fast(data):
+    """
+    Parse a 16 kHz mono S16_LE WAV straight from memory.
+    Returns None for anything else so the caller can fall back to ffmpeg.
+    """
+    try:
+        with wave.open(io.BytesIO(data), "rb") as wav:
+            if (wav.getnchannels() != 1
+                    or wav.getsampwidth() != 2
+                    or wav.getframerate() != SAMPLE_RATE
+                    or wav.getcomptype() != "NONE"):
+                return None
+            frames = wav.readframes(wav.getnframes())
+    except (wave.Error, EOFError):
+        return None
+    return pcm16_to_float32(frames)
+
+
+def decode_with_ffmpeg(data):
+    """
+    Decode any audio ffmpeg understands, piping the bytes through stdin
+    instead of going via a temp file. Same output format as whisper.audio.load_audio().
+    """
+    cmd = [
+        "ffmpeg", "-nostdin", "-threads", "0",
+        "-i", "pipe:0",
+        "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(SAMPLE_RATE),
+        "-",
+    ]
+    try:
+        out = subprocess.run(cmd, input=data, capture_output=True, check=True).stdout
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"Failed to decode audio: {e.stderr.decode(errors='ignore')}") from e
+    return pcm16_to_float32(out)
+
+
+def decode_wav_bytes(data):
+    """WAV bytes -> float32 array at 16 kHz, skipping ffmpeg when possible"""
+    audio = parse_wav_fast(data)
+    if audio is None:
+        audio = decode_with_ffmpeg(data)
+    return audio
+
+
+# ----------------------------
+# Compressed Uploads
+# ----------------------------
+# Upload formats the server decodes: name -> (file extensions, MIME type).
+# FLAC is lossless and about half the size of the WAV; Opus is lossy and far smaller.
+UPLOAD_FORMATS = {
+    "wav": ((".wav",), "audio/wav"),
+    "flac": ((".flac",), "audio/flac"),
+    "opus": ((".opus", ".ogg"), "audio/ogg"),
+}
+
+
+def upload_format(filename):
+    """Upload format name for a filename, or None if the server doesn't take it"""
+    extension = os.path.splitext(filename.lower())[1]
+    for name, (extensions, _) in UPLOAD_FORMATS.items():
+        if extension in extensions:
+            return name
+    return None
+
+
+def encode_audio_file(path, fmt):
+    """
+    A WAV file (path or file object) re-encoded as "flac" or "opus" (needs the soundfile package).
+    Opus only takes 8/12/16/24/48 kHz, which covers what arecord records.
+    """
+    import soundfile
+
+    samples, rate = soundfile.read(path, dtype="int16")
+    buffer = io.BytesIO()
+    if fmt == "flac":
+        soundfile.write(buffer, samples, rate, format="FLAC", subtype="PCM_16")
+    elif fmt == "opus":
+        soundfile.write(buffer, samples, rate, format="OGG", subtype="OPUS")
+    else:
+        raise ValueError(f"Unknown upload format: {fmt}")
+    return buffer.getvalue()
+
+
+def decode_compressed(data):
+    """
+    FLAC / Ogg Opus bytes -> float32 array at 16 kHz.
+    Decoded in-process with libsndfile (soundfile) when it is installed and
+    the audio is already 16 kHz mono, otherwise through ffmpeg.
+    """
+    try:
+        import soundfile
+        samples, rate = soundfile.read(io.BytesIO(data), dtype="int16")
+    except (ImportError, RuntimeError):
+        return decode_with_ffmpeg(data)
+    if samples.ndim != 1 or rate != SAMPLE_RATE:
+        return decode_with_ffmpeg(data)
+    return samples.astype(np.float32) / 32768.0
+
+
+# ----------------------------
+# Voice Activity Trimming
+# ----------------------------
+VAD_FRAME_SECONDS = 0.03
+# A frame counts as speech when it is this far above the clip's noise floor...
+VAD_MARGIN_DB = 12.0
+# ...clamped to this range (dBFS): hiss never counts, and a clip that is
+# speech from start to end doesn't raise the floor above its own words
+VAD_MIN_LEVEL_DB = -45.0
+VAD_MAX_LEVEL_DB = -30.0
+# Clips with less speech than this are treated as empty
+VAD_MIN_SPEECH_SECONDS = 0.15
+# Keep a little context around the speech so word edges aren't clipped
+VAD_PADDING_SECONDS = 0.25
+
+
+def frame_levels_db(audio, frame_seconds=VAD_FRAME_SECONDS):
+    """RMS level of each frame in dBFS"""
+    frame = max(1, int(SAMPLE_RATE * frame_seconds))
+    n_frames = len(audio) // frame
+    if n_frames == 0:
+        return np.zeros(0, np.float32)
+    frames = audio[:n_frames * frame].reshape(n_frames, frame)
+    rms = np.sqrt(np.mean(frames.astype(np.float64) ** 2, axis=1))
+    return 20 * np.log10(np.maximum(rms, 1e-10))
+
+
+def trim_silence(audio):
+    """
+    Cut leading and trailing silence with a simple energy VAD.
+    Returns the trimmed audio, or None when the clip has no speech at all.
+    """
+    levels = frame_levels_db(audio)
+    if len(levels) == 0:
+        return None
+
+    noise_floor = np.percentile(levels, 10)
+    threshold = min(max(noise_floor + VAD_MARGIN_DB, VAD_MIN_LEVEL_DB), VAD_MAX_LEVEL_DB)
+    speech = np.flatnonzero(levels > threshold)
+    if len(speech) * VAD_FRAME_SECONDS < VAD_MIN_SPEECH_SECONDS:
+        return None
+
+    frame = int(SAMPLE_RATE * VAD_FRAME_SECONDS)
+    padding = int(SAMPLE_RATE * VAD_PADDING_SECONDS)
+    start = max(0, speech[0] * frame - padding)
+    end = min(len(audio), (speech[-1] + 1) * frame + padding)
+    return audio[start:end]
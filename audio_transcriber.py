@@ -1,117 +1,1522 @@
+import time
+# Start of the startup profile reported on /ready
+_import_started = time.perf_counter()
+
+import base64
+import contextlib
+import ctypes
+import gc
+import itertools
+import json
+import math
 import os
 import re
+import sys
 import uuid
 import queue
 import threading
-import requests
-from flask import Flask, request, jsonify
+import numpy as np
+from flask import Flask, Response, request, jsonify
 import whisper
-from sumy.nlp.tokenizers import Tokenizer
-from sumy.parsers.plaintext import PlaintextParser
-from sumy.summarizers.lex_rank import LexRankSummarizer
-from sumy.nlp.stemmers import Stemmer
-from sumy.utils import get_stop_words
-import time
+import statistics
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import whisper.audio
-
-from datetime import datetime
-from datetime import date
-
-import json
-from json.decoder import JSONDecodeError
+from whisper_backends import CascadeBackend, SpeculativeBackend, load_backend
+from replica_pool import ReplicaPool
+from audio_ingest import (
+    UPLOAD_FORMATS, decode_compressed, decode_wav_bytes, pcm16_to_float32, trim_silence, upload_format,
+)
+from transcript_cache import TranscriptCache, cache_key
+from job_queue import Lane, LaneQueue, QueueFull
+from shared_queue import SqliteJobQueue
+from long_audio import split_at_silence, stitch, summarize
+from server_metrics import Counter, Gauge, Histogram, process_rss_bytes, render
 
 # ----------------------------
 # Load Whisper Model
 # ----------------------------
-print("Loading Whisper model...")
-meeting_transcriptor_model = whisper.load_model("medium")
-model_lock = threading.Lock()
-print("Model loaded successfully.")
+# WHISPER_BACKEND picks the inference engine: torch, torch-int8 or ctranslate2
+WHISPER_MODEL = os.environ.get("WHISPER_MODEL", "medium")
+WHISPER_BACKEND = os.environ.get("WHISPER_BACKEND", "torch")
+
+# Speculative decoding: set SPECULATIVE_DRAFT_MODEL (e.g. "tiny") to let it
+# propose SPECULATIVE_DRAFT_TOKENS tokens at a time for the main model to verify
+SPECULATIVE_DRAFT_MODEL = os.environ.get("SPECULATIVE_DRAFT_MODEL")
+SPECULATIVE_DRAFT_TOKENS = int(os.environ.get("SPECULATIVE_DRAFT_TOKENS", "4"))
+
+# Cascade: set CASCADE_MODEL (e.g. "tiny" or "base") to answer with it first
+# and only escalate clips outside these confidence limits to WHISPER_MODEL
+CASCADE_MODEL = os.environ.get("CASCADE_MODEL")
+CASCADE_LOGPROB_THRESHOLD = float(os.environ.get("CASCADE_LOGPROB_THRESHOLD", "-0.6"))
+CASCADE_NO_SPEECH_THRESHOLD = float(os.environ.get("CASCADE_NO_SPEECH_THRESHOLD", "0.5"))
+CASCADE_COMPRESSION_RATIO_THRESHOLD = float(os.environ.get("CASCADE_COMPRESSION_RATIO_THRESHOLD", "2.2"))
+
+def load_model(for_replicas=False):
+    """Build the configured backend, with the speculative and cascade wrappers"""
+    print(f"Loading Whisper model '{WHISPER_MODEL}' with the {WHISPER_BACKEND} backend...")
+    model = load_backend(WHISPER_BACKEND, WHISPER_MODEL, for_replicas)
+    if SPECULATIVE_DRAFT_MODEL:
+        print(f"Loading draft model '{SPECULATIVE_DRAFT_MODEL}' for speculative decoding...")
+        model = SpeculativeBackend(model, SPECULATIVE_DRAFT_MODEL, SPECULATIVE_DRAFT_TOKENS)
+    if CASCADE_MODEL:
+        print(f"Loading cascade model '{CASCADE_MODEL}'...")
+        model = CascadeBackend(
+            load_backend(WHISPER_BACKEND, CASCADE_MODEL, for_replicas),
+            model,
+            logprob_threshold=CASCADE_LOGPROB_THRESHOLD,
+            no_speech_threshold=CASCADE_NO_SPEECH_THRESHOLD,
+            compression_ratio_threshold=CASCADE_COMPRESSION_RATIO_THRESHOLD,
+        )
+    print("Model loaded successfully.")
+    return model
+
+# Loaded by the startup thread (see Staged Startup below)
+meeting_transcriptor_model = None
+# Reentrant: run_group holds it around run_batch_locally so its timings cover only the model
+model_lock = threading.RLock()
 
 LANGUAGE = "english"
 
+# Micro-batching: a worker waits up to BATCH_WINDOW_MS after the first
+# queued clip for more clips, and runs at most BATCH_MAX_SIZE together
+BATCH_WINDOW_MS = float(os.environ.get("BATCH_WINDOW_MS", "50"))
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", "8"))
+
+# Shrink the encoder to the clip length instead of padding to 30 s.
+# Server-wide default; requests can override with ?short_audio=0/1
+SHORT_AUDIO_MODE = os.environ.get("SHORT_AUDIO_MODE", "0") == "1"
+
+# Decoding profiles, picked per request with ?profile= (DECODING_PROFILE is the default)
+#   interactive  robot commands: one greedy pass with no temperature fallback,
+#                a pinned language and at most INTERACTIVE_MAX_TOKENS tokens
+#   archive      accuracy first: language detected per clip, whisper's
+#                fallback for bad decodes (the original behaviour)
+DECODING_PROFILE = os.environ.get("DECODING_PROFILE", "archive")
+# A language code, or "auto" to detect each robot's language and reuse it for a while
+INTERACTIVE_LANGUAGE = os.environ.get("INTERACTIVE_LANGUAGE", "auto")
+INTERACTIVE_MAX_TOKENS = int(os.environ.get("INTERACTIVE_MAX_TOKENS", "96"))
+CACHED_LANGUAGE = "auto"
+# A detected language is only reused when whisper was at least this sure of
+# it, and is detected afresh after LANGUAGE_CACHE_REQUESTS requests
+LANGUAGE_CACHE_MIN_PROBABILITY = float(os.environ.get("LANGUAGE_CACHE_MIN_PROBABILITY", "0.8"))
+LANGUAGE_CACHE_REQUESTS = int(os.environ.get("LANGUAGE_CACHE_REQUESTS", "50"))
+DECODING_PROFILES = {
+    "interactive": {"language": INTERACTIVE_LANGUAGE, "fallback": False, "max_tokens": INTERACTIVE_MAX_TOKENS},
+    "archive": {"language": None, "fallback": True, "max_tokens": None},
+}
+
+# Trim leading/trailing silence before inference (set VAD_ENABLED=0 to disable)
+VAD_ENABLED = os.environ.get("VAD_ENABLED", "1") == "1"
+
+# Process-pool mode: REPLICAS > 0 forks that many model replicas
+# (0 keeps the in-process worker threads sharing one model)
+REPLICAS = int(os.environ.get("REPLICAS", "0"))
+# In-process worker threads when REPLICAS is 0
+WORKER_THREADS = 2
+# Inference threads per replica; defaults to an even split of the cores
+TORCH_THREADS_PER_REPLICA = int(os.environ.get("TORCH_THREADS_PER_REPLICA", "0")) or None
+# Forks the zygote the replicas come from, so it must run before this module
+# starts any thread; the model itself loads later (see Staged Startup)
+replica_pool = (ReplicaPool(lambda: load_model(for_replicas=True), REPLICAS, TORCH_THREADS_PER_REPLICA)
+                if REPLICAS > 0 else None)
+
+# Streaming: re-decode once this much new audio has arrived,
+# and slide the window forward once it grows past STREAM_WINDOW_SECONDS
+STREAM_DECODE_INTERVAL = float(os.environ.get("STREAM_DECODE_INTERVAL", "0.5"))
+STREAM_WINDOW_SECONDS = float(os.environ.get("STREAM_WINDOW_SECONDS", "25"))
+# Streams with no chunk for this long are dropped
+STREAM_IDLE_TIMEOUT = 60
+
+# Admission control: clips up to QUEUE_INTERACTIVE_MAX_SECONDS go into the
+# interactive lane, which is served before the bulk lane. Each lane holds at
+# most *_DEPTH jobs (more get 429) and drops jobs that waited over *_MAX_WAIT.
+# Bulk jobs waiting longer than QUEUE_BULK_PROMOTE_AFTER jump the interactive lane
+QUEUE_INTERACTIVE_MAX_SECONDS = float(os.environ.get("QUEUE_INTERACTIVE_MAX_SECONDS", "15"))
+QUEUE_INTERACTIVE_DEPTH = int(os.environ.get("QUEUE_INTERACTIVE_DEPTH", "64"))
+QUEUE_INTERACTIVE_MAX_WAIT = float(os.environ.get("QUEUE_INTERACTIVE_MAX_WAIT", "30"))
+QUEUE_BULK_DEPTH = int(os.environ.get("QUEUE_BULK_DEPTH", "16"))
+QUEUE_BULK_MAX_WAIT = float(os.environ.get("QUEUE_BULK_MAX_WAIT", "600"))
+QUEUE_BULK_PROMOTE_AFTER = float(os.environ.get("QUEUE_BULK_PROMOTE_AFTER", "120"))
+
+# Fair sharing between robots: requests carry X-Device-Id, and inside each lane
+# devices get turns in proportion to their weight (DEVICE_WEIGHTS="kitchen=2,desk=1",
+# default 1). Optional caps on queued and running jobs per device (0 = no cap)
+DEVICE_WEIGHTS = {
+    device.strip(): float(weight)
+    for device, weight in (
+        item.split("=") for item in os.environ.get("DEVICE_WEIGHTS", "").split(",") if item.strip()
+    )
+}
+DEVICE_MAX_QUEUED = int(os.environ.get("DEVICE_MAX_QUEUED", "0"))
+DEVICE_MAX_IN_FLIGHT = int(os.environ.get("DEVICE_MAX_IN_FLIGHT", "0"))
+
+# Transcript cache: results keyed by a hash of the decoded PCM + decode options.
+# TRANSCRIPT_CACHE_SIZE=0 disables it; TRANSCRIPT_CACHE_PATH persists it to SQLite
+TRANSCRIPT_CACHE_SIZE = int(os.environ.get("TRANSCRIPT_CACHE_SIZE", "2048"))
+TRANSCRIPT_CACHE_PATH = os.environ.get("TRANSCRIPT_CACHE_PATH")
+# Where queued jobs live: "memory" (this process only) or "sqlite", a file that
+# any number of server and worker processes on the same host share. WAL-mode
+# SQLite needs a local disk: never point QUEUE_PATH at a network filesystem
+QUEUE_BACKEND = os.environ.get("QUEUE_BACKEND", "memory")
+QUEUE_PATH = os.environ.get("QUEUE_PATH", "transcription_queue.db")
+# A claimed job goes back to the queue if its worker stops heartbeating for this long...
+QUEUE_VISIBILITY_TIMEOUT = float(os.environ.get("QUEUE_VISIBILITY_TIMEOUT", "60"))
+# ...and fails after being claimed this many times
+QUEUE_MAX_ATTEMPTS = int(os.environ.get("QUEUE_MAX_ATTEMPTS", "3"))
+
+# Everything besides the audio and per-request options that changes a transcript
+MODEL_ID = f"{WHISPER_BACKEND}:{WHISPER_MODEL}:cascade={CASCADE_MODEL}:vad={VAD_ENABLED}"
+transcript_cache = TranscriptCache(TRANSCRIPT_CACHE_SIZE, path=TRANSCRIPT_CACHE_PATH) if TRANSCRIPT_CACHE_SIZE else None
+
 # ----------------------------
 # Flask Setup
 # ----------------------------
 app = Flask(__name__)
-task_queue = queue.Queue()
-result_queue = queue.Queue()
+lanes = [
+    Lane("interactive", QUEUE_INTERACTIVE_MAX_SECONDS, QUEUE_INTERACTIVE_DEPTH, QUEUE_INTERACTIVE_MAX_WAIT),
+    Lane("bulk", float("inf"), QUEUE_BULK_DEPTH, QUEUE_BULK_MAX_WAIT, promote_after=QUEUE_BULK_PROMOTE_AFTER),
+]
+if QUEUE_BACKEND == "sqlite":
+    task_queue = SqliteJobQueue(
+        QUEUE_PATH, lanes, device_weights=DEVICE_WEIGHTS, max_queued_per_device=DEVICE_MAX_QUEUED,
+        max_in_flight_per_device=DEVICE_MAX_IN_FLIGHT, visibility_timeout=QUEUE_VISIBILITY_TIMEOUT,
+        max_attempts=QUEUE_MAX_ATTEMPTS,
+    )
+else:
+    task_queue = LaneQueue(lanes, device_weights=DEVICE_WEIGHTS, max_queued_per_device=DEVICE_MAX_QUEUED,
+                           max_in_flight_per_device=DEVICE_MAX_IN_FLIGHT)
+
+# How long finished jobs stay fetchable through GET /jobs/<id>
+JOB_RESULT_TTL = 600
+# Upper bound for the ?wait= long-poll on GET /jobs/<id>
+MAX_LONG_POLL = 60
+
+
+class TranscriptionJob:
+    """
+    One transcription request.
+    The caller waits on its own event instead of a shared result queue.
+    """
+
+    def __init__(self, audio, options=None, device="unknown"):
+        self.id = uuid.uuid4().hex
+        self.audio = audio
+        # Which robot sent it, for fair scheduling
+        self.device = device
+        # Keyword arguments for transcribe_batch(); jobs batch together only when these match
+        self.options = options or {}
+        self.audio_seconds = len(audio) / whisper.audio.SAMPLE_RATE
+        # Seconds left after VAD trimming (None until the worker trims it)
+        self.speech_seconds = None
+        # Which model answered (differs from WHISPER_MODEL only in cascade mode)
+        self.tier = None
+        # Set while the result should go into the transcript cache
+        self.cache_key = None
+        self.status = "queued"
+        self.transcript = None
+        self.error = None
+        self.created_at = time.time()
+        # Set by the worker: when it picked the job up, and how long the model ran
+        self.started_at = None
+        self.inference_seconds = None
+        self.finished_at = None
+        self._done = threading.Event()
+        self._callbacks = []
+        self._callbacks_lock = threading.Lock()
+
+    def finish(self, transcript=None, error=None, status=None):
+        self.transcript = transcript
+        self.error = error
+        self.status = status or ("failed" if error else "done")
+        self.finished_at = time.time()
+        with self._callbacks_lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """Call callback(job) from the finishing thread (right away if already done)"""
+        with self._callbacks_lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def wait(self, timeout=None):
+        """Block until the job finishes; returns False on timeout"""
+        return self._done.wait(timeout)
+
+    def is_done(self):
+        return self._done.is_set()
+
+    def timings(self):
+        """Server-side seconds spent waiting in the queue and in the model"""
+        queue_wait = (self.started_at or self.finished_at or time.time()) - self.created_at
+        return {
+            "queue_wait": round(queue_wait, 3),
+            "inference": round(self.inference_seconds or 0.0, 3),
+        }
+
+    def to_dict(self):
+        data = {
+            "job_id": self.id,
+            "device": self.device,
+            "status": self.status,
+            "audio_seconds": round(self.audio_seconds, 2),
+        }
+        if self.speech_seconds is not None:
+            data["speech_seconds"] = round(self.speech_seconds, 2)
+        if self.status == "done":
+            data["transcript"] = self.transcript
+            data["tier"] = self.tier
+            data["timings"] = self.timings()
+        elif self.status in ("failed", "expired"):
+            data["error"] = self.error
+        return data
+
+
+jobs = {}
+# Idempotency-Key header -> job, and cache key -> unfinished job
+jobs_by_idempotency_key = {}
+inflight_jobs = {}
+jobs_lock = threading.Lock()
+
+def _prune_jobs():
+    """Forget finished jobs older than JOB_RESULT_TTL (call with jobs_lock held)"""
+    cutoff = time.time() - JOB_RESULT_TTL
+    expired = [job_id for job_id, job in jobs.items()
+               if job.finished_at is not None and job.finished_at < cutoff]
+    for job_id in expired:
+        del jobs[job_id]
+    for key in [k for k, job in jobs_by_idempotency_key.items() if job.id not in jobs]:
+        del jobs_by_idempotency_key[key]
+
+def submit_job(audio, options=None, device="unknown"):
+    """Queue audio for transcription; raises QueueFull when its lane is full"""
+    job = TranscriptionJob(audio, options, device)
+    task_queue.put(job)
+    with jobs_lock:
+        _prune_jobs()
+        jobs[job.id] = job
+    return job
+
+def submit_upload(audio, options=None, idempotency_key=None, device="unknown"):
+    """
+    Queue an uploaded clip unless it is already known. Returns (job, cache) where
+    cache is "hit" (finished from the transcript cache), "joined" (a retry with a
+    known Idempotency-Key, or the same audio already being transcribed) or "miss".
+    """
+    options = options or {}
+    with jobs_lock:
+        _prune_jobs()
+        known = jobs_by_idempotency_key.get(idempotency_key)
+        # A retry after a failure or expiry gets a fresh attempt, not the old error
+        if known is not None and known.status in ("queued", "running", "done"):
+            return known, "joined"
+
+    key = cache_key(audio, options, MODEL_ID) if transcript_cache is not None else None
+    cached = transcript_cache.get(key) if key else None
+
+    job = TranscriptionJob(audio, options, device)
+    with jobs_lock:
+        if cached:
+            job.audio = None
+            job.tier = cached["tier"]
+            job.speech_seconds = cached["speech_seconds"]
+            job.finish(transcript=cached["transcript"])
+            status = "hit"
+        elif key in inflight_jobs:
+            job, status = inflight_jobs[key], "joined"
+        else:
+            job.cache_key = key
+            if key:
+                inflight_jobs[key] = job
+            status = "miss"
+        jobs[job.id] = job
+        if idempotency_key:
+            jobs_by_idempotency_key[idempotency_key] = job
+
+    if status == "miss":
+        try:
+            task_queue.put(job)
+        except QueueFull:
+            with jobs_lock:
+                jobs.pop(job.id, None)
+                if inflight_jobs.get(key) is job:
+                    del inflight_jobs[key]
+                jobs_by_idempotency_key.pop(idempotency_key, None)
+            raise
+    return job, status
+
+def finish_job(job, transcript=None, error=None, status=None):
+    """
+    Finish a job the worker ran, and cache the result. Its waiters are released
+    first; a failing queue or cache write is logged so the worker keeps running.
+    """
+    job.finish(transcript=transcript, error=error, status=status)
+    try:
+        task_queue.complete(job)
+    except Exception as e:
+        print(f"⚠️ Could not record job {job.id} in the queue: {e}")
+    jobs_total.inc(status=job.status)
+    record_device(job)
+    record_first_transcription(job)
+    if job.status in ("failed", "expired"):
+        with jobs_lock:
+            for key in [k for k, known in jobs_by_idempotency_key.items() if known is job]:
+                del jobs_by_idempotency_key[key]
+    if job.cache_key is None:
+        return
+    try:
+        if error is None:
+            transcript_cache.put(job.cache_key, {
+                "transcript": transcript,
+                "tier": job.tier,
+                "speech_seconds": job.speech_seconds,
+            })
+    except Exception as e:
+        print(f"⚠️ Could not cache job {job.id}: {e}")
+    finally:
+        with jobs_lock:
+            if inflight_jobs.get(job.cache_key) is job:
+                del inflight_jobs[job.cache_key]
+
+def expire_job(job, lane):
+    print(f"⌛ Job {job.id} waited more than {lane.max_wait:.0f} seconds in the {lane.name} queue")
+    job.audio = None
+    finish_job(job, error=f"Waited more than {lane.max_wait:.0f} s in the {lane.name} queue", status="expired")
+
+task_queue.on_expire = expire_job
+
+def job_from_record(record):
+    """A job rebuilt from a shared-queue row: queued by another process, or looked up by id"""
+    audio = record["audio"] if record["audio"] is not None else np.zeros(0, np.float32)
+    job = TranscriptionJob(audio, record["options"], record["device"])
+    job.id = record["id"]
+    job.audio_seconds = record["audio_seconds"]
+    job.created_at = record["created_at"]
+    return job
+
+def finish_from_record(job, record):
+    """Finish a job this process queued and another process ran (or the shared queue failed)"""
+    job.audio = None
+    job.tier = record["tier"]
+    job.speech_seconds = record["speech_seconds"]
+    job.started_at = record["started_at"]
+    job.inference_seconds = record["inference_seconds"]
+    finish_job(job, transcript=record["transcript"], error=record["error"], status=record["status"])
+
+def restore_from_record(job, record):
+    """Finish a job rebuilt from its row with the stored result (nothing else is recorded)"""
+    job.tier = record["tier"]
+    job.speech_seconds = record["speech_seconds"]
+    job.started_at = record["started_at"]
+    job.inference_seconds = record["inference_seconds"]
+    job.finish(transcript=record["transcript"], error=record["error"], status=record["status"])
+
+if QUEUE_BACKEND == "sqlite":
+    task_queue.make_job = job_from_record
+    task_queue.on_result = finish_from_record
+    task_queue.on_watched = restore_from_record
 
-def worker():
+def queue_reaper():
+    """Fail jobs that waited too long even while every worker is busy"""
     while True:
-        job_id, file_path = task_queue.get()
-        if job_id is None:
+        time.sleep(1)
+        task_queue.expire()
+
+def retry_after(lane):
+    """Seconds until a full lane has likely drained enough to take another job"""
+    workers = REPLICAS or WORKER_THREADS
+    return max(1, math.ceil(task_queue.lane_depth(lane) * service_seconds_per_job / workers))
+
+def get_job(job_id):
+    with jobs_lock:
+        job = jobs.get(job_id)
+    if job is not None:
+        return job
+    # With a shared queue the job may have been queued by another instance or before a restart
+    record = task_queue.find(job_id)
+    if record is None:
+        return None
+    job = job_from_record(record)
+    if record["status"] in ("done", "failed", "expired"):
+        restore_from_record(job, record)
+        return job
+    # Still queued or running elsewhere: watched, so a long-poll wakes when it finishes
+    job = task_queue.watch(job)
+    if not job.is_done():
+        job.status = record["status"]
+    return job
+
+# Per-tier answer counts and recent latencies, reported on /stats
+tier_stats = {}
+stats_lock = threading.Lock()
+
+# Moving average of inference seconds per job, for Retry-After estimates
+service_seconds_per_job = 2.0
+
+def record_service_time(seconds):
+    global service_seconds_per_job
+    service_seconds_per_job = 0.9 * service_seconds_per_job + 0.1 * seconds
+
+# Per-device request counts and recent latencies, reported on /stats
+device_stats = {}
+
+def record_device(job):
+    with stats_lock:
+        entry = device_stats.setdefault(job.device, {"count": 0, "latencies": deque(maxlen=500)})
+        entry["count"] += 1
+        entry["latencies"].append(job.finished_at - job.created_at)
+
+def record_tier(job):
+    with stats_lock:
+        entry = tier_stats.setdefault(job.tier, {"count": 0, "latencies": deque(maxlen=500)})
+        entry["count"] += 1
+        entry["latencies"].append(job.finished_at - job.created_at)
+
+# ----------------------------
+# Prometheus metrics (GET /metrics)
+# ----------------------------
+queue_wait_seconds = Histogram(
+    "transcriber_queue_wait_seconds", "Time jobs spent queued before a worker took them", ["lane"]
+)
+inference_seconds = Histogram(
+    "transcriber_inference_seconds", "Model time per batch", ["tier"]
+)
+decode_seconds = Histogram(
+    "transcriber_upload_decode_seconds", "Time to decode an upload into PCM",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0),
+)
+jobs_total = Counter("transcriber_jobs_total", "Finished jobs", ["status"])
+audio_seconds_total = Counter("transcriber_audio_seconds_total", "Seconds of audio received by workers")
+speech_seconds_total = Counter("transcriber_speech_seconds_total", "Seconds of audio left after VAD and sent to the model")
+busy_seconds_total = Counter(
+    "transcriber_worker_busy_seconds_total", "Seconds workers spent running the model; rate() / workers = utilization"
+)
+workers_busy = Gauge("transcriber_workers_busy", "Workers running the model right now")
+real_time_factor = Gauge("transcriber_real_time_factor", "Model seconds per speech second of the last batch")
+rejected_total = Counter("transcriber_rejected_total", "Uploads answered with 429", ["lane"])
+converse_stage_seconds = Histogram(
+    "transcriber_converse_stage_seconds", "Time per /converse stage (transcribe, intent, reply, speech)", ["stage"]
+)
+evictions_total = Counter("transcriber_model_evictions_total", "Times the idle model was unloaded")
+reload_seconds = Histogram(
+    "transcriber_model_reload_seconds", "Time to bring an evicted model back before the next batch",
+    buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0),
+)
+
+def backend_name():
+    if replica_pool is not None:
+        return replica_pool.backend_name or WHISPER_BACKEND
+    return getattr(meeting_transcriptor_model, "name", WHISPER_BACKEND)
+
+def _metric_families():
+    info = Gauge("transcriber_model_info", "Model and backend in use", ["model", "backend", "cascade_model"],
+                 fn=lambda: {(WHISPER_MODEL, backend_name(),
+                                 CASCADE_MODEL or ""): 1})
+    workers = Gauge("transcriber_workers", "Worker threads (one per replica in process-pool mode)",
+                    fn=lambda: REPLICAS or WORKER_THREADS)
+    depth = Gauge("transcriber_queue_depth", "Jobs waiting per lane", ["lane"],
+                  fn=lambda: {(lane.name,): task_queue.lane_depth(lane) for lane in task_queue.lanes})
+    expired = Gauge("transcriber_queue_expired", "Jobs dropped for waiting too long, per lane", ["lane"],
+                    fn=lambda: {(lane.name,): lane.expired for lane in task_queue.lanes})
+
+    def rss():
+        processes = {("server",): process_rss_bytes()}
+        if replica_pool is not None:
+            processes[("zygote",)] = process_rss_bytes(replica_pool.zygote_pid)
+            for replica in replica_pool.replicas:
+                if replica.pid is not None:
+                    processes[(f"replica-{replica.index}",)] = process_rss_bytes(replica.pid)
+        return {key: value for key, value in processes.items() if value is not None}
+
+    ready = Gauge("transcriber_ready", "1 once the model is loaded and warm", fn=lambda: int(ready_event.is_set()))
+    resident = Gauge("transcriber_model_resident", "1 while the model is in memory, 0 while evicted or reloading",
+                     fn=lambda: int(model_state == "resident"))
+    startup = Gauge("transcriber_startup_seconds", "Seconds spent in each startup stage", ["stage"],
+                    fn=lambda: {(name,): seconds for name, seconds in startup_profile})
+    rss_bytes = Gauge("transcriber_resident_memory_bytes", "Resident set size per process", ["process"], fn=rss)
+    families = [info, ready, resident, evictions_total, reload_seconds, startup, workers, workers_busy, depth, expired, rejected_total, queue_wait_seconds,
+                decode_seconds, inference_seconds, real_time_factor, jobs_total, audio_seconds_total,
+                speech_seconds_total, busy_seconds_total, converse_stage_seconds, rss_bytes]
+    if transcript_cache is not None:
+        families.append(Gauge("transcriber_cache_lookups", "Transcript cache lookups", ["result"],
+                              fn=lambda: {("hit",): transcript_cache.hits, ("miss",): transcript_cache.misses}))
+    return families
+
+def collect_batch():
+    """
+    Block for the first queued job, then keep collecting until the batch
+    window closes or the batch is full. Returns None on shutdown.
+    """
+    first = task_queue.get()
+    if first is None:
+        return None
+
+    # Fill the batch from the first job's lane only, so a quick command
+    # never waits on a long upload sharing its batch
+    lane = task_queue.lane_for(first)
+    batch = [first]
+    deadline = time.monotonic() + BATCH_WINDOW_MS / 1000
+    while len(batch) < BATCH_MAX_SIZE:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            job = task_queue.get(timeout=remaining, lane=lane)
+        except queue.Empty:
+            break
+        if job is None:
+            # Leave the shutdown marker for the next get()
+            task_queue.task_done()
+            task_queue.put(None)
+            break
+        batch.append(job)
+    return batch
+
+def run_batch_locally(audios, **options):
+    with model_lock:
+        return meeting_transcriptor_model.transcribe_batch(audios, **options)
+
+def worker(run_batch=run_batch_locally):
+    while True:
+        batch = collect_batch()
+        if batch is None:
             break
 
-        # Measure transcription start time
-        start_time = time.time()
+        # Audio was already decoded in memory by the request handler
+        ready = []
+        for job in batch:
+            job.status = "running"
+            job.started_at = time.time()
+            queue_wait_seconds.observe(job.started_at - job.created_at, lane=task_queue.lane_for(job).name)
+            audio_seconds_total.inc(job.audio_seconds)
+            audio = job.audio
+            if VAD_ENABLED:
+                audio = trim_silence(audio)
+                if audio is None:
+                    # Nothing but silence: answer right away without the model
+                    job.speech_seconds = 0.0
+                    print(f"🔇 Job {job.id} has no speech ({job.audio_seconds:.2f} seconds of audio)")
+                    finish_job(job, transcript="")
+                    continue
+            job.speech_seconds = len(audio) / whisper.audio.SAMPLE_RATE
+            speech_seconds_total.inc(job.speech_seconds)
+            print(f"🎵 Job {job.id} audio duration: {job.audio_seconds:.2f} seconds, "
+                  f"speech: {job.speech_seconds:.2f} seconds")
+            ready.append((job, audio))
 
-        # Load audio to get duration
-        audio = whisper.audio.load_audio(file_path)
-        duration_seconds = len(audio) / whisper.audio.SAMPLE_RATE
-        print(f"🎵 Received audio '{file_path}' with duration: {duration_seconds:.2f} seconds")
+        # Jobs with different decode options can't share a batch
+        groups = {}
+        for job, audio in ready:
+            key = tuple(sorted(decode_options(job).items()))
+            groups.setdefault(key, []).append((job, audio))
 
-        with model_lock:
-            result = meeting_transcriptor_model.transcribe(file_path, language=None)
+        try:
+            for key, group in groups.items():
+                run_group(run_batch, group, dict(key))
+        finally:
+            for job in batch:
+                # Drop the samples; finished jobs linger in the registry
+                job.audio = None
+                task_queue.task_done(job)
 
-        transcript = result["text"].strip()
+# Robot -> [language it was confidently heard in, requests left to reuse it],
+# for profiles with language "auto"
+device_languages = {}
 
-        # Measure transcription end time
-        end_time = time.time()
-        processing_time = end_time - start_time
-        print(f"⏱ Transcription completed in {processing_time:.2f} seconds")
+def decode_options(job):
+    """The job's options with a cached language filled in (None means detect it)"""
+    options = dict(job.options)
+    if options.get("language") == CACHED_LANGUAGE:
+        options["language"] = None
+        cached = device_languages.get(job.device)
+        if cached is not None:
+            options["language"], cached[1] = cached[0], cached[1] - 1
+            if cached[1] <= 0:
+                device_languages.pop(job.device, None)
+    return options
 
-        result_queue.put((job_id, transcript))
-        task_queue.task_done()
+def run_group(run_batch, group, options):
+    """Run one batch of (job, audio) pairs sharing the same decode options"""
+    # Local workers share one model: wait for it (and for a reload) before the clock starts
+    lock = model_lock if run_batch is run_batch_locally else contextlib.nullcontext()
+    try:
+        with model_in_use(), lock:
+            workers_busy.inc()
+            start_time = time.time()
+            try:
+                results = run_batch([audio for _, audio in group], **options)
+            finally:
+                processing_time = time.time() - start_time
+                workers_busy.dec()
+                busy_seconds_total.inc(processing_time)
+
+        print(f"⏱ Transcribed batch of {len(group)} clip(s) in {processing_time:.2f} seconds")
+        record_service_time(processing_time / len(group))
+        speech = sum(job.speech_seconds for job, _ in group)
+        if speech:
+            real_time_factor.set(processing_time / speech)
+        # Each job is charged its share of the batch, so per-job times add up to the model time
+        for job, _ in group:
+            job.inference_seconds = processing_time / len(group)
+    except Exception as e:
+        print(f"❌ Transcription failed for batch of {len(group)}: {e}")
+        for job, _ in group:
+            finish_job(job, error=str(e))
+        return
 
-for _ in range(2):
-    threading.Thread(target=worker, daemon=True).start()
+    for (job, _), result in zip(group, results):
+        if (job.options.get("language") == CACHED_LANGUAGE and result["text"].strip()
+                and (result.get("language_probability") or 0) >= LANGUAGE_CACHE_MIN_PROBABILITY):
+            device_languages[job.device] = [result["language"], LANGUAGE_CACHE_REQUESTS]
+        job.tier = result.get("tier", WHISPER_MODEL)
+        finish_job(job, transcript=result["text"].strip())
+        record_tier(job)
+    tiers = {job.tier for job, _ in group}
+    inference_seconds.observe(processing_time, tier=tiers.pop() if len(tiers) == 1 else "mixed")
+
+# ----------------------------
+# Staged Startup
+# ----------------------------
+# Flask binds right away while the model loads on a background thread.
+# /test is liveness; /ready answers 200 only once the workers are warm.
+# Uploads that arrive earlier wait in the queue (up to its wait limits).
+STARTUP_IN_BACKGROUND = os.environ.get("STARTUP_IN_BACKGROUND", "1") == "1"
+# Seconds of silence pushed through every replica before going ready (0 = skip)
+WARMUP_SECONDS = float(os.environ.get("WARMUP_SECONDS", "1"))
+
+ready_event = threading.Event()
+startup_stage = "loading model"
+startup_error = None
+# (stage, seconds) in order, starting with this module's own imports
+startup_profile = [("imports", time.perf_counter() - _import_started)]
+first_transcription_seconds = None
+
+def warm_up(run_batches):
+    """Push a silent clip through each model copy so the first real request doesn't pay for lazy init"""
+    silence = np.zeros(int(WARMUP_SECONDS * whisper.audio.SAMPLE_RATE), np.float32)
+    errors = []
+
+    def run(run_batch):
+        try:
+            # The cascade escalates an empty transcript, so both of its tiers get warmed
+            run_batch([silence], short_audio=SHORT_AUDIO_MODE)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(run_batch,)) for run_batch in run_batches]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        # A model that can't transcribe silence won't transcribe speech either
+        raise RuntimeError(f"Warm-up failed: {errors[0]}") from errors[0]
+
+def start_workers():
+    """Load the model, fork replicas, warm up and then start serving the queue"""
+    global meeting_transcriptor_model, startup_stage, startup_error
+
+    def stage(name, started):
+        startup_profile.append((name, time.perf_counter() - started))
+
+    try:
+        started = time.perf_counter()
+        if replica_pool is not None:
+            # Only the zygote holds the model; the replicas share it copy-on-write
+            replica_pool.load()
+        else:
+            meeting_transcriptor_model = load_model()
+        stage("model load", started)
+
+        started = time.perf_counter()
+        if replica_pool is not None:
+            # The zygote forks the replicas, so threads running here can't leak
+            # a held lock into them; each replica gets a dispatcher that only
+            # pulls work while its replica is idle
+            startup_stage = "forking replicas"
+            replica_pool.start()
+            run_batches = [replica.transcribe_batch for replica in replica_pool.replicas]
+            stage("replica fork", started)
+        else:
+            run_batches = [run_batch_locally] * WORKER_THREADS
+
+        if WARMUP_SECONDS > 0:
+            startup_stage = "warming up"
+            started = time.perf_counter()
+            # Every local worker shares one model, so one warm-up covers them all
+            warm_up(run_batches if replica_pool else run_batches[:1])
+            stage("warm-up", started)
+    except Exception as e:
+        startup_error = str(e)
+        startup_stage = "failed"
+        print(f"❌ Startup failed: {e}")
+        return
+
+    for run_batch in run_batches:
+        threading.Thread(target=worker, args=(run_batch,), daemon=True).start()
+    if IDLE_EVICT_MINUTES > 0:
+        threading.Thread(target=idle_evictor, daemon=True).start()
+    startup_stage = "ready"
+    ready_event.set()
+
+    total = time.perf_counter() - _import_started
+    print("🚀 Ready. Startup profile:")
+    for name, seconds in startup_profile:
+        print(f"   {name:<14} {seconds:7.2f} s")
+    print(f"   {'total':<14} {total:7.2f} s  (python -X importtime audio_transcriber.py breaks down the imports)")
+
+def record_first_transcription(job):
+    """Time from import to the first real transcript: the number a deploy is judged by"""
+    global first_transcription_seconds
+    if first_transcription_seconds is None and job.status == "done":
+        first_transcription_seconds = time.perf_counter() - _import_started
+        print(f"🥇 First transcription {first_transcription_seconds:.2f} seconds after startup")
+
+# ----------------------------
+# Idle Eviction
+# ----------------------------
+# With IDLE_EVICT_MINUTES set, a model that ran no batch for that long is
+# unloaded (replicas included) and the next batch loads it again; jobs stay
+# queued meanwhile. With WHISPER_WEIGHTS_CACHE the reload only maps the
+# cached weights, which usually still sit in the page cache.
+IDLE_EVICT_MINUTES = float(os.environ.get("IDLE_EVICT_MINUTES", "0"))
+
+# "resident", "evicted" or "reloading"
+model_state = "resident"
+residency_lock = threading.Lock()
+batches_running = 0
+last_batch_at = time.monotonic()
+
+def evict_model():
+    """Drop every reference to the model and hand the freed memory back to the OS"""
+    global meeting_transcriptor_model, model_state
+    if replica_pool is not None:
+        replica_pool.unload()
+    meeting_transcriptor_model = None
+    gc.collect()
+    try:
+        # glibc keeps small freed blocks in its arenas unless asked
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+    model_state = "evicted"
+    evictions_total.inc()
+
+def reload_model():
+    global meeting_transcriptor_model, model_state
+    model_state = "reloading"
+    started = time.perf_counter()
+    # Jobs queued behind the reload shouldn't be charged for it
+    task_queue.pause_expiry()
+    try:
+        if replica_pool is not None:
+            replica_pool.reload()
+        else:
+            meeting_transcriptor_model = load_model()
+    except Exception:
+        model_state = "evicted"
+        raise
+    finally:
+        task_queue.resume_expiry()
+    model_state = "resident"
+    seconds = time.perf_counter() - started
+    reload_seconds.observe(seconds)
+    print(f"♻️ Model reloaded in {seconds:.2f} seconds")
+
+@contextlib.contextmanager
+def model_in_use():
+    """Around a batch: reload an evicted model first (other workers wait) and keep it from being evicted"""
+    global batches_running, last_batch_at
+    with residency_lock:
+        if model_state != "resident":
+            reload_model()
+        batches_running += 1
+    try:
+        yield
+    finally:
+        with residency_lock:
+            batches_running -= 1
+            last_batch_at = time.monotonic()
+
+def idle_evictor():
+    idle_limit = IDLE_EVICT_MINUTES * 60
+    while True:
+        time.sleep(min(30, idle_limit / 4))
+        with residency_lock:
+            idle = time.monotonic() - last_batch_at
+            if model_state == "resident" and not batches_running and idle >= idle_limit:
+                print(f"💤 No jobs for {idle / 60:.1f} minutes, unloading the model")
+                evict_model()
+
+threading.Thread(target=queue_reaper, daemon=True).start()
+if STARTUP_IN_BACKGROUND:
+    threading.Thread(target=start_workers, daemon=True).start()
+else:
+    start_workers()
+
+# ----------------------------
+# Streaming Sessions
+# ----------------------------
+def _common_prefix(a, b):
+    n = 0
+    while n < len(a) and n < len(b) and a[n] == b[n]:
+        n += 1
+    return a[:n]
+
+
+class StreamSession:
+    """
+    Audio arriving in chunks while the robot is still recording.
+
+    Each decode runs over the current window through the normal job queue,
+    so streams share the batching workers with /transcribe. Words that two
+    consecutive decodes agree on become "stable" and never change again.
+    Once the window passes STREAM_WINDOW_SECONDS its text is frozen and a
+    new window starts at the end of the audio decoded so far.
+    """
+
+    def __init__(self, options=None, device="unknown"):
+        self.id = uuid.uuid4().hex
+        self.options = options or {}
+        self.device = device
+        self.lock = threading.Lock()
+        self.samples = []
+        self.total_samples = 0
+        self.window_start = 0
+        self.decoded_until = 0
+        self.frozen_text = ""
+        self.hypothesis = []
+        self.stable = []
+        self.pending = None
+        self.pending_until = 0
+        self.last_active = time.time()
+
+    def append(self, audio):
+        self.samples.append(audio)
+        self.total_samples += len(audio)
+        self.last_active = time.time()
+
+    def _window_audio(self):
+        audio = np.concatenate(self.samples) if self.samples else np.zeros(0, np.float32)
+        self.samples = [audio]
+        return audio[self.window_start:]
+
+    def _fold_pending(self):
+        """Merge a finished decode into the hypothesis (call with lock held)"""
+        if self.pending is None or not self.pending.is_done():
+            return
+        job, self.pending = self.pending, None
+        if job.status != "done":
+            return
+        words = job.transcript.split()
+        agreed = _common_prefix(self.hypothesis, words)
+        # Stable text only ever grows
+        if len(agreed) > len(self.stable) and agreed[:len(self.stable)] == self.stable:
+            self.stable = agreed
+        self.hypothesis = words
+        self.decoded_until = self.pending_until
+
+    def _slide_window(self):
+        window_seconds = (self.total_samples - self.window_start) / whisper.audio.SAMPLE_RATE
+        if window_seconds <= STREAM_WINDOW_SECONDS or self.decoded_until <= self.window_start:
+            return
+        self.frozen_text = " ".join(filter(None, [self.frozen_text] + self.hypothesis))
+        self.window_start = self.decoded_until
+        self.hypothesis = []
+        self.stable = []
+
+    def maybe_decode(self):
+        """Queue a decode of the window if enough new audio arrived and none is running"""
+        with self.lock:
+            self._fold_pending()
+            new_seconds = (self.total_samples - self.decoded_until) / whisper.audio.SAMPLE_RATE
+            if self.pending is not None or new_seconds < STREAM_DECODE_INTERVAL:
+                return
+            self._slide_window()
+            self.pending_until = self.total_samples
+            try:
+                self.pending = submit_job(self._window_audio(), self.options, self.device)
+            except QueueFull:
+                # Server is saturated: skip this partial, the next chunk tries again
+                pass
+
+    def finish(self):
+        """Decode whatever is left and return the final transcript (raises QueueFull)"""
+        with self.lock:
+            if self.pending is not None:
+                self.pending.wait()
+                self._fold_pending()
+            if self.total_samples > self.decoded_until:
+                self._slide_window()
+                self.pending_until = self.total_samples
+                self.pending = submit_job(self._window_audio(), self.options, self.device)
+                self.pending.wait()
+                self._fold_pending()
+            return " ".join(filter(None, [self.frozen_text] + self.hypothesis))
+
+    def to_dict(self):
+        with self.lock:
+            self._fold_pending()
+            return {
+                "stream_id": self.id,
+                "partial": " ".join(filter(None, [self.frozen_text] + self.hypothesis)),
+                "stable": " ".join(filter(None, [self.frozen_text] + self.stable)),
+                "audio_seconds": round(self.total_samples / whisper.audio.SAMPLE_RATE, 2),
+            }
+
+
+streams = {}
+streams_lock = threading.Lock()
+
+def _prune_streams():
+    """Drop abandoned streams (call with streams_lock held)"""
+    cutoff = time.time() - STREAM_IDLE_TIMEOUT
+    for stream_id in [sid for sid, st in streams.items() if st.last_active < cutoff]:
+        del streams[stream_id]
+
+# ----------------------------
+# Long Recordings
+# ----------------------------
+# Long uploads are cut at silence into overlapping chunks that go through the
+# job queue like any other clip, so every worker (or replica, or --worker
+# process on a shared queue) takes a share and batches can hold several chunks
+LONG_AUDIO_CHUNK_SECONDS = float(os.environ.get("LONG_AUDIO_CHUNK_SECONDS", "25"))
+LONG_AUDIO_OVERLAP_SECONDS = float(os.environ.get("LONG_AUDIO_OVERLAP_SECONDS", "1"))
+# Chunks of one recording queued at a time, so a meeting can't fill the bulk lane by itself
+LONG_AUDIO_MAX_IN_FLIGHT = int(os.environ.get("LONG_AUDIO_MAX_IN_FLIGHT", "8"))
+# With none of its chunks queued, a recording retries a full lane for this long
+# before failing the chunks it couldn't queue
+LONG_AUDIO_QUEUE_TIMEOUT = float(os.environ.get("LONG_AUDIO_QUEUE_TIMEOUT", "60"))
+SUMMARY_SENTENCES = int(os.environ.get("SUMMARY_SENTENCES", "5"))
+
+def transcribe_long(audio, options=None, device="unknown", summary_sentences=SUMMARY_SENTENCES):
+    """
+    Yield progress events for a long recording: "start", one "chunk" per
+    chunk in the order they finish, then "transcript" (the stitched text)
+    and "summary" (LexRank sentences). Raises QueueFull before the "start"
+    event if not even the first chunk can be queued.
+    """
+    started = time.perf_counter()
+    ranges = split_at_silence(audio, LONG_AUDIO_CHUNK_SECONDS, LONG_AUDIO_OVERLAP_SECONDS)
+    finished = queue.Queue()
+    pending = {}
+    texts = [""] * len(ranges)
+    next_index = completed = 0
+
+    def queue_chunk(index):
+        start, end = ranges[index]
+        job = submit_job(audio[start:end], options, device)
+        pending[job.id] = index
+        job.add_done_callback(finished.put)
+
+    def chunk_event(index):
+        start, end = ranges[index]
+        return {
+            "event": "chunk",
+            "index": index,
+            "start": round(start / whisper.audio.SAMPLE_RATE, 2),
+            "end": round(end / whisper.audio.SAMPLE_RATE, 2),
+            "completed": completed,
+            "total": len(ranges),
+        }
+
+    if ranges:
+        queue_chunk(0)
+        next_index = 1
+    yield {"event": "start", "chunks": len(ranges), "audio_seconds": round(len(audio) / whisper.audio.SAMPLE_RATE, 2)}
+
+    full_since = None
+    while next_index < len(ranges) or pending:
+        while next_index < len(ranges) and len(pending) < LONG_AUDIO_MAX_IN_FLIGHT:
+            try:
+                queue_chunk(next_index)
+            except QueueFull:
+                if pending:
+                    break
+                # Nothing of ours to wait for: back off until the lane drains a little
+                full_since = full_since or time.monotonic()
+                if time.monotonic() - full_since > LONG_AUDIO_QUEUE_TIMEOUT:
+                    break
+                time.sleep(1)
+                continue
+            full_since = None
+            next_index += 1
+
+        if not pending:
+            # The lane stayed full: fail the chunks that never got queued
+            for index in range(next_index, len(ranges)):
+                completed += 1
+                yield {**chunk_event(index), "error": f"Queue full for {LONG_AUDIO_QUEUE_TIMEOUT:.0f} s"}
+            break
+
+        job = finished.get()
+        index = pending.pop(job.id)
+        completed += 1
+        event = chunk_event(index)
+        if job.status == "done":
+            texts[index] = job.transcript.strip()
+            event["text"] = texts[index]
+        else:
+            event["error"] = job.error
+        yield event
+
+    transcript = stitch(texts)
+    elapsed = time.perf_counter() - started
+    print(f"📼 Long recording: {len(ranges)} chunk(s), {len(audio) / whisper.audio.SAMPLE_RATE:.0f} s of audio "
+          f"in {elapsed:.1f} s")
+    yield {"event": "transcript", "text": transcript, "seconds": round(elapsed, 2)}
+
+    try:
+        yield {"event": "summary", "sentences": summarize(transcript, summary_sentences, LANGUAGE) if transcript else []}
+    except Exception as e:
+        print(f"❌ Summary failed: {e}")
+        yield {"event": "summary", "error": str(e)}
+
+# ----------------------------
+# Conversation (/converse)
+# ----------------------------
+# TypeCast key and voice for the spoken reply; without a key /converse answers with text only
+TYPECAST_API_KEY = os.environ.get("TYPECAST_API_KEY")
+TYPECAST_VOICE_ID = os.environ.get("TYPECAST_VOICE_ID", "tc_632a759503f3cb7b9c8a717b")
+# Threads for the intent, reply and speech calls, which mostly wait on other APIs
+CONVERSE_THREADS = int(os.environ.get("CONVERSE_THREADS", "8"))
+
+converse_executor = ThreadPoolExecutor(CONVERSE_THREADS, thread_name_prefix="converse")
+
+def _timed(stage, timings, fn, *args):
+    start = time.perf_counter()
+    try:
+        return fn(*args)
+    finally:
+        timings[stage] = round(time.perf_counter() - start, 3)
+        converse_stage_seconds.observe(timings[stage], stage=stage)
+
+def detect_intent(transcript):
+    """The robot command for a transcript as a dict, {"command": "none"} if the model's answer isn't JSON"""
+    from get_intent import getSekaiIntent
+    answer = getSekaiIntent(transcript)
+    # The model sometimes wraps the JSON in a code fence or a sentence
+    match = re.search(r"\{.*\}", answer or "", re.DOTALL)
+    try:
+        data = json.loads(match.group(0)) if match else None
+    except ValueError:
+        data = None
+    if not isinstance(data, dict) or "command" not in data:
+        print(f"⚠️ Unexpected intent answer: {answer!r}")
+        return {"command": "none"}
+    return data
+
+def generate_reply(transcript, mood, timings):
+    """(reply text, reply WAV bytes or None); speech starts as soon as the text is back"""
+    from ai_talk import getSekaiResponse
+    from typecast_api import synthesize_speech
+    reply = _timed("reply", timings, getSekaiResponse, transcript, mood)
+    if not reply or not TYPECAST_API_KEY:
+        return reply, None
+    return reply, _timed("speech", timings, synthesize_speech, reply, TYPECAST_API_KEY, TYPECAST_VOICE_ID)
+
+def converse_with(transcript, mood):
+    """
+    Intent and reply for a transcript, run side by side.
+    A stage that fails is reported under "errors" instead of failing the whole turn.
+    """
+    timings = {}
+    data = {"transcript": transcript, "mood": mood, "command": {"command": "none"},
+            "reply": None, "audio": None, "errors": {}, "timings": timings}
+    if not transcript:
+        return data
+
+    intent = converse_executor.submit(_timed, "intent", timings, detect_intent, transcript)
+    reply = converse_executor.submit(generate_reply, transcript, mood, timings)
+    try:
+        data["command"] = intent.result()
+    except Exception as e:
+        print(f"❌ Intent failed: {e}")
+        data["errors"]["intent"] = str(e)
+    try:
+        data["reply"], audio = reply.result()
+        if audio is not None:
+            data["audio"] = base64.b64encode(audio).decode("ascii")
+        elif data["reply"] and TYPECAST_API_KEY:
+            data["errors"]["speech"] = "Text to speech failed"
+    except Exception as e:
+        print(f"❌ Reply failed: {e}")
+        data["errors"]["reply"] = str(e)
+    return data
+
+def converse_response(job, cache, mood, request_start):
+    """(JSON body, headers) answering /converse once its transcription is done"""
+    transcribe_time = time.perf_counter() - request_start
+    converse_stage_seconds.observe(transcribe_time, stage="transcribe")
+
+    data = converse_with(job.transcript.strip(), mood)
+    data["timings"]["transcribe"] = round(transcribe_time, 3)
+    print(f"💬 {data['transcript']!r} -> {data['command']} ({time.perf_counter() - request_start:.2f}s)")
+    return data, {
+        "X-Cache": cache,
+        "X-Server-Seconds": f"{time.perf_counter() - request_start:.3f}",
+    }
 
 # ----------------------------
 # Endpoints
 # ----------------------------
-@app.route("/transcribe", methods=["POST"])
-def transcribe_audio():
+def read_upload():
+    """
+    Decode the uploaded audio in memory.
+    Accepts a multipart WAV, FLAC or Opus file under 'file', or a raw 16 kHz mono S16_LE
+    PCM body sent as application/octet-stream.
+    Returns (audio, None) on success or (None, error_response).
+    """
+    if request.mimetype == "application/octet-stream":
+        return decode_upload(request.get_data())
+
     # Check if file is present
     if 'file' not in request.files:
-        return "No file part", 400
+        return None, ("No file part", 400)
     
     wav_file = request.files['file']
-    
+    return decode_upload(wav_file.read(), wav_file.filename)
+
+def decode_upload(data, filename=None):
+    """
+    Upload bytes -> (audio, None) or (None, (message, status)).
+    filename is None for a raw PCM body, else the multipart file's name.
+    Shared by the Flask handlers and async_server.
+    """
+    if filename is None:
+        if not data:
+            return None, ("Empty PCM body", 400)
+        try:
+            return pcm16_to_float32(data), None
+        except ValueError as e:
+            return None, (str(e), 400)
+
     # Check if file was selected
-    if wav_file.filename == '':
-        return "No selected file", 400
-    
-    # Check if file is WAV format
-    if not wav_file.filename.lower().endswith('.wav'):
-        return "Only WAV files are accepted", 400
+    if filename == '':
+        return None, ("No selected file", 400)
     
-    # Save the uploaded file temporarily
-    temp_path = f"recording_{uuid.uuid4().hex}.wav"
-    wav_file.save(temp_path)
+    # Check the format by extension (clients learn the list from X-Accept-Audio)
+    fmt = upload_format(filename)
+    if fmt is None:
+        return None, (f"Unsupported audio format; send one of: {ACCEPT_AUDIO}", 415)
     
-    # Create job ID and add to queue
-    job_id = threading.get_ident()
-    task_queue.put((job_id, temp_path))
+    # 16 kHz mono S16_LE (what arecord gives us) and FLAC / Opus are decoded
+    # in-process; anything else goes through ffmpeg via a pipe
+    try:
+        if fmt == "wav":
+            return decode_wav_bytes(data), None
+        return decode_compressed(data), None
+    except Exception as e:
+        return None, (f"Could not decode audio: {e}", 400)
+
+def read_device():
+    """Which robot sent the request; falls back to its address"""
+    return request.headers.get("X-Device-Id") or request.remote_addr or "unknown"
+
+def read_options():
+    """Per-request decode options from the query string"""
+    return parse_options(request.args)
+
+class UnknownProfile(ValueError):
+    def __init__(self, name):
+        super().__init__(f"Unknown decoding profile '{name}'; use one of: {', '.join(DECODING_PROFILES)}")
+
+def parse_options(args):
+    """Decode options for a ?profile= (raises UnknownProfile), with ?short_audio= on top"""
+    profile = args.get("profile") or DECODING_PROFILE
+    if profile not in DECODING_PROFILES:
+        raise UnknownProfile(profile)
+    short_audio = args.get("short_audio")
+    if short_audio is None:
+        short_audio = SHORT_AUDIO_MODE
+    else:
+        short_audio = short_audio.lower() in ("1", "true", "yes")
+    return {**DECODING_PROFILES[profile], "short_audio": short_audio}
+
+# Upload formats we decode, advertised on every response so new clients can
+# send compressed audio and fall back to WAV for servers without the header
+ACCEPT_AUDIO = ", ".join(UPLOAD_FORMATS)
+
+@app.after_request
+def advertise_upload_formats(response):
+    response.headers["X-Accept-Audio"] = ACCEPT_AUDIO
+    return response
+
+@app.before_request
+def refuse_work_after_failed_startup():
+    # Without a model nothing would ever leave the queue; fail fast instead
+    if startup_error and request.method == "POST":
+        return jsonify({"error": f"Model failed to load: {startup_error}"}), 503
+
+def rejection(e):
+    """(JSON body, status, headers) answering a QueueFull"""
+    print(f"🚦 {e}")
+    rejected_total.inc(lane=e.lane.name)
+    return {"error": str(e), "lane": e.lane.name}, 429, {"Retry-After": str(retry_after(e.lane))}
+
+@app.errorhandler(QueueFull)
+def queue_full(e):
+    body, status, headers = rejection(e)
+    return jsonify(body), status, headers
+
+@app.errorhandler(UnknownProfile)
+def unknown_profile(e):
+    return str(e), 400
+
+def transcription_response(job, cache, decode_time, request_start):
+    """(body, status, headers) for a finished /transcribe job"""
+    if job.status == "failed":
+        return f"Transcription failed: {job.error}", 500, {}
+    if job.status == "expired":
+        lane = task_queue.lane_for(job)
+        return f"Transcription failed: {job.error}", 503, {"Retry-After": str(retry_after(lane))}
+
+    # Print only the transcription output
+    print(job.transcript)
+    # Server-side timings, so clients can tell them apart from network time
+    timings = job.timings()
+    return job.transcript, 200, {
+        "X-Audio-Seconds": f"{job.audio_seconds:.2f}",
+        "X-Speech-Seconds": f"{job.speech_seconds:.2f}",
+        "X-Model-Tier": job.tier or "none",
+        "X-Cache": cache,
+        "X-Decode-Seconds": f"{decode_time:.3f}",
+        "X-Queue-Wait-Seconds": f"{timings['queue_wait']:.3f}",
+        "X-Inference-Seconds": f"{timings['inference']:.3f}",
+        "X-Server-Seconds": f"{time.perf_counter() - request_start:.3f}",
+    }
+
+@app.route("/transcribe", methods=["POST"])
+def transcribe_audio():
+    request_start = time.perf_counter()
+    audio, error = read_upload()
+    if error:
+        return error
+    decode_time = time.perf_counter() - request_start
+    decode_seconds.observe(decode_time)
     
-    # Wait for transcription result
-    while True:
-        rid, transcript = result_queue.get()
-        if rid == job_id:
-            try:
-                os.remove(temp_path)
-            except Exception as e:
-                print(f"Cleanup error: {e}")
-            # Print only the transcription output
-            print(transcript)
-            return transcript
+    # Queue the job (or find its cached / in-flight twin) and wait on its own event
+    job, cache = submit_upload(
+        audio, read_options(), request.headers.get("Idempotency-Key"), read_device()
+    )
+    job.wait()
+    return transcription_response(job, cache, decode_time, request_start)
+
+@app.route("/transcribe/long", methods=["POST"])
+def transcribe_long_audio():
+    """
+    Long recordings (meetings): same upload as /transcribe, answered with
+    newline-delimited JSON events while the chunks finish (see transcribe_long).
+    """
+    audio, error = read_upload()
+    if error:
+        return error
+    try:
+        sentences = int(request.args.get("summary_sentences", SUMMARY_SENTENCES))
+    except ValueError:
+        return jsonify({"error": "summary_sentences must be an integer"}), 400
+
+    events = transcribe_long(audio, read_options(), read_device(), sentences)
+    # Run up to the "start" event here, so a full queue is still answered with 429
+    first = next(events)
+    return Response((json.dumps(event) + "\n" for event in itertools.chain([first], events)),
+                    mimetype="application/x-ndjson")
+
+@app.route("/converse", methods=["POST"])
+def converse():
+    """
+    One round trip for a voice command: the recorded WAV (plus a 'mood' form
+    field or query parameter) in; transcript, command, reply text and the
+    base64 reply WAV out.
+    """
+    request_start = time.perf_counter()
+    audio, error = read_upload()
+    if error:
+        return error
+    decode_time = time.perf_counter() - request_start
+    decode_seconds.observe(decode_time)
+    mood = request.form.get("mood") or request.args.get("mood") or "happy"
+
+    job, cache = submit_upload(
+        audio, read_options(), request.headers.get("Idempotency-Key"), read_device()
+    )
+    job.wait()
+    if job.status != "done":
+        return transcription_response(job, cache, decode_time, request_start)
+    data, headers = converse_response(job, cache, mood, request_start)
+    return jsonify(data), 200, headers
+
+@app.route("/jobs", methods=["POST"])
+def create_job():
+    request_start = time.perf_counter()
+    audio, error = read_upload()
+    if error:
+        return error
+    decode_seconds.observe(time.perf_counter() - request_start)
+
+    job, cache = submit_upload(
+        audio, read_options(), request.headers.get("Idempotency-Key"), read_device()
+    )
+    response = jsonify({**job.to_dict(), "cache": cache})
+    response.status_code = 202
+    response.headers["Location"] = f"/jobs/{job.id}"
+    return response
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+
+    # Long-poll: ?wait=<seconds> holds the request until the job finishes
+    try:
+        wait_seconds = float(request.args.get("wait", 0))
+    except ValueError:
+        return jsonify({"error": "wait must be a number"}), 400
+    if wait_seconds > 0:
+        job.wait(min(wait_seconds, MAX_LONG_POLL))
+
+    return jsonify(job.to_dict()), (200 if job.is_done() else 202)
+
+@app.route("/stream", methods=["POST"])
+def open_stream():
+    session = StreamSession(read_options(), read_device())
+    with streams_lock:
+        _prune_streams()
+        streams[session.id] = session
+    response = jsonify(session.to_dict())
+    response.status_code = 201
+    response.headers["Location"] = f"/stream/{session.id}"
+    return response
+
+@app.route("/stream/<stream_id>/chunk", methods=["POST"])
+def stream_chunk(stream_id):
+    with streams_lock:
+        session = streams.get(stream_id)
+    if session is None:
+        return jsonify({"error": "Unknown stream"}), 404
+
+    # Chunks are raw 16 kHz mono S16_LE PCM, exactly what arecord -t raw writes
+    try:
+        audio = pcm16_to_float32(request.get_data())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    with session.lock:
+        session.append(audio)
+    session.maybe_decode()
+    return jsonify(session.to_dict())
+
+@app.route("/stream/<stream_id>/end", methods=["POST"])
+def end_stream(stream_id):
+    with streams_lock:
+        session = streams.pop(stream_id, None)
+    if session is None:
+        return jsonify({"error": "Unknown stream"}), 404
+
+    # A last chunk may ride along with the end request
+    data = request.get_data()
+    if data:
+        try:
+            audio = pcm16_to_float32(data)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        with session.lock:
+            session.append(audio)
+
+    try:
+        final = session.finish()
+    except QueueFull:
+        # Keep the stream so the client can retry /end after Retry-After
+        with streams_lock:
+            streams[stream_id] = session
+        raise
+    print(final)
+    return jsonify({"stream_id": session.id, "final": final})
+
+@app.route("/stats", methods=["GET"])
+def server_stats():
+    with stats_lock:
+        total = sum(entry["count"] for entry in tier_stats.values())
+        tiers = {
+            tier: {
+                "count": entry["count"],
+                "share": round(entry["count"] / total, 3),
+                "median_latency": round(statistics.median(entry["latencies"]), 3),
+            }
+            for tier, entry in tier_stats.items()
+        }
+        device_latencies = {device: (entry["count"], list(entry["latencies"]))
+                            for device, entry in device_stats.items()}
+    counts = task_queue.device_counts()
+    devices = {}
+    for device in set(device_latencies) | set(counts):
+        count, latencies = device_latencies.get(device, (0, []))
+        queued, in_flight = counts.get(device, (0, 0))
+        devices[device] = {"count": count, "queued": queued, "in_flight": in_flight}
+        if latencies:
+            devices[device]["p50_latency"] = round(float(np.percentile(latencies, 50)), 3)
+            devices[device]["p99_latency"] = round(float(np.percentile(latencies, 99)), 3)
+    data = {"model": WHISPER_MODEL, "backend": WHISPER_BACKEND, "tiers": tiers, "devices": devices}
+    if CASCADE_MODEL:
+        escalated = tier_stats.get(WHISPER_MODEL, {}).get("count", 0)
+        data["escalation_rate"] = round(escalated / total, 3) if total else 0.0
+    if transcript_cache is not None:
+        lookups = transcript_cache.hits + transcript_cache.misses
+        data["cache"] = {
+            "entries": len(transcript_cache),
+            "hits": transcript_cache.hits,
+            "misses": transcript_cache.misses,
+            "hit_rate": round(transcript_cache.hits / lookups, 3) if lookups else 0.0,
+        }
+    return jsonify(data)
+
+@app.route("/queue", methods=["GET"])
+def queue_status():
+    return jsonify({
+        "backend": QUEUE_BACKEND,
+        "depth": task_queue.depth(),
+        "lanes": task_queue.to_dict(),
+        "service_seconds_per_job": round(service_seconds_per_job, 3),
+    })
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return render(_metric_families()), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
 
 @app.route("/test", methods=["GET"])
 def test_connection():
+    # Liveness only: the process is up, the model may still be loading (see /ready)
     return "Server is running", 200
 
+@app.route("/ready", methods=["GET"])
+def readiness():
+    data = {
+        "ready": ready_event.is_set(),
+        "stage": startup_stage,
+        "model": model_state,
+        "profile": {name: round(seconds, 3) for name, seconds in startup_profile},
+        "uptime": round(time.perf_counter() - _import_started, 3),
+    }
+    if first_transcription_seconds is not None:
+        data["first_transcription"] = round(first_transcription_seconds, 3)
+    if startup_error:
+        data["error"] = startup_error
+    return jsonify(data), (200 if data["ready"] else 503)
+
 # ----------------------------
 # Run Server
 # ----------------------------
 if __name__ == "__main__":
+    if "--worker" in sys.argv:
+        # Only pull jobs from the shared queue; the HTTP instances queue them
+        if QUEUE_BACKEND != "sqlite":
+            sys.exit("--worker needs QUEUE_BACKEND=sqlite")
+        print(f"👷 Worker {task_queue.worker_id} serving {QUEUE_PATH}")
+        threading.Event().wait()
     app.run(host="0.0.0.0", port=5000)
\ No newline at end of file
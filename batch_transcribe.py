@@ -0,0 +1,175 @@
+"""
+Offline batch transcription of recorded audio archives.
+
+    python batch_transcribe.py recordings/ --output transcripts.jsonl
+    python batch_transcribe.py recordings/ old_commands/ --workers 4 --model small
+
+Walks the given folders for .wav/.flac/.opus files and transcribes them in
+process-pool workers that share one copy of the model (loaded before the
+pool forks, as the server's replicas do). One JSON line per file is
+appended to --output as soon as it is done, so an interrupted run started
+again with the same output skips everything already transcribed and picks
+up where it stopped. Files that failed are retried on the next run (so a
+file can have several lines; the last one wins).
+"""
+import argparse
+import functools
+import json
+import multiprocessing
+import os
+import time
+
+import whisper
+
+from audio_ingest import decode_compressed, decode_wav_bytes, trim_silence, upload_format
+from replica_pool import default_threads_per_replica
+from whisper_backends import BACKENDS, load_backend
+
+# Set in the parent before the pool forks, so children share its pages
+_backend = None
+
+
+def find_audio(paths):
+    """Every file under paths the server could decode, in a stable order"""
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                found.extend(os.path.join(root, f) for f in files if upload_format(f))
+        elif upload_format(path):
+            found.append(path)
+    return sorted(os.path.abspath(path) for path in found)
+
+
+def load_done(output):
+    """Paths the output file already has a transcript for (a torn last line is ignored)"""
+    done = set()
+    if not os.path.exists(output):
+        return done
+    with open(output) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if "transcript" in record:
+                done.add(record["path"])
+    return done
+
+
+def _end_torn_line(output):
+    """Start appending on a fresh line if the last run died mid-write"""
+    if os.path.exists(output) and os.path.getsize(output):
+        with open(output, "rb+") as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+
+
+def _init_worker(threads):
+    _backend.set_threads(threads)
+
+
+def _decode(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    return decode_wav_bytes(data) if upload_format(path) == "wav" else decode_compressed(data)
+
+
+def transcribe_files(paths, options):
+    """Worker: transcribe a batch of files; returns one record per file, errors included"""
+    records, clips = [], []
+    for path in paths:
+        record = {"path": path}
+        try:
+            audio = _decode(path)
+        except Exception as e:
+            record["error"] = f"Could not decode audio: {e}"
+            records.append(record)
+            continue
+        record["audio_seconds"] = round(len(audio) / whisper.audio.SAMPLE_RATE, 2)
+        if options["vad"]:
+            audio = trim_silence(audio)
+            if audio is None:
+                record.update(transcript="", speech_seconds=0.0)
+                records.append(record)
+                continue
+        record["speech_seconds"] = round(len(audio) / whisper.audio.SAMPLE_RATE, 2)
+        records.append(record)
+        clips.append((record, audio))
+
+    if clips:
+        start = time.perf_counter()
+        try:
+            results = _backend.transcribe_batch(
+                [audio for _, audio in clips], language=options["language"], short_audio=options["short_audio"],
+            )
+        except Exception as e:
+            for record, _ in clips:
+                record["error"] = str(e)
+            return records
+        seconds = round((time.perf_counter() - start) / len(clips), 3)
+        for (record, _), result in zip(clips, results):
+            record.update(transcript=result["text"].strip(), language=result.get("language"), seconds=seconds)
+    return records
+
+
+def _batches(paths, size):
+    for i in range(0, len(paths), size):
+        yield paths[i:i + size]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", help="audio files or folders to walk")
+    parser.add_argument("--output", default="transcripts.jsonl", help="JSONL file to append results to")
+    parser.add_argument("--model", default=os.environ.get("WHISPER_MODEL", "medium"), help="Whisper model name")
+    parser.add_argument("--backend", default=os.environ.get("WHISPER_BACKEND", "torch"), choices=sorted(BACKENDS))
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 1) // 4),
+                        help="worker processes (each gets cores / workers threads)")
+    parser.add_argument("--batch-size", type=int, default=8, help="files per batched model call")
+    parser.add_argument("--language", default=None, help="pin the language instead of detecting it per file")
+    parser.add_argument("--short-audio", action="store_true", help="shrink the encoder to each clip's length")
+    parser.add_argument("--no-vad", dest="vad", action="store_false", help="don't trim silence before decoding")
+    args = parser.parse_args()
+
+    paths = find_audio(args.paths)
+    done = load_done(args.output)
+    todo = [path for path in paths if path not in done]
+    print(f"📂 {len(paths)} file(s), {len(paths) - len(todo)} already in {args.output}, {len(todo)} to go")
+    if not todo:
+        return
+
+    global _backend
+    print(f"Loading Whisper model '{args.model}' with the {args.backend} backend...")
+    _backend = load_backend(args.backend, args.model, for_replicas=True)
+    options = {"language": args.language, "short_audio": args.short_audio, "vad": args.vad}
+
+    _end_torn_line(args.output)
+    started = time.perf_counter()
+    audio_seconds = 0.0
+    completed = failed = 0
+    context = multiprocessing.get_context("fork")
+    with context.Pool(args.workers, _init_worker, (default_threads_per_replica(args.workers),)) as pool, \
+            open(args.output, "a") as output:
+        batches = _batches(todo, args.batch_size)
+        for records in pool.imap_unordered(functools.partial(transcribe_files, options=options), batches):
+            for record in records:
+                output.write(json.dumps(record) + "\n")
+                completed += 1
+                failed += "error" in record
+                audio_seconds += record.get("audio_seconds", 0.0)
+            output.flush()
+
+            wall = time.perf_counter() - started
+            rate = audio_seconds / wall
+            remaining = (len(todo) - completed) * wall / completed
+            print(f"⏱ {completed}/{len(todo)} files ({failed} failed), {audio_seconds / 3600:.2f} h of audio "
+                  f"in {wall / 60:.1f} min: {rate:.1f} audio-hours per wall-hour, ~{remaining / 60:.0f} min left")
+
+    print(f"✅ Done: {completed} file(s), {audio_seconds / 3600:.2f} h of audio in "
+          f"{(time.perf_counter() - started) / 60:.1f} min -> {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""
+Bounded, prioritised, fair job queue for the transcription server.
+
+Jobs are sorted into lanes by clip length: short interactive commands go
+into a lane that is always served first, long uploads into a bulk lane.
+Every lane has a maximum depth (put() raises QueueFull once it is full, so
+the server can answer 429 instead of letting clients time out) and a
+maximum queue wait (older jobs are handed to on_expire instead of being run).
+The wait clock can be paused (pause_expiry()) while the server can't run
+anything, e.g. during a model reload, so that time isn't counted as waiting.
+A bulk job that has waited longer than its lane's promote_after is served
+before interactive work, so long uploads are never starved completely.
+
+Inside a lane, jobs from different devices (robots) are served by weighted
+fair queuing: each job is stamped with a virtual finish time of
+    max(lane virtual time, device's previous finish) + audio seconds / weight
+and the smallest stamp goes next, so a device flooding the queue only
+delays its own jobs. Devices can also be capped on queued and running jobs.
+"""
+import queue
+import threading
+import time
+from collections import deque
+
+
+class QueueFull(queue.Full):
+    def __init__(self, lane, device=None):
+        if device is None:
+            message = f"The {lane.name} queue is full ({lane.max_depth} jobs)"
+        else:
+            message = f"Device '{device}' has too many jobs queued in the {lane.name} queue"
+        super().__init__(message)
+        self.lane = lane
+        self.device = device
+
+
+class Lane:
+    def __init__(self, name, max_audio_seconds, max_depth, max_wait, promote_after=None):
+        self.name = name
+        # Jobs up to this long go into this lane (the last lane takes everything else)
+        self.max_audio_seconds = max_audio_seconds
+        self.max_depth = max_depth
+        self.max_wait = max_wait
+        # Serve this lane ahead of higher-priority lanes once its oldest job waited this long
+        self.promote_after = promote_after
+        # device -> deque of (finish tag, enqueued_at, job) in arrival order
+        self.devices = {}
+        self.virtual_time = 0.0
+        self.last_tag = {}
+        self.admitted = 0
+        self.rejected = 0
+        self.expired = 0
+
+    def depth(self):
+        return sum(len(entries) for entries in self.devices.values())
+
+    def oldest_wait(self, now):
+        return max((now - entries[0][1] for entries in self.devices.values()), default=0.0)
+
+    def to_dict(self, now):
+        return {
+            "depth": self.depth(),
+            "max_depth": self.max_depth,
+            "max_wait": self.max_wait,
+            "oldest_wait": round(self.oldest_wait(now), 2),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "expired": self.expired,
+            "devices": {device: len(entries) for device, entries in self.devices.items()},
+        }
+
+
+class LaneQueue:
+    """
+    Drop-in for the queue.Queue the workers used to share: put(job),
+    get(timeout=None) and task_done(job), plus per-lane depths for /queue.
+    Lanes are given highest priority first. Jobs carry a .device; a device
+    with max_in_flight_per_device jobs dispatched gets nothing more until task_done().
+    """
+
+    def __init__(self, lanes, on_expire=None, device_weights=None,
+                 max_queued_per_device=None, max_in_flight_per_device=None):
+        self.lanes = lanes
+        self.on_expire = on_expire
+        self.device_weights = device_weights or {}
+        self.max_queued_per_device = max_queued_per_device
+        self.max_in_flight_per_device = max_in_flight_per_device
+        # device -> jobs handed to a worker and not yet task_done()
+        self.in_flight = {}
+        self._cond = threading.Condition()
+        # Control messages (the None shutdown marker) jump every lane
+        self._control = deque()
+        # Set while the wait clock is paused
+        self._paused_at = None
+
+    def lane_for(self, job):
+        for lane in self.lanes[:-1]:
+            if job.audio_seconds <= lane.max_audio_seconds:
+                return lane
+        return self.lanes[-1]
+
+    def put(self, job):
+        with self._cond:
+            if job is None:
+                self._control.append(None)
+            else:
+                lane = self.lane_for(job)
+                if lane.depth() >= lane.max_depth:
+                    lane.rejected += 1
+                    raise QueueFull(lane)
+                if (self.max_queued_per_device
+                        and len(lane.devices.get(job.device, ())) >= self.max_queued_per_device):
+                    lane.rejected += 1
+                    raise QueueFull(lane, job.device)
+
+                weight = self.device_weights.get(job.device, 1.0)
+                start = max(lane.virtual_time, lane.last_tag.get(job.device, 0.0))
+                # Floor the cost so tiny clips still advance their device's clock
+                tag = start + max(job.audio_seconds, 0.1) / weight
+                lane.last_tag[job.device] = tag
+                lane.devices.setdefault(job.device, deque()).append((tag, time.monotonic(), job))
+                lane.admitted += 1
+            # Wake everyone: a waiter filling a batch only takes jobs from its own lane
+            self._cond.notify_all()
+
+    def _pop_expired(self, now):
+        expired = []
+        for lane in self.lanes:
+            for device, entries in list(lane.devices.items()):
+                while entries and now - entries[0][1] > lane.max_wait:
+                    expired.append((lane, entries.popleft()[2]))
+                    lane.expired += 1
+                if not entries:
+                    del lane.devices[device]
+        return expired
+
+    def _can_run(self, device):
+        return (not self.max_in_flight_per_device
+                or self.in_flight.get(device, 0) < self.max_in_flight_per_device)
+
+    def _pop_from(self, lane):
+        """Pop the job with the smallest finish tag among devices under their cap"""
+        candidates = [(entries[0][0], device) for device, entries in lane.devices.items()
+                      if self._can_run(device)]
+        if not candidates:
+            return None
+        tag, device = min(candidates, key=lambda candidate: candidate[0])
+        entries = lane.devices[device]
+        job = entries.popleft()[2]
+        if not entries:
+            del lane.devices[device]
+        lane.virtual_time = tag
+        self.in_flight[device] = self.in_flight.get(device, 0) + 1
+        return job
+
+    def _pop_next(self, now, only=None):
+        if only is not None:
+            return self._pop_from(only)
+        # Promoted lanes first, otherwise in priority order (sorted() is stable)
+        lanes = sorted(self.lanes, key=lambda lane: not (
+            lane.promote_after is not None and lane.oldest_wait(now) > lane.promote_after
+        ))
+        for lane in lanes:
+            job = self._pop_from(lane)
+            if job is not None:
+                return job
+        return None
+
+    def pause_expiry(self):
+        """Stop the wait clock: nothing expires until resume_expiry()"""
+        with self._cond:
+            if self._paused_at is None:
+                self._paused_at = time.monotonic()
+
+    def resume_expiry(self):
+        """Restart the wait clock; time spent paused doesn't count as queue wait"""
+        with self._cond:
+            if self._paused_at is None:
+                return
+            now = time.monotonic()
+            for lane in self.lanes:
+                for device, entries in lane.devices.items():
+                    # Jobs queued during the pause start waiting now
+                    lane.devices[device] = deque(
+                        (tag, enqueued_at + now - max(enqueued_at, self._paused_at), job)
+                        for tag, enqueued_at, job in entries
+                    )
+            self._paused_at = None
+
+    def expire(self):
+        """Hand every job that waited past its lane's limit to on_expire"""
+        with self._cond:
+            if self._paused_at is not None:
+                return
+            expired = self._pop_expired(time.monotonic())
+        for lane, job in expired:
+            if self.on_expire:
+                self.on_expire(job, lane)
+
+    def get(self, timeout=None, lane=None):
+        """Next job by priority and fairness, or only from `lane` when given; raises queue.Empty on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self.expire()
+        with self._cond:
+            while True:
+                if self._control:
+                    return self._control.popleft()
+                job = self._pop_next(time.monotonic(), lane)
+                if job is not None:
+                    return job
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise queue.Empty
+                self._cond.wait(remaining)
+
+    def task_done(self, job=None):
+        """A job from get() finished; frees its device's in-flight slot"""
+        if job is None:
+            return
+        with self._cond:
+            self.in_flight[job.device] -= 1
+            if not self.in_flight[job.device]:
+                del self.in_flight[job.device]
+            self._cond.notify_all()
+
+    def complete(self, job):
+        """Results stay on the job object in this process; nothing to store"""
+
+    def find(self, job_id):
+        """Only shared queues can look up jobs this process doesn't hold"""
+        return None
+
+    def lane_depth(self, lane):
+        with self._cond:
+            return lane.depth()
+
+    def depth(self):
+        with self._cond:
+            return sum(lane.depth() for lane in self.lanes)
+
+    def device_counts(self):
+        """device -> (queued, in flight)"""
+        with self._cond:
+            queued = {}
+            for lane in self.lanes:
+                for device, entries in lane.devices.items():
+                    queued[device] = queued.get(device, 0) + len(entries)
+            return {device: (queued.get(device, 0), self.in_flight.get(device, 0))
+                    for device in set(queued) | set(self.in_flight)}
+
+    def to_dict(self):
+        now = time.monotonic()
+        with self._cond:
+            return {lane.name: lane.to_dict(now) for lane in self.lanes}
@@ -0,0 +1,346 @@
+"""
+Load test for POST /transcribe.
+
+Fires a corpus of WAVs at the server with a fixed number of concurrent
+clients (closed loop) or at a Poisson arrival rate (open loop), then reports
+latency percentiles, throughput, errors and real-time factor.
+
+Usage:
+    python load_test.py --url http://localhost:5000 --concurrency 8 --requests 200
+    python load_test.py --url http://localhost:5000 --rate 4 --duration 60 --devices 3
+    python load_test.py --in-process --stub-rtf 0.05 --concurrency 16 --max-p95 2.0
+
+--in-process imports audio_transcriber with a stub backend that sleeps for
+stub-rtf x audio seconds instead of running Whisper. It needs no weights,
+so it can catch queueing and batching regressions in CI. With --max-p95 or
+--max-error-rate the exit status is 1 when a threshold is exceeded.
+
+With no paths the bundled greeting/result clips are used, converted to the
+16 kHz mono WAV the robots send.
+"""
+import argparse
+import io
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+import wave
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+DEFAULT_CORPUS = ["voices_happy", "voices_angry", "happy_results", "angry_results"]
+SAMPLE_RATE = 16000
+
+
+# ----------------------------
+# Corpus
+# ----------------------------
+def find_wavs(paths):
+    wavs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                wavs.extend(os.path.join(root, f) for f in files if f.lower().endswith(".wav"))
+        elif path.lower().endswith(".wav"):
+            wavs.append(path)
+    return sorted(wavs)
+
+
+def read_pcm16k(path):
+    """Any 8/16-bit PCM WAV -> int16 mono samples at 16 kHz (linear resampling)"""
+    with wave.open(path, "rb") as wav:
+        channels, width, rate = wav.getnchannels(), wav.getsampwidth(), wav.getframerate()
+        frames = wav.readframes(wav.getnframes())
+    if width == 1:
+        samples = (np.frombuffer(frames, np.uint8).astype(np.float32) - 128) * 256
+    else:
+        samples = np.frombuffer(frames, "<i2").astype(np.float32)
+    samples = samples.reshape(-1, channels).mean(axis=1)
+    if rate != SAMPLE_RATE:
+        n_out = int(len(samples) * SAMPLE_RATE / rate)
+        samples = np.interp(np.linspace(0, len(samples) - 1, n_out), np.arange(len(samples)), samples)
+    return samples.astype(np.int16)
+
+
+def synthetic_clip(seconds, seed):
+    """A tone burst with silence around it, for when there is no corpus to hand"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    envelope = (t > 0.2) & (t < seconds - 0.2)
+    tone = 0.3 * np.sin(2 * np.pi * rng.uniform(150, 400) * t) * envelope
+    noise = rng.normal(0, 0.003, len(t))
+    return ((tone + noise) * 32767).astype(np.int16)
+
+
+def to_wav(samples):
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(samples.tobytes())
+    return buffer.getvalue()
+
+
+def load_corpus(paths, synthetic=0, synthetic_seconds=(1.0, 8.0)):
+    """[(name, int16 samples)] from WAV paths (or the bundled clips), plus synthetic clips"""
+    corpus = [(os.path.basename(path), read_pcm16k(path)) for path in find_wavs(paths or [])]
+    if not paths and not synthetic:
+        corpus = [(os.path.basename(path), read_pcm16k(path)) for path in find_wavs(DEFAULT_CORPUS)]
+    rng = random.Random(0)
+    for i in range(synthetic):
+        seconds = rng.uniform(*synthetic_seconds)
+        corpus.append((f"synthetic-{i}.wav", synthetic_clip(seconds, i)))
+    return corpus
+
+
+# ----------------------------
+# Clients
+# ----------------------------
+# Server counters whose deltas give the model time per speech second: each batch is
+# counted once, where summing per-request headers counts it once per clip on older servers
+MODEL_COUNTERS = ("transcriber_worker_busy_seconds_total", "transcriber_speech_seconds_total")
+
+
+def parse_counters(text):
+    """MODEL_COUNTERS values from a /metrics page (a counter never incremented isn't listed yet)"""
+    values = {}
+    for line in text.splitlines():
+        name, _, value = line.partition(" ")
+        if name in MODEL_COUNTERS:
+            values[name] = float(value)
+    return values
+
+
+def http_client(url):
+    """(send, read_counters) for a running server"""
+    import requests
+
+    session = requests.Session()
+
+    def send(wav, headers):
+        files = {"file": ("clip.wav", wav, "audio/wav")}
+        response = session.post(f"{url}/transcribe", files=files, headers=headers, timeout=300)
+        return response.status_code, response.headers
+
+    def read_counters():
+        try:
+            return parse_counters(session.get(f"{url}/metrics", timeout=10).text)
+        except requests.exceptions.RequestException:
+            return None
+
+    return send, read_counters
+
+
+class StubBackend:
+    """Stands in for Whisper: sleeps rtf x audio seconds per batch (plus a fixed overhead)"""
+    name = "stub"
+
+    def __init__(self, model_name, rtf=0.05, overhead=0.02):
+        self.model_name = model_name
+        self.rtf = rtf
+        self.overhead = overhead
+
+    def transcribe_batch(self, audios, **options):
+        time.sleep(self.overhead + self.rtf * sum(len(audio) for audio in audios) / SAMPLE_RATE)
+        return [{"text": "stub transcript", "language": "en", "avg_logprob": 0.0,
+                 "no_speech_prob": 0.0, "compression_ratio": 1.0} for _ in audios]
+
+    def set_threads(self, threads):
+        pass
+
+
+def in_process_client(stub_rtf, stub_overhead):
+    """(send, read_counters) for the server imported with the stub backend, driven through Flask's test client"""
+    import whisper_backends
+
+    whisper_backends.BACKENDS[StubBackend.name] = (
+        lambda model_name: StubBackend(model_name, stub_rtf, stub_overhead)
+    )
+    os.environ["WHISPER_BACKEND"] = StubBackend.name
+    os.environ["STARTUP_IN_BACKGROUND"] = "0"
+    # Every request is unique anyway, but keep the cache out of the measurement
+    os.environ.setdefault("TRANSCRIPT_CACHE_SIZE", "0")
+    import audio_transcriber
+
+    app = audio_transcriber.app
+
+    def send(wav, headers):
+        response = app.test_client().post(
+            "/transcribe", data={"file": (io.BytesIO(wav), "clip.wav")},
+            content_type="multipart/form-data", headers=headers,
+        )
+        return response.status_code, response.headers
+
+    def read_counters():
+        return parse_counters(app.test_client().get("/metrics").get_data(as_text=True))
+
+    return send, read_counters
+
+
+# ----------------------------
+# Load generation
+# ----------------------------
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else float("nan")
+
+
+def run_load(send, corpus, concurrency, n_requests, rate=0.0, duration=None, devices=1, seed=0):
+    """
+    Send n_requests clips (or keep going for `duration` seconds).
+    rate=0 is a closed loop of `concurrency` clients sending back to back;
+    rate>0 sends Poisson arrivals at that many requests/s, and latency is
+    counted from the scheduled arrival so a backed-up client isn't hidden.
+    """
+    rng = random.Random(seed)
+    results = []
+    results_lock = threading.Lock()
+    counter = iter(range(10 ** 9))
+
+    def one(arrival):
+        i = next(counter)
+        name, samples = corpus[i % len(corpus)]
+        samples = samples.copy()
+        # Nudge one sample so the server's transcript cache never short-circuits a request
+        samples[0] = i % 32768
+        headers = {"X-Device-Id": f"loadtest-{i % devices}", "Idempotency-Key": uuid.uuid4().hex}
+        try:
+            status, response_headers = send(to_wav(samples), headers)
+        except Exception as e:
+            status, response_headers = f"error: {type(e).__name__}", {}
+        latency = time.perf_counter() - arrival
+        with results_lock:
+            results.append({
+                "clip": name,
+                "status": status,
+                "latency": latency,
+                "audio_seconds": len(samples) / SAMPLE_RATE,
+                "queue_wait": float(response_headers.get("X-Queue-Wait-Seconds", "nan")),
+                "inference": float(response_headers.get("X-Inference-Seconds", "nan")),
+                "speech_seconds": float(response_headers.get("X-Speech-Seconds", "nan")),
+            })
+
+    started = time.perf_counter()
+    deadline = started + duration if duration else None
+
+    def more(sent):
+        if deadline is not None:
+            return time.perf_counter() < deadline
+        return sent < n_requests
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        sent = 0
+        if rate > 0:
+            next_arrival = started
+            while more(sent):
+                next_arrival += rng.expovariate(rate)
+                delay = next_arrival - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(one, next_arrival)
+                sent += 1
+        else:
+            def client():
+                nonlocal sent
+                while True:
+                    with results_lock:
+                        if not more(sent):
+                            return
+                        sent += 1
+                    one(time.perf_counter())
+
+            for _ in range(concurrency):
+                pool.submit(client)
+    return results, time.perf_counter() - started
+
+
+def report(results, elapsed, counters=None):
+    """counters: MODEL_COUNTERS deltas over the run, when the server exposes them"""
+    ok = [r for r in results if r["status"] == 200]
+    errors = {}
+    for r in results:
+        if r["status"] != 200:
+            errors[r["status"]] = errors.get(r["status"], 0) + 1
+    latencies = [r["latency"] for r in ok]
+    audio_seconds = sum(r["audio_seconds"] for r in ok)
+    error_rate = 1 - len(ok) / len(results) if results else 0.0
+
+    print(f"Requests:       {len(results)} in {elapsed:.1f} s ({len(ok)} ok)")
+    print(f"Throughput:     {len(ok) / elapsed:.2f} req/s, {audio_seconds / elapsed:.2f} audio s/s")
+    print(f"Error rate:     {error_rate:.1%}" + (f"  {errors}" if errors else ""))
+    if latencies:
+        print(f"Latency:        p50 {percentile(latencies, 50):.3f} s, p95 {percentile(latencies, 95):.3f} s, "
+              f"p99 {percentile(latencies, 99):.3f} s, max {max(latencies):.3f} s")
+        waits = [r["queue_wait"] for r in ok if not np.isnan(r["queue_wait"])]
+        if waits:
+            print(f"Queue wait:     p50 {percentile(waits, 50):.3f} s, p95 {percentile(waits, 95):.3f} s, "
+                  f"p99 {percentile(waits, 99):.3f} s")
+        # End to end: client-observed seconds per second of audio
+        print(f"RTF end-to-end: {sum(latencies) / audio_seconds:.3f}")
+        busy, speech = (counters or {}).get(MODEL_COUNTERS[0]), (counters or {}).get(MODEL_COUNTERS[1])
+        if busy is not None and speech:
+            print(f"RTF inference:  {busy / speech:.3f} (server model time per speech second, from /metrics)")
+        else:
+            # X-Inference-Seconds is each clip's share of its batch
+            speech = sum(r["speech_seconds"] for r in ok if not np.isnan(r["speech_seconds"]))
+            inference = sum(r["inference"] for r in ok if not np.isnan(r["inference"]))
+            if speech:
+                print(f"RTF inference:  {inference / speech:.3f} (server model time per speech second)")
+    return {
+        "error_rate": error_rate,
+        "p95": percentile(latencies, 95) if latencies else float("inf"),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--url", help="server to load, e.g. http://localhost:5000")
+    target.add_argument("--in-process", action="store_true", help="run audio_transcriber here with a stub model")
+    parser.add_argument("--concurrency", type=int, default=4, help="concurrent clients (max in flight with --rate)")
+    parser.add_argument("--requests", type=int, default=100, help="total requests (ignored with --duration)")
+    parser.add_argument("--duration", type=float, help="run for this many seconds instead")
+    parser.add_argument("--rate", type=float, default=0.0, help="Poisson arrivals per second (0 = closed loop)")
+    parser.add_argument("--devices", type=int, default=1, help="spread requests over this many device ids")
+    parser.add_argument("--synthetic", type=int, default=0, help="add this many generated clips to the corpus")
+    parser.add_argument("--stub-rtf", type=float, default=0.05, help="stub model seconds per audio second")
+    parser.add_argument("--stub-overhead", type=float, default=0.02, help="stub model seconds per batch")
+    parser.add_argument("--max-p95", type=float, help="exit 1 if p95 latency (s) is above this")
+    parser.add_argument("--max-error-rate", type=float, help="exit 1 if the error rate is above this (0-1)")
+    parser.add_argument("paths", nargs="*", help="WAV files or folders")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.paths, args.synthetic)
+    if not corpus:
+        parser.error("no WAV files found")
+    print(f"{len(corpus)} clip(s), {sum(len(s) for _, s in corpus) / SAMPLE_RATE:.1f} s of audio")
+
+    if args.in_process:
+        send, read_counters = in_process_client(args.stub_rtf, args.stub_overhead)
+    else:
+        send, read_counters = http_client(args.url)
+    mode = f"{args.rate:g} req/s arrivals" if args.rate else "closed loop"
+    print(f"Sending with concurrency {args.concurrency}, {mode}...\n")
+    before = read_counters()
+    results, elapsed = run_load(send, corpus, args.concurrency, args.requests, args.rate, args.duration, args.devices)
+    after = read_counters()
+    counters = None
+    if before is not None and after is not None:
+        counters = {name: after[name] - before.get(name, 0.0) for name in MODEL_COUNTERS if name in after}
+    summary = report(results, elapsed, counters)
+
+    failed = False
+    if args.max_p95 is not None and summary["p95"] > args.max_p95:
+        print(f"❌ p95 {summary['p95']:.3f} s is above {args.max_p95} s")
+        failed = True
+    if args.max_error_rate is not None and summary["error_rate"] > args.max_error_rate:
+        print(f"❌ Error rate {summary['error_rate']:.1%} is above {args.max_error_rate:.1%}")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Long recordings (meetings): split at silence, stitch, summarise.
+
+The server transcribes the chunks in parallel through its normal job queue
+(see /transcribe/long in audio_transcriber.py). This module only holds
+the pure parts:
+
+    ranges = split_at_silence(audio)          # [(start, end)] in samples
+    text = stitch([transcribe(audio[s:e]) for s, e in ranges])
+    sentences = summarize(text)
+"""
+import re
+import threading
+
+import numpy as np
+
+from audio_ingest import SAMPLE_RATE, VAD_FRAME_SECONDS, frame_levels_db
+
+# Chunks stay under Whisper's 30 s window, so each one is a single decode
+DEFAULT_CHUNK_SECONDS = 25.0
+# Audio shared by neighbouring chunks, so a word on the cut is heard whole by one of them
+DEFAULT_OVERLAP_SECONDS = 1.0
+# Look this far back from a chunk's maximum length for the quietest place to cut
+DEFAULT_SEARCH_SECONDS = 5.0
+
+
+def split_at_silence(audio, chunk_seconds=DEFAULT_CHUNK_SECONDS, overlap_seconds=DEFAULT_OVERLAP_SECONDS,
+                     search_seconds=DEFAULT_SEARCH_SECONDS):
+    """
+    [(start, end)] sample ranges covering audio, each at most chunk_seconds long.
+    Every cut goes at the quietest frame of the last search_seconds of its
+    chunk, and the next chunk starts overlap_seconds before the cut.
+    """
+    chunk = int(chunk_seconds * SAMPLE_RATE)
+    overlap = int(overlap_seconds * SAMPLE_RATE)
+    search = int(search_seconds * SAMPLE_RATE)
+    frame = int(VAD_FRAME_SECONDS * SAMPLE_RATE)
+    if len(audio) <= chunk:
+        return [(0, len(audio))]
+
+    levels = frame_levels_db(audio)
+    ranges = []
+    start = 0
+    while len(audio) - start > chunk:
+        end = start + chunk
+        # Never cut so early that the overlap would stop us moving forward
+        first_frame = -(-max(end - search, start + overlap + frame) // frame)
+        last_frame = end // frame
+        if first_frame < last_frame:
+            cut = (first_frame + int(np.argmin(levels[first_frame:last_frame]))) * frame
+        else:
+            cut = end
+        ranges.append((start, cut))
+        start = cut - overlap
+    ranges.append((start, len(audio)))
+    return ranges
+
+
+def _normalize(word):
+    return re.sub(r"[^\w']", "", word.lower())
+
+
+def _overlap_length(previous, words, max_words):
+    """How many leading words of words repeat the tail of previous"""
+    tail = [_normalize(w) for w in previous[-max_words:]]
+    head = [_normalize(w) for w in words[:max_words]]
+    for n in range(min(len(tail), len(head)), 0, -1):
+        if tail[-n:] == head[:n]:
+            return n
+    return 0
+
+
+def stitch(texts, max_overlap_words=20):
+    """
+    Join chunk transcripts in order, dropping the words the overlap made
+    both neighbours say. A chunk's first word may be cut in half by the
+    overlap, so the match is also tried without it.
+    """
+    words = []
+    for text in texts:
+        chunk_words = (text or "").split()
+        if words and chunk_words:
+            skip = _overlap_length(words, chunk_words, max_overlap_words)
+            if not skip and len(chunk_words) > 1:
+                partial = _overlap_length(words, chunk_words[1:], max_overlap_words)
+                if partial:
+                    skip = partial + 1
+            chunk_words = chunk_words[skip:]
+        words.extend(chunk_words)
+    return " ".join(words)
+
+
+_nltk_download_lock = threading.Lock()
+
+
+def _tokenizer(language):
+    """
+    sumy's sentence tokenizer. Its NLTK data is baked into the Docker image;
+    builds without that step (railpack) download it on first use.
+    """
+    from sumy.nlp.tokenizers import Tokenizer
+
+    try:
+        return Tokenizer(language)
+    except LookupError:
+        import nltk
+
+        with _nltk_download_lock:
+            print("📥 Downloading the NLTK sentence tokenizer (punkt_tab)...")
+            nltk.download("punkt_tab", quiet=True)
+        return Tokenizer(language)
+
+
+def summarize(text, sentences=5, language="english"):
+    """LexRank summary of a transcript as a list of sentences (sumy is imported only when needed)"""
+    from sumy.nlp.stemmers import Stemmer
+    from sumy.parsers.plaintext import PlaintextParser
+    from sumy.summarizers.lex_rank import LexRankSummarizer
+    from sumy.utils import get_stop_words
+
+    parser = PlaintextParser.from_string(text, _tokenizer(language))
+    summarizer = LexRankSummarizer(Stemmer(language))
+    summarizer.stop_words = get_stop_words(language)
+    return [str(sentence) for sentence in summarizer(parser.document, sentences)]
@@ -0,0 +1,251 @@
+import ctypes
+import gc
+import os
+import pickle
+import signal
+import socket
+import sys
+import threading
+import time
+from multiprocessing.connection import Connection
+
+# Replies between the pool and its zygote are small pickles
+MAX_MESSAGE = 1 << 16
+
+
+def default_threads_per_replica(replicas):
+    """Split the cores evenly so replicas don't fight over them"""
+    return max(1, (os.cpu_count() or 1) // max(1, replicas))
+
+
+def _replica_main(index, backend, threads, conn):
+    """Child process: run batches from the parent until it sends None or the pipe closes"""
+    setup_error = None
+    try:
+        backend.set_threads(threads)
+    except Exception as e:
+        # Exiting would only get this replica restarted into the same error;
+        # stay up and fail every batch with it instead
+        setup_error = f"Replica {index} failed to start: {e}"
+        print(f"❌ {setup_error}")
+    else:
+        print(f"🧠 Replica {index} ready (pid {os.getpid()}, {threads} threads)")
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        if setup_error:
+            conn.send(("error", setup_error))
+            continue
+        audios, kwargs = message
+        try:
+            conn.send(("ok", backend.transcribe_batch(audios, **kwargs)))
+        except Exception as e:
+            conn.send(("error", str(e)))
+
+
+def _send(sock, message, fds=()):
+    socket.send_fds(sock, [pickle.dumps(message)], list(fds))
+
+
+def _recv(sock):
+    data, fds, _, _ = socket.recv_fds(sock, MAX_MESSAGE, 1)
+    if not data:
+        raise EOFError
+    return pickle.loads(data), fds
+
+
+def _fork():
+    # Anything still buffered would be written again by the child
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return os.fork()
+
+
+def _wait(pid, timeout):
+    """Reap a replica that was asked to exit, killing it if it doesn't"""
+    deadline = time.monotonic() + timeout
+    try:
+        while not os.waitpid(pid, os.WNOHANG)[0]:
+            if time.monotonic() > deadline:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+                return
+            time.sleep(0.05)
+    except ChildProcessError:
+        pass
+
+
+def _zygote_main(load_backend, threads, control):
+    """
+    The process replicas are forked from. It is forked itself before the
+    server starts any thread and never starts one of its own, so a replica
+    can't inherit a lock (stdout's, a queue's) that another thread was holding.
+    """
+    # Ctrl-C is for the server; replicas exit once their pipe closes
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    backend = None
+    while True:
+        try:
+            (command, arg), _ = _recv(control)
+        except EOFError:
+            break
+        try:
+            if command == "load":
+                started = time.perf_counter()
+                backend = load_backend()
+                _send(control, ("ok", (time.perf_counter() - started, getattr(backend, "name", None))))
+            elif command == "fork":
+                index, previous_pid = arg
+                if previous_pid is not None:
+                    # The replica this one replaces died; reap it
+                    _wait(previous_pid, 1)
+                parent_end, child_end = socket.socketpair()
+                pid = _fork()
+                if pid == 0:
+                    control.close()
+                    parent_end.close()
+                    try:
+                        _replica_main(index, backend, threads, Connection(child_end.detach()))
+                    finally:
+                        sys.stdout.flush()
+                        os._exit(0)
+                child_end.close()
+                _send(control, ("ok", pid), [parent_end.fileno()])
+                parent_end.close()
+            elif command == "join":
+                _wait(arg, 5)
+                _send(control, ("ok", None))
+            elif command == "unload":
+                backend = None
+                gc.collect()
+                try:
+                    ctypes.CDLL("libc.so.6").malloc_trim(0)
+                except (OSError, AttributeError):
+                    pass
+                _send(control, ("ok", None))
+        except Exception as e:
+            _send(control, ("error", str(e)))
+
+
+class Replica:
+    """One forked worker process holding a copy-on-write view of the model"""
+
+    def __init__(self, index, pool):
+        self.index = index
+        self.pool = pool
+        self.busy = False
+        self.pid = None
+        self.conn = None
+
+    def _start(self):
+        self.pid, self.conn = self.pool._fork_replica(self.index, self.pid)
+
+    def transcribe_batch(self, audios, **kwargs):
+        self.busy = True
+        try:
+            self.conn.send((audios, kwargs))
+            status, payload = self.conn.recv()
+        except (EOFError, OSError, BrokenPipeError):
+            # The replica died mid-batch (most likely OOM-killed); fork a fresh one
+            print(f"⚠️ Replica {self.index} died, restarting")
+            self.conn.close()
+            self._start()
+            raise RuntimeError(f"Replica {self.index} crashed during inference")
+        finally:
+            self.busy = False
+
+        if status == "error":
+            raise RuntimeError(payload)
+        return payload
+
+    def stop(self):
+        if self.conn is None:
+            return
+        try:
+            self.conn.send(None)
+        except (OSError, BrokenPipeError):
+            pass
+        self.conn.close()
+        self.conn = None
+        self.pool._request("join", self.pid)
+        self.pid = None
+
+
+class ReplicaPool:
+    """
+    N backend replicas in forked worker processes.
+
+    Constructing the pool forks a zygote: a single-threaded process that
+    loads the model once (load()) and forks the replicas from it (start()),
+    so on Linux the weights stay shared copy-on-write instead of being loaded
+    N times, and the server process never holds a copy. Create the pool
+    before any thread starts; the fork of a multi-threaded process is unsafe.
+    Each replica gets its own thread budget. Routing is pull-based: the
+    server runs one dispatcher thread per replica, and a dispatcher only
+    takes the next batch off the queue once its replica is idle.
+    """
+
+    def __init__(self, load_backend, replicas, threads_per_replica=None):
+        threads = threads_per_replica or default_threads_per_replica(replicas)
+        self.replicas = [Replica(i, self) for i in range(replicas)]
+        self.backend_name = None
+        self._lock = threading.Lock()
+        self._control, zygote_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.zygote_pid = _fork()
+        if self.zygote_pid == 0:
+            self._control.close()
+            try:
+                _zygote_main(load_backend, threads, zygote_end)
+            finally:
+                os._exit(0)
+        zygote_end.close()
+
+    def __len__(self):
+        return len(self.replicas)
+
+    def _request(self, command, arg=None):
+        with self._lock:
+            _send(self._control, (command, arg))
+            (status, payload), fds = _recv(self._control)
+        if status == "error":
+            raise RuntimeError(payload)
+        return payload, fds
+
+    def _fork_replica(self, index, previous_pid):
+        pid, fds = self._request("fork", (index, previous_pid))
+        return pid, Connection(fds[0])
+
+    def busy_count(self):
+        return sum(1 for replica in self.replicas if replica.busy)
+
+    def load(self):
+        """Load the backend in the zygote; returns the seconds it took"""
+        (seconds, self.backend_name), _ = self._request("load")
+        return seconds
+
+    def start(self):
+        """Fork every replica from the loaded backend"""
+        for replica in self.replicas:
+            replica._start()
+
+    def unload(self):
+        """Stop every replica and drop the zygote's backend, so its memory can be given back"""
+        for replica in self.replicas:
+            replica.stop()
+        self._request("unload")
+
+    def reload(self):
+        """Load the backend again and fork fresh replicas (after unload())"""
+        self.load()
+        self.start()
+
+    def stop(self):
+        for replica in self.replicas:
+            replica.stop()
+        # The zygote exits once its control socket closes
+        self._control.close()
+        os.waitpid(self.zygote_pid, 0)
@@ -1,15 +1,178 @@
+import base64
 import requests
 import os
-from typecast_api import text_to_speech_api
+import random
+import socket
+import subprocess
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from urllib3.util.connection import is_connection_dropped
+from audio_ingest import UPLOAD_FORMATS, encode_audio_file
+from typecast_api import save_audio, synthesize_speech, text_to_speech_api
 from ai_talk import getSekaiResponse
 from get_intent import getSekaiIntent
 import json
 
 current_mood = "happy"
 
-def transcribe_wav_file(file_path, server_url="https://sekaiserver-production.up.railway.app"):
+# Identifies this robot to the server, which shares its workers fairly between devices
+DEVICE_ID = os.environ.get("SEKAI_DEVICE_ID") or socket.gethostname()
+
+# Upload format: "flac" (lossless, about half the bytes of the WAV), "opus" (lossy, smallest) or "wav"
+UPLOAD_FORMAT = os.environ.get("SEKAI_UPLOAD_FORMAT", "flac")
+
+# TypeCast key for speaking replies here when the server couldn't (see converse_wav_file)
+TYPECAST_API_KEY = os.environ.get("TYPECAST_API_KEY", "__pltMzLwjRtejoHYcjCEi984cBgKa6qMU6EiSkEs2Xne ")
+
+# Decoding profile asked of the server: "interactive" (fast, greedy, for commands) or "archive"
+DECODING_PROFILE = os.environ.get("SEKAI_DECODING_PROFILE", "interactive")
+
+# One long-lived session for every call to the server: its keep-alive pool lets a
+# command reuse the connection warm_connection() opened during the greeting
+# instead of paying DNS, TCP and TLS setup again
+session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=2, pool_maxsize=4)
+session.mount("https://", _adapter)
+session.mount("http://", _adapter)
+
+# Timeouts per stage instead of a flat 300 s: connecting, then how long the
+# server may go quiet while it answers (its queue and model time included)
+CONNECT_TIMEOUT = float(os.environ.get("SEKAI_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUTS = {"warm": 5, "stream": 15, "transcribe": 60, "converse": 90}
+# Everything one command may take, retries and backoff included
+COMMAND_BUDGET = float(os.environ.get("SEKAI_COMMAND_BUDGET", "120"))
+# Retries after the first attempt, on dropped connections, timeouts and these statuses
+RETRIES = 3
+RETRY_STATUSES = (429, 502, 503, 504)
+# First backoff in seconds, doubled per retry; the actual sleep is a random fraction of it
+RETRY_BACKOFF = 0.5
+
+# server_url -> estimated DNS + TCP + TLS setup, measured by warm_connection()
+handshake_seconds = {}
+# Commands sent, how many found a live pooled connection, and the setup time that saved
+connection_stats = {"commands": 0, "reused": 0, "saved_seconds": 0.0}
+
+# server_url -> formats it decodes, from the X-Accept-Audio header on its last response
+# (servers without the header only take WAV)
+server_formats = {}
+
+def _has_live_connection(url):
+    """Whether the session's pools hold an open connection to url's host"""
+    parts = urlsplit(url)
+    pools = _adapter.poolmanager.pools
+    try:
+        for key in pools.keys():
+            if key.key_scheme != parts.scheme or key.key_host != parts.hostname:
+                continue
+            pool = pools[key]
+            if any(conn is not None and conn.sock is not None and not is_connection_dropped(conn)
+                   for conn in list(pool.pool.queue)):
+                return True
+    except (AttributeError, KeyError):
+        pass
+    return False
+
+def _timeout(stage, deadline):
+    remaining = max(0.1, deadline - time.monotonic())
+    return min(CONNECT_TIMEOUT, remaining), min(READ_TIMEOUTS[stage], remaining)
+
+def _post(url, stage, budget=COMMAND_BUDGET, **kwargs):
+    """
+    session.post() with the stage's timeouts, retried with jittered exponential
+    backoff (or the server's Retry-After) while the budget lasts. Returns the
+    last response, or raises the last connection error.
+    """
+    deadline = time.monotonic() + budget
+    for attempt in range(RETRIES + 1):
+        delay = None
+        try:
+            response = session.post(url, timeout=_timeout(stage, deadline), **kwargs)
+            if response.status_code not in RETRY_STATUSES:
+                return response
+            error = None
+            if response.headers.get('Retry-After', '').isdigit():
+                delay = int(response.headers['Retry-After'])
+            reason = f"server answered {response.status_code}"
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            response, error = None, e
+            reason = "connection lost"
+        if delay is None:
+            delay = random.uniform(0, RETRY_BACKOFF * 2 ** attempt)
+        if attempt == RETRIES or time.monotonic() + delay >= deadline:
+            break
+        print(f"{reason.capitalize()}, retrying in {delay:.1f} s...")
+        time.sleep(delay)
+    if response is None:
+        raise error
+    return response
+
+def _report_connection(server_url, reused):
+    """Count the command and print what the pooled connection saved it"""
+    connection_stats["commands"] += 1
+    handshake = handshake_seconds.get(server_url)
+    if not reused:
+        print("🔌 Opened a new connection for this command")
+        return
+    connection_stats["reused"] += 1
+    if handshake is not None:
+        connection_stats["saved_seconds"] += handshake
+        print(f"🔌 Reused the warm connection: saved ~{handshake * 1000:.0f} ms of DNS/TCP/TLS setup "
+              f"({connection_stats['reused']}/{connection_stats['commands']} commands, "
+              f"{connection_stats['saved_seconds']:.2f} s saved so far)")
+
+def warm_connection(server_url="https://sekaiserver-production.up.railway.app"):
+    """
+    Open a pooled connection to the server ahead of the command upload (or
+    keep the open one alive). A fresh connection is timed against a second
+    request on it, which estimates the setup cost later commands skip.
+    Returns False if the server can't be reached.
+    """
+    url = f"{server_url}/test"
+    timeout = (CONNECT_TIMEOUT, READ_TIMEOUTS["warm"])
+    try:
+        if _has_live_connection(url):
+            session.get(url, timeout=timeout)
+            return True
+        start = time.perf_counter()
+        session.get(url, timeout=timeout)
+        cold = time.perf_counter() - start
+        start = time.perf_counter()
+        session.get(url, timeout=timeout)
+        warm = time.perf_counter() - start
+    except requests.exceptions.RequestException as e:
+        print(f"Could not pre-warm the connection: {e}")
+        return False
+    handshake_seconds[server_url] = max(0.0, cold - warm)
+    print(f"🔌 Connected to {server_url} ahead of the command "
+          f"({handshake_seconds[server_url] * 1000:.0f} ms of setup done early)")
+    return True
+
+def prewarm_connection(server_url="https://sekaiserver-production.up.railway.app"):
+    """warm_connection() on a background thread, e.g. right when the wake word fires"""
+    threading.Thread(target=warm_connection, args=(server_url,), daemon=True).start()
+
+def _encode_upload(file_path, audio_format):
+    """(filename, bytes, MIME type) for the upload, falling back to the WAV itself"""
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    if audio_format != "wav":
+        try:
+            extensions, mime = UPLOAD_FORMATS[audio_format]
+            return name + extensions[0], encode_audio_file(file_path, audio_format), mime
+        except Exception as e:
+            print(f"Could not encode {audio_format} ({e}), sending WAV")
+    with open(file_path, 'rb') as f:
+        return name + '.wav', f.read(), 'audio/wav'
+
+def _upload_wav(file_path, url, server_url, idempotency_key=None, data=None, audio_format=None, stage="transcribe"):
     """
-    Simple function to transcribe a WAV file using the local server
+    POST a WAV file as multipart 'file', compressed to audio_format (default
+    UPLOAD_FORMAT) if the server takes it. Retries (see _post) keep the same
+    Idempotency-Key, and it is sent again as WAV if an older server refuses
+    the compressed upload.
+    Returns the response, or None if the file isn't a WAV that exists.
     """
     if not os.path.exists(file_path):
         print(f"Error: File not found: {file_path}")
@@ -19,25 +182,183 @@ def transcribe_wav_file(file_path, server_url="https://sekaiserver-production.up
         print(f"Error: Only WAV files are accepted: {file_path}")
         return None
     
+    audio_format = audio_format or UPLOAD_FORMAT
+    if audio_format not in server_formats.get(server_url, (audio_format,)):
+        audio_format = "wav"
+    upload = _encode_upload(file_path, audio_format)
+    
+    idempotency_key = idempotency_key or uuid.uuid4().hex
+    headers = {'Idempotency-Key': idempotency_key, 'X-Device-Id': DEVICE_ID}
+    reused = _has_live_connection(url)
+    response = _post(url, stage, params={'profile': DECODING_PROFILE}, files={'file': upload}, data=data,
+                     headers=headers)
+    _report_connection(server_url, reused)
+    
+    accepted = response.headers.get('X-Accept-Audio')
+    server_formats[server_url] = set(accepted.split(', ')) if accepted else {"wav"}
+    if response.status_code in (400, 415) and not upload[0].endswith('.wav') and not accepted:
+        print("Server only takes WAV, sending that instead...")
+        return _upload_wav(file_path, url, server_url, idempotency_key, data, "wav", stage)
+    return response
+
+
+def transcribe_wav_file(file_path, server_url="https://sekaiserver-production.up.railway.app", idempotency_key=None,
+                        audio_format=None):
+    """
+    Simple function to transcribe a WAV file using the local server.
+    Every upload carries an Idempotency-Key, so if the connection drops the
+    retry joins the transcription the server already started instead of
+    running it twice.
+    audio_format picks the upload encoding ("flac", "opus" or "wav", default
+    UPLOAD_FORMAT); servers that don't advertise it get the WAV.
+    """
     try:
-        with open(file_path, 'rb') as f:
-            files = {'file': (os.path.basename(file_path), f, 'audio/wav')}
-            response = requests.post(f"{server_url}/transcribe", files=files, timeout=300)
+        response = _upload_wav(file_path, f"{server_url}/transcribe", server_url, idempotency_key,
+                               audio_format=audio_format)
+        if response is None:
+            return None
             
-            if response.status_code == 200:
-                return response.text.strip()
-            else:
+        if response.status_code == 200:
+            return response.text.strip()
+        else:
+            print(f"Server error: {response.status_code} - {response.text}")
+            return None
+    except requests.exceptions.ConnectionError:
+        print("Error: Could not connect to transcription server.")
+        print("Make sure the server is running: python transcribe_server.py")
+        return None
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return None
+
+
+def converse_wav_file(file_path, mood="happy", server_url="https://sekaiserver-production.up.railway.app",
+                      idempotency_key=None, reply_file="response_audio.wav", audio_format=None):
+    """
+    Transcribe a recorded command and get Sekai's answer in one round trip.
+    The server works out the intent and the reply side by side and speaks the reply.
+    Returns a dict with transcript, command (e.g. {"command": "open_calendar"}),
+    reply and audio_file (reply_file, or None if there is no spoken reply),
+    or None on error.
+    A server that can't reply or speak (no ai_talk or TypeCast key there)
+    still sends the transcript; the reply is then made and spoken here.
+    """
+    try:
+        response = _upload_wav(file_path, f"{server_url}/converse", server_url, idempotency_key,
+                               data={'mood': mood}, audio_format=audio_format, stage="converse")
+        if response is None:
+            return None
+        if response.status_code != 200:
+            print(f"Server error: {response.status_code} - {response.text}")
+            return None
+
+        data = response.json()
+        for stage, error in data.get("errors", {}).items():
+            print(f"⚠️ Server {stage} step failed: {error}")
+        reply, audio_file = data["reply"], None
+        if data.get("audio"):
+            audio_file = save_audio(base64.b64decode(data["audio"]), reply_file)
+        elif data["transcript"]:
+            reply, audio_file = _local_reply(data["transcript"], mood, reply, reply_file)
+        return {
+            "transcript": data["transcript"],
+            "command": data["command"],
+            "reply": reply,
+            "audio_file": audio_file,
+        }
+    except requests.exceptions.ConnectionError:
+        print("Error: Could not connect to transcription server.")
+        return None
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return None
+
+
+def _local_reply(transcript, mood, reply, reply_file):
+    """(reply, audio_file) made on the robot, reusing the server's reply text if it sent one"""
+    try:
+        if not reply:
+            print("Making the reply here instead...")
+            reply = getSekaiResponse(transcript, mood)
+        audio_content = synthesize_speech(reply, TYPECAST_API_KEY)
+    except Exception as e:
+        print(f"Local reply failed: {e}")
+        return reply, None
+    if audio_content is None:
+        return reply, None
+    return reply, save_audio(audio_content, reply_file)
+
+
+def transcribe_stream(chunks, server_url="https://sekaiserver-production.up.railway.app", on_partial=None):
+    """
+    Stream raw 16 kHz mono S16_LE PCM chunks to the server while they are recorded.
+    on_partial(partial, stable) is called after every chunk.
+    Returns the final transcript, or None on error.
+    """
+    try:
+        response = _post(f"{server_url}/stream", "stream", params={'profile': DECODING_PROFILE},
+                         headers={'X-Device-Id': DEVICE_ID})
+        if response.status_code != 201:
+            print(f"Server error: {response.status_code} - {response.text}")
+            return None
+        stream_id = response.json()["stream_id"]
+
+        # Chunks append to the stream, so they are sent once and never retried
+        headers = {'Content-Type': 'application/octet-stream'}
+        timeout = (CONNECT_TIMEOUT, READ_TIMEOUTS["stream"])
+        for chunk in chunks:
+            if not chunk:
+                continue
+            response = session.post(f"{server_url}/stream/{stream_id}/chunk",
+                                    data=chunk, headers=headers, timeout=timeout)
+            if response.status_code != 200:
                 print(f"Server error: {response.status_code} - {response.text}")
                 return None
+            if on_partial:
+                data = response.json()
+                on_partial(data["partial"], data["stable"])
+
+        response = _post(f"{server_url}/stream/{stream_id}/end", "transcribe")
+        if response.status_code == 200:
+            return response.json()["final"].strip()
+        else:
+            print(f"Server error: {response.status_code} - {response.text}")
+            return None
     except requests.exceptions.ConnectionError:
         print("Error: Could not connect to transcription server.")
-        print("Make sure the server is running: python transcribe_server.py")
         return None
     except Exception as e:
         print(f"Error: {str(e)}")
         return None
 
 
+def record_chunks(duration=5, chunk_seconds=0.5):
+    """
+    Record from the mic with arecord and yield raw PCM chunks as they arrive.
+    Same format start_recording() uses, minus the WAV header.
+    """
+    chunk_bytes = int(16000 * 2 * chunk_seconds)
+    process = subprocess.Popen(
+        ["arecord", "-q", "-d", str(duration), "-f", "S16_LE", "-t", "raw", "-r", "16000", "-c", "1"],
+        stdout=subprocess.PIPE,
+    )
+    try:
+        while True:
+            chunk = process.stdout.read(chunk_bytes)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        process.stdout.close()
+        process.wait()
+
+
+def record_and_transcribe_stream(duration=5, server_url="https://sekaiserver-production.up.railway.app", on_partial=None):
+    """Record a command and transcribe it while recording is still going"""
+    return transcribe_stream(record_chunks(duration), server_url, on_partial)
+
+
+
 # Quick usage example
 if __name__ == "__main__":
     # Test the function
@@ -0,0 +1,452 @@
+"""
+SQLite-backed job queue that several server and worker processes share.
+
+Drop-in for job_queue.LaneQueue (QUEUE_BACKEND=sqlite): the same lanes,
+depth limits, wait limits and bulk promotion, but jobs and their results
+live in one SQLite file, so any process pointed at it can pull work. A
+restart no longer loses queued jobs, and /jobs/<id> can be answered by
+any instance. The processes must share one host: the file is in WAL mode,
+which needs shared memory and so does not work over a network filesystem.
+
+A worker claims a job for visibility_timeout seconds and keeps extending
+the claim while it runs. If the worker dies the claim runs out and the job
+goes back to the queue, up to max_attempts times.
+
+The process that queued a job keeps the TranscriptionJob its client waits
+on. If another process runs it, a poller thread here reads the result back
+and hands it to on_result(job, record). Jobs run in the process that
+queued them are returned as that same object, so nothing is copied. Jobs
+rebuilt from another process's row can be watch()ed, so their waiters are
+released the same way (through on_watched).
+
+Fairness between devices is coarser than LaneQueue's virtual clock: within
+a lane the next job comes from the device with the fewest running jobs
+(divided by its weight), oldest job first.
+"""
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+
+import numpy as np
+
+from job_queue import QueueFull
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    lane TEXT NOT NULL,
+    device TEXT NOT NULL,
+    audio BLOB,
+    audio_seconds REAL NOT NULL,
+    options TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    enqueued_at REAL NOT NULL,
+    claimed_by TEXT,
+    claimed_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    transcript TEXT,
+    error TEXT,
+    tier TEXT,
+    speech_seconds REAL,
+    inference_seconds REAL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_queued ON jobs (status, lane, enqueued_at);
+"""
+
+
+class SqliteJobQueue:
+    """
+    put(job), get(timeout=None, lane=None), task_done(job) and complete(job),
+    like LaneQueue, over a SQLite file. make_job(record) must turn a row
+    into a job object for jobs queued by other processes.
+    """
+
+    # How often idle workers look for new rows and the poller looks for results
+    POLL_SECONDS = 0.05
+
+    def __init__(self, path, lanes, on_expire=None, device_weights=None,
+                 max_queued_per_device=None, max_in_flight_per_device=None,
+                 visibility_timeout=60.0, max_attempts=3, result_ttl=600.0):
+        self.path = path
+        self.lanes = lanes
+        self.on_expire = on_expire
+        self.on_result = None
+        self.on_watched = None
+        self.make_job = None
+        self.device_weights = device_weights or {}
+        self.max_queued_per_device = max_queued_per_device
+        self.max_in_flight_per_device = max_in_flight_per_device
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.result_ttl = result_ttl
+        # Claims made by this process carry its id, so heartbeats only touch our own
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        # Jobs queued here and not finished yet, and jobs claimed here and still running
+        self.local = {}
+        self.claimed = {}
+        # Jobs rebuilt from rows queued elsewhere, waiting for their result
+        self.watched = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._control = deque()
+        self._connections = threading.local()
+        self._last_cleanup = 0.0
+        # Set while this process's wait clock is paused
+        self._paused_at = None
+
+        self._db().executescript(SCHEMA)
+        threading.Thread(target=self._poll_results, daemon=True).start()
+        threading.Thread(target=self._heartbeat, daemon=True).start()
+
+    def _db(self):
+        """This thread's connection (sqlite3 connections can't be shared between threads)"""
+        db = getattr(self._connections, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._connections.db = db
+        return db
+
+    def lane_for(self, job):
+        for lane in self.lanes[:-1]:
+            if job.audio_seconds <= lane.max_audio_seconds:
+                return lane
+        return self.lanes[-1]
+
+    # ----------------------------
+    # Producer side
+    # ----------------------------
+    def put(self, job):
+        if job is None:
+            with self._lock:
+                self._control.append(None)
+                self._wakeup.notify_all()
+            return
+
+        lane = self.lane_for(job)
+        # Registered before the row is committed: another process may claim and
+        # finish it right away, and the poller must find the job here by then
+        with self._lock:
+            self.local[job.id] = job
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            depth = db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND lane = ?",
+                               (lane.name,)).fetchone()[0]
+            if depth >= lane.max_depth:
+                lane.rejected += 1
+                raise QueueFull(lane)
+            if self.max_queued_per_device:
+                queued = db.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND lane = ? AND device = ?",
+                    (lane.name, job.device),
+                ).fetchone()[0]
+                if queued >= self.max_queued_per_device:
+                    lane.rejected += 1
+                    raise QueueFull(lane, job.device)
+            db.execute(
+                "INSERT INTO jobs (id, lane, device, audio, audio_seconds, options, status, created_at, enqueued_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, 'queued', ?, ?)",
+                (job.id, lane.name, job.device, np.asarray(job.audio, np.float32).tobytes(),
+                 job.audio_seconds, json.dumps(job.options), job.created_at, time.time()),
+            )
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            with self._lock:
+                self.local.pop(job.id, None)
+            raise
+        lane.admitted += 1
+        with self._lock:
+            self._wakeup.notify_all()
+
+    def complete(self, job):
+        """Store a finished job's result, for whichever process queued it"""
+        self._db().execute(
+            "UPDATE jobs SET status = ?, transcript = ?, error = ?, tier = ?, speech_seconds = ?,"
+            " inference_seconds = ?, started_at = ?, finished_at = ?, audio = NULL, claimed_by = NULL"
+            " WHERE id = ? AND status NOT IN ('done', 'failed', 'expired')",
+            (job.status, job.transcript, job.error, job.tier, job.speech_seconds,
+             job.inference_seconds, job.started_at, job.finished_at or time.time(), job.id),
+        )
+        with self._lock:
+            self.local.pop(job.id, None)
+
+    def watch(self, job):
+        """
+        Hand a job rebuilt from a queued or running row to on_watched once its
+        result is stored. Returns the job already watched under that id, if any.
+        """
+        with self._lock:
+            return self.watched.setdefault(job.id, job)
+
+    def find(self, job_id):
+        """The stored row for a job as a dict (audio left out), or None"""
+        row = self._db().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        record = self._record(row)
+        record["audio"] = None
+        return record
+
+    @staticmethod
+    def _record(row):
+        record = dict(row)
+        record["options"] = json.loads(record["options"])
+        if record["audio"] is not None:
+            record["audio"] = np.frombuffer(record["audio"], np.float32)
+        return record
+
+    def _poll_results(self):
+        """Finish local jobs that another process ran (or that the queue failed)"""
+        while True:
+            time.sleep(self.POLL_SECONDS)
+            with self._lock:
+                waiting = [job_id for job_id in self.local if job_id not in self.claimed]
+                waiting += [job_id for job_id in self.watched if job_id not in self.local]
+            if not waiting or self.on_result is None:
+                continue
+            rows = []
+            for start in range(0, len(waiting), 500):
+                ids = waiting[start:start + 500]
+                rows += self._db().execute(
+                    f"SELECT * FROM jobs WHERE status IN ('done', 'failed', 'expired')"
+                    f" AND id IN ({','.join('?' * len(ids))})", ids,
+                ).fetchall()
+            for row in rows:
+                with self._lock:
+                    job = self.local.pop(row["id"], None)
+                    watched = self.watched.pop(row["id"], None)
+                if job is not None and not job.is_done():
+                    self.on_result(job, self._record(row))
+                if watched is not None and self.on_watched is not None:
+                    self.on_watched(watched, self._record(row))
+
+    # ----------------------------
+    # Worker side
+    # ----------------------------
+    def _requeue_abandoned(self, db, now):
+        """Claims whose worker stopped heartbeating go back to the queue, or fail after max_attempts"""
+        db.execute(
+            "UPDATE jobs SET status = 'failed', error = ?, audio = NULL, claimed_by = NULL, finished_at = ?"
+            " WHERE status = 'running' AND claimed_until < ? AND attempts >= ?",
+            (f"Worker stopped responding {self.max_attempts} times", now, now, self.max_attempts),
+        )
+        db.execute(
+            "UPDATE jobs SET status = 'queued', claimed_by = NULL"
+            " WHERE status = 'running' AND claimed_until < ?", (now,),
+        )
+
+    def _claim(self, only=None):
+        """Claim the next job in one transaction, or return None"""
+        db = self._db()
+        now = time.time()
+        # Cheap read first, so idle workers don't keep taking the write lock
+        if db.execute(
+            "SELECT 1 FROM jobs WHERE status = 'queued' OR (status = 'running' AND claimed_until < ?) LIMIT 1",
+            (now,),
+        ).fetchone() is None:
+            return None
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            self._requeue_abandoned(db, now)
+            running = dict(db.execute(
+                "SELECT device, COUNT(*) FROM jobs WHERE status = 'running' GROUP BY device"
+            ).fetchall())
+            if only is not None:
+                lanes = [only]
+            else:
+                # Promoted lanes first, otherwise in priority order (sorted() is stable)
+                oldest = dict(db.execute(
+                    "SELECT lane, MIN(enqueued_at) FROM jobs WHERE status = 'queued' GROUP BY lane"
+                ).fetchall())
+                lanes = sorted(self.lanes, key=lambda lane: not (
+                    lane.promote_after is not None and lane.name in oldest
+                    and now - oldest[lane.name] > lane.promote_after
+                ))
+            row = None
+            for lane in lanes:
+                # The oldest job of every device waiting in this lane (SQLite fills id from the MIN row)
+                max_wait = float("inf") if self._paused_at is not None else lane.max_wait
+                candidates = [
+                    (device, enqueued_at, job_id) for device, enqueued_at, job_id in db.execute(
+                        "SELECT device, MIN(enqueued_at), id FROM jobs"
+                        " WHERE status = 'queued' AND lane = ? AND enqueued_at >= ? GROUP BY device",
+                        (lane.name, now - max_wait),
+                    ).fetchall()
+                    if not self.max_in_flight_per_device
+                    or running.get(device, 0) < self.max_in_flight_per_device
+                ]
+                if candidates:
+                    device, _, job_id = min(candidates, key=lambda c: (
+                        running.get(c[0], 0) / self.device_weights.get(c[0], 1.0), c[1]
+                    ))
+                    db.execute(
+                        "UPDATE jobs SET status = 'running', claimed_by = ?, claimed_until = ?,"
+                        " attempts = attempts + 1 WHERE id = ?",
+                        (self.worker_id, now + self.visibility_timeout, job_id),
+                    )
+                    row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+                    break
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+
+        with self._lock:
+            job = self.local.get(row["id"])
+        if job is None:
+            # Queued by another process (or by this one before a restart)
+            job = self.make_job(self._record(row))
+        with self._lock:
+            self.claimed[job.id] = job
+        return job
+
+    def get(self, timeout=None, lane=None):
+        """Next job by priority and fairness, or only from `lane` when given; raises queue.Empty on timeout"""
+        # Overdue jobs are skipped here and failed by expire(), which the server's reaper calls every second
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                if self._control:
+                    return self._control.popleft()
+            job = self._claim(lane)
+            if job is not None:
+                return job
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise queue.Empty
+            # Local puts wake us at once; rows from other processes are found by polling
+            with self._lock:
+                wait = self.POLL_SECONDS if remaining is None else min(self.POLL_SECONDS, remaining)
+                self._wakeup.wait(wait)
+
+    def task_done(self, job=None):
+        """A job from get() is no longer running here; stop extending its claim"""
+        if job is None:
+            return
+        with self._lock:
+            self.claimed.pop(job.id, None)
+            self._wakeup.notify_all()
+
+    def _heartbeat(self):
+        """Keep extending our claims so slow jobs aren't handed to another worker"""
+        while True:
+            time.sleep(self.visibility_timeout / 3)
+            with self._lock:
+                ids = list(self.claimed)
+            if ids:
+                self._db().execute(
+                    f"UPDATE jobs SET claimed_until = ? WHERE status = 'running' AND claimed_by = ?"
+                    f" AND id IN ({','.join('?' * len(ids))})",
+                    [time.time() + self.visibility_timeout, self.worker_id, *ids],
+                )
+
+    def pause_expiry(self):
+        """Stop this process's wait clock: it expires nothing until resume_expiry()"""
+        if self._paused_at is None:
+            self._paused_at = time.time()
+
+    def resume_expiry(self):
+        """
+        Restart the wait clock; queued jobs are moved forward by the time spent
+        paused. Other processes sharing the file keep expiring in the meantime.
+        """
+        if self._paused_at is None:
+            return
+        self._db().execute(
+            "UPDATE jobs SET enqueued_at = enqueued_at + (? - MAX(enqueued_at, ?)) WHERE status = 'queued'",
+            (time.time(), self._paused_at),
+        )
+        self._paused_at = None
+
+    def expire(self):
+        """Fail every job that waited past its lane's limit, and forget old results"""
+        if self._paused_at is not None:
+            return
+        db = self._db()
+        now = time.time()
+        expired = []
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            for lane in self.lanes:
+                rows = db.execute(
+                    "SELECT id FROM jobs WHERE status = 'queued' AND lane = ? AND enqueued_at < ?",
+                    (lane.name, now - lane.max_wait),
+                ).fetchall()
+                for (job_id,) in rows:
+                    db.execute(
+                        "UPDATE jobs SET status = 'expired', error = ?, audio = NULL, finished_at = ? WHERE id = ?",
+                        (f"Waited more than {lane.max_wait:.0f} s in the {lane.name} queue", now, job_id),
+                    )
+                    expired.append((lane, job_id))
+            if now - self._last_cleanup > 10:
+                db.execute("DELETE FROM jobs WHERE status IN ('done', 'failed', 'expired') AND finished_at < ?",
+                           (now - self.result_ttl,))
+                self._last_cleanup = now
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+        for lane, job_id in expired:
+            lane.expired += 1
+            with self._lock:
+                job = self.local.pop(job_id, None)
+            # Jobs queued by other processes are finished by their own poller
+            if job is not None and self.on_expire:
+                self.on_expire(job, lane)
+
+    # ----------------------------
+    # Introspection
+    # ----------------------------
+    def lane_depth(self, lane):
+        return self._db().execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND lane = ?",
+                                  (lane.name,)).fetchone()[0]
+
+    def depth(self):
+        return self._db().execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+    def device_counts(self):
+        """device -> (queued, in flight), across every process sharing the queue"""
+        counts = {}
+        for device, status, count in self._db().execute(
+            "SELECT device, status, COUNT(*) FROM jobs WHERE status IN ('queued', 'running') GROUP BY device, status"
+        ).fetchall():
+            queued, running = counts.get(device, (0, 0))
+            counts[device] = (queued + count, running) if status == "queued" else (queued, running + count)
+        return counts
+
+    def to_dict(self):
+        now = time.time()
+        rows = self._db().execute(
+            "SELECT lane, device, COUNT(*), MIN(enqueued_at) FROM jobs WHERE status = 'queued' GROUP BY lane, device"
+        ).fetchall()
+        data = {}
+        for lane in self.lanes:
+            devices = {device: count for name, device, count, _ in rows if name == lane.name}
+            oldest = min((enqueued_at for name, _, _, enqueued_at in rows if name == lane.name), default=now)
+            data[lane.name] = {
+                "depth": sum(devices.values()),
+                "max_depth": lane.max_depth,
+                "max_wait": lane.max_wait,
+                "oldest_wait": round(now - oldest, 2),
+                # Counted by this process only
+                "admitted": lane.admitted,
+                "rejected": lane.rejected,
+                "expired": lane.expired,
+                "devices": devices,
+            }
+        return data
@@ -0,0 +1,210 @@
+"""
+Speculative greedy decoding for Whisper.
+
+A small draft model (tiny/base/small) proposes a few tokens, and the big
+target model checks them all in one decoder forward pass. The target keeps
+the longest prefix that matches its own argmax, plus its own next token.
+Since every emitted token is the target's greedy choice after the same
+logit filters, the output is the same as whisper.decode() with greedy
+decoding on the target alone. The draft only changes how many target
+forward passes it takes to get there.
+"""
+import torch
+import torch.nn.functional as F
+import whisper
+import whisper.audio
+from whisper.decoding import DecodingResult, DecodingTask
+from whisper.tokenizer import get_tokenizer
+from whisper.utils import compression_ratio
+
+from whisper_batching import detect_language_from_features, encode_short, short_audio_samples
+
+DRAFT_TOKENS = 4
+
+
+def check_compatible(target, draft):
+    """Draft and target must share a vocabulary for their tokens to mean the same thing"""
+    if (target.is_multilingual != draft.is_multilingual
+            or target.num_languages != draft.num_languages
+            or target.dims.n_vocab != draft.dims.n_vocab):
+        raise ValueError("Draft and target models must use the same tokenizer "
+                         "(e.g. tiny/base/small with medium, not tiny.en with medium)")
+
+
+def _encode(model, audio, short_audio):
+    n_samples = short_audio_samples(len(audio)) if short_audio else whisper.audio.N_SAMPLES
+    mel = whisper.log_mel_spectrogram(
+        whisper.pad_or_trim(torch.from_numpy(audio), n_samples), n_mels=model.dims.n_mels
+    ).unsqueeze(0).to(model.device)
+    return encode_short(model, mel) if short_audio else model.encoder(mel)
+
+
+class CachedDecoder:
+    """
+    Whisper's TextDecoder with a self-attention kv cache that can be rolled back.
+
+    whisper's hook-based kv cache assumes a single new token per call once the
+    cache is warm (its causal mask isn't shifted past the cached positions), so
+    scoring several draft tokens in one pass needs its own attention here.
+    """
+
+    def __init__(self, model, audio_features):
+        self.model = model
+        blocks = model.decoder.blocks
+        # Cross-attention keys/values only depend on the audio; compute them once
+        self.cross = [
+            (block.cross_attn.key(audio_features), block.cross_attn.value(audio_features))
+            for block in blocks
+        ]
+        self.keys = [None] * len(blocks)
+        self.values = [None] * len(blocks)
+        self.length = 0
+
+    @staticmethod
+    def _attend(attention, q, k, v, mask):
+        def heads(t):
+            return t.view(*t.shape[:2], attention.n_head, -1).permute(0, 2, 1, 3)
+
+        out = F.scaled_dot_product_attention(heads(q), heads(k), heads(v), attn_mask=mask)
+        return attention.out(out.permute(0, 2, 1, 3).flatten(start_dim=2))
+
+    def logits(self, tokens):
+        """Logits after each of `tokens`, which continue the cached prefix"""
+        decoder = self.model.decoder
+        n, offset = len(tokens), self.length
+        dtype = self.cross[0][0].dtype
+        x = decoder.token_embedding(torch.tensor([tokens], device=self.model.device))
+        x = (x + decoder.positional_embedding[offset:offset + n]).to(dtype)
+        # Query i sits at position offset + i and may see keys up to there
+        mask = torch.full((n, offset + n), float("-inf"), device=x.device, dtype=dtype).triu_(offset + 1)
+
+        for i, block in enumerate(decoder.blocks):
+            h = block.attn_ln(x)
+            k, v = block.attn.key(h), block.attn.value(h)
+            if self.keys[i] is not None:
+                k = torch.cat([self.keys[i], k], dim=1)
+                v = torch.cat([self.values[i], v], dim=1)
+            self.keys[i], self.values[i] = k, v
+            x = x + self._attend(block.attn, block.attn.query(h), k, v, mask)
+
+            h = block.cross_attn_ln(x)
+            x = x + self._attend(block.cross_attn, block.cross_attn.query(h), *self.cross[i], None)
+            x = x + block.mlp(block.mlp_ln(x))
+
+        self.length += n
+        x = decoder.ln(x)
+        return (x @ decoder.token_embedding.weight.to(x.dtype).T).float()[0]
+
+    def rollback(self, length):
+        """Forget every cached position from `length` on"""
+        if length >= self.length:
+            return
+        self.keys = [k[:, :length] for k in self.keys]
+        self.values = [v[:, :length] for v in self.values]
+        self.length = length
+
+
+def _filtered(task, logits, tokens):
+    """Apply the same logit filters whisper's greedy decoder would"""
+    logits = logits.clone()
+    sequence = torch.tensor([tokens], device=logits.device)
+    for logit_filter in task.logit_filters:
+        logit_filter.apply(logits, sequence)
+    return logits
+
+
+@torch.no_grad()
+def speculative_decode(target, draft, audio, language=None, draft_tokens=DRAFT_TOKENS, short_audio=False,
+                       sample_len=None):
+    """
+    Greedy-decode one clip (up to 30 s) with the target model, using the
+    draft model to propose tokens.
+    Returns (DecodingResult, stats) where stats counts proposed/accepted draft tokens
+    and target forward passes.
+    """
+    check_compatible(target, draft)
+    target_features = _encode(target, audio, short_audio)
+    draft_features = _encode(draft, audio, short_audio)
+
+    language_probs = None
+    if language is None:
+        tokenizer = get_tokenizer(target.is_multilingual, num_languages=target.num_languages)
+        _, probs = detect_language_from_features(target, target_features, tokenizer)
+        language_probs = probs[0]
+        language = max(language_probs, key=language_probs.get)
+
+    options = whisper.DecodingOptions(language=language, without_timestamps=True, fp16=False, sample_len=sample_len)
+    task = DecodingTask(target, options)
+    tokenizer = task.tokenizer
+    eot = tokenizer.eot
+
+    target_decoder = CachedDecoder(target, target_features)
+    draft_decoder = CachedDecoder(draft, draft_features)
+
+    tokens = list(task.initial_tokens)
+    sum_logprob = 0.0
+    no_speech_prob = None
+    stats = {"proposed": 0, "accepted": 0, "target_passes": 0}
+
+    while len(tokens) - task.sample_begin < task.sample_len and tokens[-1] != eot:
+        # Draft: propose up to draft_tokens greedily
+        budget = min(draft_tokens, task.sample_len - (len(tokens) - task.sample_begin))
+        proposals = []
+        feed = tokens[draft_decoder.length:]
+        for _ in range(budget):
+            logits = _filtered(task, draft_decoder.logits(feed)[-1:], tokens + proposals)
+            token = logits.argmax(dim=-1).item()
+            proposals.append(token)
+            feed = [token]
+            if token == eot:
+                break
+
+        # Target: score the unseen prefix plus every proposal in one pass
+        target_start = target_decoder.length
+        logits = target_decoder.logits(tokens[target_start:] + proposals)
+        stats["target_passes"] += 1
+        if no_speech_prob is None:
+            no_speech_prob = logits[task.sot_index].softmax(dim=-1)[tokenizer.no_speech].item()
+
+        # logits[base + j] predicts the token after tokens + proposals[:j]
+        base = len(tokens) - target_start - 1
+        sampled = len(tokens) - task.sample_begin
+        accepted, matched = [], 0
+        for j in range(len(proposals) + 1):
+            step_logits = _filtered(task, logits[base + j].unsqueeze(0), tokens + accepted)
+            token = step_logits.argmax(dim=-1).item()
+            sum_logprob += F.log_softmax(step_logits, dim=-1)[0, token].item()
+            accepted.append(token)
+            if j < len(proposals) and token == proposals[j]:
+                matched += 1
+                if token == eot or sampled + len(accepted) >= task.sample_len:
+                    break
+            else:
+                # The target disagrees (or every proposal matched): its own token ends the step
+                break
+
+        stats["proposed"] += len(proposals)
+        stats["accepted"] += matched
+
+        # Keep only cache entries computed from tokens that survived
+        target_decoder.rollback(len(tokens) + matched)
+        draft_decoder.rollback(len(tokens) + matched)
+        tokens.extend(accepted)
+
+    text_tokens = tokens[task.sample_begin:]
+    if text_tokens and text_tokens[-1] == eot:
+        text_tokens = text_tokens[:-1]
+    text = tokenizer.decode(text_tokens).strip()
+
+    result = DecodingResult(
+        audio_features=target_features[0],
+        language=language,
+        language_probs=language_probs,
+        tokens=text_tokens,
+        text=text,
+        avg_logprob=sum_logprob / (len(text_tokens) + 1),
+        no_speech_prob=no_speech_prob or 0.0,
+        temperature=0.0,
+        compression_ratio=compression_ratio(text),
+    )
+    return result, stats
@@ -0,0 +1,79 @@
+"""
+Jobs queued behind an idle-evicted model must wait for the reload, not expire.
+
+    python -m unittest test_idle_eviction
+
+Runs the server in this process with load_test's stub backend, so no
+Whisper model is downloaded.
+"""
+import os
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import whisper_backends
+from job_queue import Lane, LaneQueue
+from load_test import StubBackend
+
+MAX_WAIT = 1.0
+RELOAD_SECONDS = 2.5
+
+whisper_backends.BACKENDS[StubBackend.name] = StubBackend
+os.environ.update(
+    WHISPER_BACKEND=StubBackend.name, STARTUP_IN_BACKGROUND="0", WARMUP_SECONDS="0",
+    TRANSCRIPT_CACHE_SIZE="0", VAD_ENABLED="0", QUEUE_INTERACTIVE_MAX_WAIT=str(MAX_WAIT),
+    # One job per batch, so the jobs past the first one per worker stay queued
+    BATCH_MAX_SIZE="1",
+)
+import audio_transcriber as server  # noqa: E402  (configured by the environment above)
+
+
+class Job:
+    def __init__(self, device="robot"):
+        self.device = device
+        self.audio_seconds = 1.0
+
+
+class PausedExpiryTest(unittest.TestCase):
+    def test_paused_time_is_not_queue_wait(self):
+        expired = []
+        lanes = [Lane("interactive", float("inf"), 10, MAX_WAIT)]
+        jobs = LaneQueue(lanes, on_expire=lambda job, lane: expired.append(job))
+        before, during = Job(), Job()
+        jobs.put(before)
+        jobs.pause_expiry()
+        time.sleep(MAX_WAIT / 2)
+        jobs.put(during)
+        time.sleep(MAX_WAIT)
+        jobs.expire()
+        jobs.resume_expiry()
+        jobs.expire()
+        self.assertEqual(expired, [])
+        self.assertIs(jobs.get(timeout=0), before)
+        self.assertIs(jobs.get(timeout=0), during)
+
+
+class ReloadTest(unittest.TestCase):
+    def test_jobs_queued_during_a_slow_reload_complete(self):
+        with server.residency_lock:
+            server.evict_model()
+        load_model = server.load_model
+
+        def slow_load_model():
+            time.sleep(RELOAD_SECONDS)
+            return load_model()
+
+        with mock.patch.object(server, "load_model", slow_load_model):
+            # More jobs than worker threads, so some sit in the queue for the whole reload
+            jobs = [server.submit_job(np.zeros(16000 + i, np.float32)) for i in range(server.WORKER_THREADS + 3)]
+            for job in jobs:
+                self.assertTrue(job.wait(timeout=RELOAD_SECONDS + 10))
+
+        self.assertEqual([job.status for job in jobs], ["done"] * len(jobs), [job.error for job in jobs])
+        self.assertEqual(server.model_state, "resident")
+
+
+if __name__ == "__main__":
+    unittest.main()
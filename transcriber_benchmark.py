@@ -0,0 +1,409 @@
+"""
+Offline benchmarks for the transcription server's inference options.
+
+Usage:
+    python transcriber_benchmark.py short-audio [--model medium] [wav files or folders...]
+    python transcriber_benchmark.py backends [--backends torch,torch-int8,ctranslate2] [wavs...]
+    python transcriber_benchmark.py speculative [--draft tiny] [--draft-tokens 4] [wavs...]
+    python transcriber_benchmark.py upload-formats [--uplink-kbps 1000] [--url http://...] [wavs...]
+    python transcriber_benchmark.py profiles [--max-tokens 96] [wavs...]
+
+With no paths the bundled greeting/result clips are used.
+"""
+import argparse
+import io
+import multiprocessing
+import os
+import resource
+import statistics
+import time
+
+import numpy as np
+import requests
+import whisper
+
+from audio_ingest import (
+    UPLOAD_FORMATS, decode_compressed, decode_wav_bytes, encode_audio_file, trim_silence,
+)
+from load_test import read_pcm16k, to_wav
+from whisper_backends import BACKENDS, load_backend
+from speculative_decoding import speculative_decode
+from whisper_batching import decode_batch, transcribe_batch
+
+DEFAULT_CORPUS = ["voices_happy", "voices_angry", "happy_results", "angry_results"]
+
+
+def find_wavs(paths):
+    wavs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                wavs.extend(os.path.join(root, f) for f in files if f.lower().endswith(".wav"))
+        elif path.lower().endswith(".wav"):
+            wavs.append(path)
+    return sorted(wavs)
+
+
+def load_corpus(paths, trim=True):
+    """[(name, float32 audio)] for every WAV under paths"""
+    corpus = []
+    for path in find_wavs(paths or DEFAULT_CORPUS):
+        with open(path, "rb") as f:
+            audio = decode_wav_bytes(f.read())
+        if trim:
+            audio = trim_silence(audio)
+            if audio is None:
+                continue
+        corpus.append((path, audio))
+    return corpus
+
+
+def word_error_rate(reference, hypothesis):
+    """Word-level edit distance divided by the reference length"""
+    ref = reference.lower().split()
+    hyp = hypothesis.lower().split()
+    if not ref:
+        return 0.0 if not hyp else 1.0
+    previous = list(range(len(hyp) + 1))
+    for i, r in enumerate(ref, 1):
+        current = [i]
+        for j, h in enumerate(hyp, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (r != h)))
+        previous = current
+    return previous[-1] / len(ref)
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def print_table(headers, rows):
+    widths = [max(len(str(x)) for x in column) for column in zip(headers, *rows)]
+    line = "  ".join(f"{{:<{w}}}" for w in widths)
+    print(line.format(*headers))
+    print(line.format(*["-" * w for w in widths]))
+    for row in rows:
+        print(line.format(*row))
+
+
+# ----------------------------
+# Short-clip encoder mode
+# ----------------------------
+def bench_short_audio(args):
+    print(f"Loading Whisper model '{args.model}'...")
+    model = whisper.load_model(args.model)
+    corpus = load_corpus(args.paths)
+    print(f"{len(corpus)} clip(s)\n")
+
+    # Warm up both code paths so the first clip doesn't pay for it
+    transcribe_batch(model, [corpus[0][1]], language=args.language)
+    transcribe_batch(model, [corpus[0][1]], language=args.language, short_audio=True)
+
+    rows, full_times, short_times, errors = [], [], [], []
+    for path, audio in corpus:
+        (full,), full_time = timed(transcribe_batch, model, [audio], language=args.language)
+        (short,), short_time = timed(
+            transcribe_batch, model, [audio], language=args.language, short_audio=True
+        )
+        wer = word_error_rate(full["text"], short["text"])
+        full_times.append(full_time)
+        short_times.append(short_time)
+        errors.append(wer)
+        rows.append((
+            os.path.basename(path),
+            f"{len(audio) / whisper.audio.SAMPLE_RATE:.2f}",
+            f"{full_time:.2f}",
+            f"{short_time:.2f}",
+            f"{full_time / short_time:.1f}x",
+            f"{wer:.2f}",
+        ))
+
+    print_table(["clip", "audio s", "30s pad s", "short s", "speedup", "WER vs 30s"], rows)
+    print()
+    print(f"Median latency: 30 s padding {statistics.median(full_times):.2f} s, "
+          f"short mode {statistics.median(short_times):.2f} s")
+    print(f"Mean WER of short mode against the default mode: {statistics.mean(errors):.3f}")
+
+
+# ----------------------------
+# Inference backends
+# ----------------------------
+def _run_backend(backend_name, model_name, corpus, language):
+    """Runs in a fresh process so peak RSS belongs to this backend alone"""
+    load_start = time.perf_counter()
+    backend = load_backend(backend_name, model_name)
+    load_time = time.perf_counter() - load_start
+
+    backend.transcribe_batch([corpus[0][1]], language=language)  # warm-up
+    texts, inference_time = [], 0.0
+    for _, audio in corpus:
+        (result,), elapsed = timed(backend.transcribe_batch, [audio], language=language)
+        texts.append(result["text"])
+        inference_time += elapsed
+
+    return {
+        "load_time": load_time,
+        "inference_time": inference_time,
+        "texts": texts,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def bench_backends(args):
+    corpus = load_corpus(args.paths)
+    audio_seconds = sum(len(audio) for _, audio in corpus) / whisper.audio.SAMPLE_RATE
+    names = args.backends.split(",")
+    print(f"{len(corpus)} clip(s), {audio_seconds:.1f} s of audio, model '{args.model}'\n")
+
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for name in names:
+        print(f"Running {name}...")
+        with context.Pool(1) as pool:
+            try:
+                results[name] = pool.apply(_run_backend, (name, args.model, corpus, args.language))
+            except Exception as e:
+                print(f"  {name} failed: {e}")
+
+    # No ground truth for the bundled clips, so fp32 torch is the reference
+    reference = results.get("torch") or next(iter(results.values()), None)
+    if reference is None:
+        return
+    rows = []
+    for name, result in results.items():
+        wer = statistics.mean(
+            word_error_rate(ref, hyp) for ref, hyp in zip(reference["texts"], result["texts"])
+        )
+        rows.append((
+            name,
+            f"{result['load_time']:.1f}",
+            f"{result['inference_time']:.2f}",
+            f"{result['inference_time'] / audio_seconds:.3f}",
+            f"{result['peak_rss_mb']:.0f}",
+            f"{wer:.3f}",
+        ))
+    print()
+    print_table(["backend", "load s", "infer s", "RTF", "peak RSS MB", "WER vs torch"], rows)
+
+
+# ----------------------------
+# Speculative decoding
+# ----------------------------
+def bench_speculative(args):
+    print(f"Loading target '{args.model}' and draft '{args.draft}'...")
+    target = whisper.load_model(args.model, device="cpu")
+    draft = whisper.load_model(args.draft, device="cpu")
+    corpus = load_corpus(args.paths)
+    print(f"{len(corpus)} clip(s)\n")
+
+    def plain(audio):
+        options = whisper.DecodingOptions(language=args.language, without_timestamps=True, fp16=False)
+        return decode_batch(target, [audio], options)[0]
+
+    # Warm up both paths
+    plain(corpus[0][1])
+    speculative_decode(target, draft, corpus[0][1], args.language, args.draft_tokens)
+
+    rows, matches = [], 0
+    totals = {"plain_time": 0.0, "spec_time": 0.0, "tokens": 0, "proposed": 0, "accepted": 0}
+    for path, audio in corpus:
+        reference, plain_time = timed(plain, audio)
+        (result, stats), spec_time = timed(
+            speculative_decode, target, draft, audio, args.language, args.draft_tokens
+        )
+        same = result.tokens == reference.tokens
+        matches += same
+        n_tokens = len(reference.tokens) + 1  # + end of text
+        totals["plain_time"] += plain_time
+        totals["spec_time"] += spec_time
+        totals["tokens"] += n_tokens
+        totals["proposed"] += stats["proposed"]
+        totals["accepted"] += stats["accepted"]
+        rows.append((
+            os.path.basename(path),
+            n_tokens,
+            f"{plain_time:.2f}",
+            f"{spec_time:.2f}",
+            f"{n_tokens / plain_time:.1f}",
+            f"{n_tokens / spec_time:.1f}",
+            f"{stats['accepted'] / max(1, stats['proposed']):.2f}",
+            "yes" if same else "NO",
+        ))
+
+    print_table(["clip", "tokens", "plain s", "spec s", "plain tok/s", "spec tok/s", "accept", "identical"], rows)
+    print()
+    print(f"End-to-end: plain {totals['plain_time']:.2f} s, speculative {totals['spec_time']:.2f} s "
+          f"({totals['plain_time'] / totals['spec_time']:.2f}x)")
+    print(f"Tokens/s: plain {totals['tokens'] / totals['plain_time']:.1f}, "
+          f"speculative {totals['tokens'] / totals['spec_time']:.1f}")
+    print(f"Draft acceptance rate: {totals['accepted'] / max(1, totals['proposed']):.2f}")
+    print(f"Identical to plain greedy output: {matches}/{len(corpus)}")
+
+
+# ----------------------------
+# Upload formats
+# ----------------------------
+def bench_upload_formats(args):
+    # What the robots upload: 16 kHz mono WAVs straight from arecord
+    corpus = [(path, to_wav(read_pcm16k(path))) for path in find_wavs(args.paths or DEFAULT_CORPUS)]
+    audio_seconds = sum(len(wav) - 44 for _, wav in corpus) / 2 / whisper.audio.SAMPLE_RATE
+    print(f"{len(corpus)} clip(s), {audio_seconds:.1f} s of audio, uplink {args.uplink_kbps:g} kbit/s\n")
+
+    totals = {fmt: {"bytes": 0, "encode": 0.0, "decode": 0.0, "latencies": [], "lossless": True}
+              for fmt in UPLOAD_FORMATS}
+    for path, wav in corpus:
+        original = decode_wav_bytes(wav)
+        for fmt, total in totals.items():
+            if fmt == "wav":
+                data, encode_time = wav, 0.0
+                audio, decode_time = timed(decode_wav_bytes, data)
+            else:
+                data, encode_time = timed(encode_audio_file, io.BytesIO(wav), fmt)
+                audio, decode_time = timed(decode_compressed, data)
+            total["bytes"] += len(data)
+            total["encode"] += encode_time
+            total["decode"] += decode_time
+            total["lossless"] &= len(audio) == len(original) and np.array_equal(audio, original)
+
+            if args.url:
+                name = os.path.splitext(os.path.basename(path))[0] + UPLOAD_FORMATS[fmt][0][0]
+                start = time.perf_counter()
+                response = requests.post(f"{args.url}/transcribe", timeout=300,
+                                         files={"file": (name, data, UPLOAD_FORMATS[fmt][1])})
+                response.raise_for_status()
+                total["latencies"].append(encode_time + time.perf_counter() - start)
+
+    def upload_seconds(n_bytes):
+        return n_bytes * 8 / (args.uplink_kbps * 1000)
+
+    wav_total = totals["wav"]
+    wav_cost = upload_seconds(wav_total["bytes"]) + wav_total["encode"] + wav_total["decode"]
+    rows = []
+    for fmt, total in totals.items():
+        # Estimated per-clip cost of the format on the link: encode on the Pi + upload + server decode
+        cost = upload_seconds(total["bytes"]) + total["encode"] + total["decode"]
+        row = [
+            fmt,
+            f"{total['bytes'] / len(corpus) / 1024:.1f}",
+            f"{100 * (1 - total['bytes'] / wav_total['bytes']):.0f}%",
+            f"{1000 * total['encode'] / len(corpus):.1f}",
+            f"{1000 * total['decode'] / len(corpus):.1f}",
+            f"{1000 * upload_seconds(total['bytes']) / len(corpus):.0f}",
+            f"{1000 * (wav_cost - cost) / len(corpus):+.0f}",
+            "yes" if total["lossless"] else "no",
+        ]
+        if args.url:
+            row.append(f"{statistics.median(total['latencies']):.3f}")
+        rows.append(row)
+
+    headers = ["format", "KB/clip", "saved", "encode ms", "decode ms", "upload ms", "gain ms", "lossless"]
+    if args.url:
+        headers.append("median /transcribe s")
+    print_table(headers, rows)
+    print()
+    print("upload ms is estimated from --uplink-kbps; gain ms is the per-clip time saved against WAV "
+          "(upload + encode + server decode).")
+
+
+# ----------------------------
+# Decoding profiles
+# ----------------------------
+def bench_profiles(args):
+    print(f"Loading Whisper model '{args.model}'...")
+    model = whisper.load_model(args.model, device="cpu")
+    corpus = load_corpus(args.paths)
+    audio_seconds = sum(len(audio) for _, audio in corpus) / whisper.audio.SAMPLE_RATE
+    print(f"{len(corpus)} clip(s), {audio_seconds:.1f} s of audio\n")
+
+    # Same decode options as the server's profiles; like a robot's first
+    # interactive request, the first archive transcript picks the language
+    # unless --language pins it
+    (first,), _ = timed(transcribe_batch, model, [corpus[0][1]], language=args.language)
+    profiles = {
+        "archive": {"language": args.language, "fallback": True, "max_tokens": None},
+        "interactive": {"language": args.language or first["language"], "fallback": False,
+                        "max_tokens": args.max_tokens},
+    }
+
+    times = {name: [] for name in profiles}
+    texts = {name: [] for name in profiles}
+    rows = []
+    for path, audio in corpus:
+        for name, options in profiles.items():
+            (result,), elapsed = timed(transcribe_batch, model, [audio], **options)
+            times[name].append(elapsed)
+            texts[name].append(result["text"])
+        wer = word_error_rate(texts["archive"][-1], texts["interactive"][-1])
+        rows.append((
+            os.path.basename(path),
+            f"{len(audio) / whisper.audio.SAMPLE_RATE:.2f}",
+            f"{times['archive'][-1]:.2f}",
+            f"{times['interactive'][-1]:.2f}",
+            f"{times['archive'][-1] / times['interactive'][-1]:.1f}x",
+            f"{wer:.2f}",
+        ))
+    print_table(["clip", "audio s", "archive s", "interactive s", "speedup", "WER vs archive"], rows)
+
+    print()
+    rows = []
+    for name, options in profiles.items():
+        wer = statistics.mean(
+            word_error_rate(ref, hyp) for ref, hyp in zip(texts["archive"], texts[name])
+        )
+        rows.append((
+            name,
+            options["language"] or "detect",
+            "yes" if options["fallback"] else "no",
+            options["max_tokens"] or "-",
+            f"{statistics.median(times[name]):.2f}",
+            f"{max(times[name]):.2f}",
+            f"{sum(times[name]) / audio_seconds:.3f}",
+            f"{wer:.3f}",
+        ))
+    print_table(["profile", "language", "fallback", "max tokens", "median s", "max s", "RTF", "WER vs archive"],
+                rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="medium", help="Whisper model name")
+    parser.add_argument("--language", default=None, help="pin the language instead of detecting it")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    short_audio = subparsers.add_parser("short-audio", help="30 s padding vs short-clip encoder")
+    short_audio.add_argument("paths", nargs="*", help="WAV files or folders")
+    short_audio.set_defaults(run=bench_short_audio)
+
+    backends = subparsers.add_parser("backends", help="real-time factor and peak RSS per backend")
+    backends.add_argument("--backends", default=",".join(BACKENDS), help="comma-separated backend names")
+    backends.add_argument("paths", nargs="*", help="WAV files or folders")
+    backends.set_defaults(run=bench_backends)
+
+    speculative = subparsers.add_parser("speculative", help="plain greedy vs draft-model speculative decoding")
+    speculative.add_argument("--draft", default="tiny", help="draft Whisper model name")
+    speculative.add_argument("--draft-tokens", type=int, default=4, help="tokens proposed per round")
+    speculative.add_argument("paths", nargs="*", help="WAV files or folders")
+    speculative.set_defaults(run=bench_speculative)
+
+    upload_formats = subparsers.add_parser("upload-formats", help="WAV vs FLAC vs Opus upload size and latency")
+    upload_formats.add_argument("--uplink-kbps", type=float, default=1000,
+                                help="robot uplink speed used to estimate upload time")
+    upload_formats.add_argument("--url", default=None,
+                                help="also time POST /transcribe per format against this server")
+    upload_formats.add_argument("paths", nargs="*", help="WAV files or folders")
+    upload_formats.set_defaults(run=bench_upload_formats)
+
+    profiles = subparsers.add_parser("profiles", help="archive vs interactive decoding profile")
+    profiles.add_argument("--max-tokens", type=int, default=96, help="interactive token cap")
+    profiles.add_argument("paths", nargs="*", help="WAV files or folders")
+    profiles.set_defaults(run=bench_profiles)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def cache_key(audio, options, model_id):
+    """
+    Content address for a transcription: the decoded PCM, the decode options
+    and the model that produced it. The same recording re-uploaded (or sent
+    as WAV one time and raw PCM the next) maps to the same key.
+    """
+    digest = hashlib.sha256()
+    digest.update(model_id.encode())
+    digest.update(json.dumps(options, sort_keys=True).encode())
+    digest.update(audio.tobytes())
+    return digest.hexdigest()
+
+
+class TranscriptCache:
+    """
+    LRU of transcription results, bounded by entry count and by the total
+    size of the stored results. With a path, entries are also written to a
+    SQLite file so the cache survives restarts (memory misses fall back to disk).
+    """
+
+    def __init__(self, max_entries=2048, max_bytes=8 * 1024 * 1024, path=None, max_disk_entries=100000):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_disk_entries = max_disk_entries
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS transcripts "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, used_at REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS transcripts_used_at ON transcripts (used_at)")
+            self._db.commit()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remember(self, key, encoded):
+        """Insert into the in-memory LRU (call with the lock held)"""
+        if key in self._entries:
+            self._bytes -= len(self._entries.pop(key))
+        self._entries[key] = encoded
+        self._bytes += len(encoded)
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+
+    def get(self, key):
+        with self._lock:
+            encoded = self._entries.get(key)
+            if encoded is not None:
+                self._entries.move_to_end(key)
+            elif self._db is not None:
+                row = self._db.execute("SELECT value FROM transcripts WHERE key = ?", (key,)).fetchone()
+                if row:
+                    encoded = row[0]
+                    self._remember(key, encoded)
+                    self._db.execute("UPDATE transcripts SET used_at = ? WHERE key = ?", (time.time(), key))
+                    self._db.commit()
+
+            if encoded is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return json.loads(encoded)
+
+    def put(self, key, value):
+        encoded = json.dumps(value)
+        with self._lock:
+            self._remember(key, encoded)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO transcripts (key, value, used_at) VALUES (?, ?, ?)",
+                    (key, encoded, time.time()),
+                )
+                # Least recently used rows go first once the file is over its budget
+                self._db.execute(
+                    "DELETE FROM transcripts WHERE key IN (SELECT key FROM transcripts "
+                    "ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_disk_entries,),
+                )
+                self._db.commit()
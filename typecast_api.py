@@ -2,11 +2,10 @@ import requests
 import os
 
 
-def text_to_speech_api(text, api_key, voice_id="tc_632a759503f3cb7b9c8a717b"):
+def synthesize_speech(text, api_key, voice_id="tc_632a759503f3cb7b9c8a717b"):
     """
     Convert text to speech using TypeCast.ai API
-    Always saves as response_audio.wav (deletes previous)
-    Returns the path to the saved audio file
+    Returns the WAV bytes, or None on error
     """
     url = "https://api.typecast.ai/v1/text-to-speech"
     
@@ -33,43 +32,24 @@ def text_to_speech_api(text, api_key, voice_id="tc_632a759503f3cb7b9c8a717b"):
         "Content-Type": "application/json"
     }
     
-    # Always use this filename
-    filename = "response_audio.wav"
-    
     try:
         print(f"📞 Calling TypeCast.ai API for text: '{text[:50]}...'")
         response = requests.post(url, json=payload, headers=headers)
         
         # Check if request was successful
         if response.status_code == 200:
-            # Get the audio content
-            audio_content = response.content
-            
             # Check if it's JSON (error) or binary (audio)
             if response.headers.get('Content-Type', '').startswith('application/json'):
                 # It's JSON, check for errors
                 data = response.json()
                 if 'error' in data:
                     print(f"❌ API Error: {data['error']}")
-                    return None
                 else:
                     print("⚠️ Unexpected JSON response")
                     print(f"Response: {data}")
-                    return None
-            else:
-                # Delete previous audio file if it exists
-                if os.path.exists(filename):
-                    os.remove(filename)
-                
-                # Save the audio file
-                with open(filename, 'wb') as f:
-                    f.write(audio_content)
-                
-                print(f"✅ Audio saved as: {filename}")
-                print(f"   File size: {len(audio_content)} bytes")
-                
-                return filename
-                
+                return None
+            return response.content
+            
         else:
             print(f"❌ API request failed with status {response.status_code}")
             print(f"Response: {response.text[:200]}")
@@ -79,6 +59,35 @@ def text_to_speech_api(text, api_key, voice_id="tc_632a759503f3cb7b9c8a717b"):
         print(f"❌ Error in TTS API call: {e}")
         return None
 
+
+def save_audio(audio_content, filename="response_audio.wav"):
+    """Write reply audio to filename (deleting the previous one) and return the path"""
+    # Delete previous audio file if it exists
+    if os.path.exists(filename):
+        os.remove(filename)
+    
+    # Save the audio file
+    with open(filename, 'wb') as f:
+        f.write(audio_content)
+    
+    print(f"✅ Audio saved as: {filename}")
+    print(f"   File size: {len(audio_content)} bytes")
+    
+    return filename
+
+
+def text_to_speech_api(text, api_key, voice_id="tc_632a759503f3cb7b9c8a717b"):
+    """
+    Convert text to speech using TypeCast.ai API
+    Always saves as response_audio.wav (deletes previous)
+    Returns the path to the saved audio file
+    """
+    audio_content = synthesize_speech(text, api_key, voice_id)
+    if audio_content is None:
+        return None
+    # Always use this filename
+    return save_audio(audio_content, "response_audio.wav")
+
 # Usage example
 if __name__ == "__main__":
     API_KEY = "__pltMzLwjRtejoHYcjCEi984cBgKa6qMU6EiSkEs2Xne "  # Replace with your actual API key
@@ -0,0 +1,278 @@
+"""
+Inference backends for the transcription server.
+
+Every backend exposes the same interface:
+    backend.transcribe_batch(audios, language=None, short_audio=False, fallback=True, max_tokens=None)
+        -> one result dict (with "text") per float32 16 kHz clip
+    backend.set_threads(n)   # called in each forked replica
+
+    torch        whisper's PyTorch model in fp32 (the original behaviour)
+    torch-int8   the same model with its Linear layers dynamically quantized to int8
+    ctranslate2  a CTranslate2 export via faster-whisper (pip install faster-whisper),
+                 int8 weights by default
+
+CascadeBackend chains two of them: a small model answers first and only
+low-confidence clips are escalated to the big one. SpeculativeBackend wraps
+a torch backend so a small draft model proposes tokens for it to verify.
+
+With WHISPER_WEIGHTS_CACHE set to a directory, the torch backends keep an
+fp32 copy of each checkpoint there and memory-map it on later starts
+instead of unpickling and converting the fp16 download every time.
+"""
+import contextlib
+import dataclasses
+import os
+
+import torch
+import torch.nn as nn
+import whisper
+import whisper.model
+
+from speculative_decoding import DRAFT_TOKENS, check_compatible, speculative_decode
+from whisper_batching import transcribe_batch
+
+WEIGHTS_CACHE_DIR = os.environ.get("WHISPER_WEIGHTS_CACHE")
+
+# torch only lets a process set its interop threads once; a cascade has two
+# torch tiers that both ask
+_interop_threads_set = False
+
+
+@contextlib.contextmanager
+def _skip_weight_init():
+    """Build modules without random init; every weight is overwritten by the checkpoint anyway"""
+    layers = (nn.Linear, nn.Conv1d, nn.Embedding, nn.LayerNorm)
+    originals = [layer.reset_parameters for layer in layers]
+    for layer in layers:
+        layer.reset_parameters = lambda self: None
+    try:
+        yield
+    finally:
+        for layer, original in zip(layers, originals):
+            layer.reset_parameters = original
+
+
+def load_whisper(model_name, cache_dir=WEIGHTS_CACHE_DIR):
+    """
+    whisper.load_model() on the CPU, through the memory-mappable weights cache
+    when cache_dir is set. The first load writes <cache_dir>/<model>.fp32.pt;
+    later loads map it (pages shared with forked replicas) and skip both the
+    random init and the fp16 -> fp32 copy.
+    """
+    if not cache_dir:
+        return whisper.load_model(model_name, device="cpu")
+
+    path = os.path.join(cache_dir, f"{model_name}.fp32.pt")
+    if not os.path.exists(path):
+        model = whisper.load_model(model_name, device="cpu")
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        torch.save({"dims": dataclasses.asdict(model.dims), "model_state_dict": model.state_dict()}, tmp_path)
+        os.replace(tmp_path, path)
+        return model
+
+    checkpoint = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    with _skip_weight_init():
+        model = whisper.model.Whisper(whisper.model.ModelDimensions(**checkpoint["dims"]))
+    model.load_state_dict(checkpoint["model_state_dict"], assign=True)
+    if model_name in whisper._ALIGNMENT_HEADS:
+        model.set_alignment_heads(whisper._ALIGNMENT_HEADS[model_name])
+    return model.eval()
+
+
+class TorchBackend:
+    name = "torch"
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self.model = load_whisper(model_name)
+
+    def transcribe_batch(self, audios, **options):
+        return transcribe_batch(self.model, audios, **options)
+
+    def set_threads(self, threads):
+        global _interop_threads_set
+        torch.set_num_threads(threads)
+        if not _interop_threads_set:
+            torch.set_num_interop_threads(1)
+            _interop_threads_set = True
+
+
+def _swap_whisper_linears(module):
+    """
+    whisper.model.Linear subclasses nn.Linear, which quantize_dynamic()
+    refuses to convert; swap in plain nn.Linear layers with the same weights.
+    """
+    for name, child in module.named_children():
+        if isinstance(child, whisper.model.Linear):
+            plain = nn.Linear(child.in_features, child.out_features, bias=child.bias is not None)
+            plain.weight = child.weight
+            if child.bias is not None:
+                plain.bias = child.bias
+            setattr(module, name, plain)
+        else:
+            _swap_whisper_linears(child)
+
+
+class TorchInt8Backend(TorchBackend):
+    name = "torch-int8"
+
+    def __init__(self, model_name):
+        super().__init__(model_name)
+        _swap_whisper_linears(self.model)
+        # Attention and MLP projections hold nearly all of the weights; the
+        # convolutions and the tied token embedding stay in fp32
+        self.model = torch.ao.quantization.quantize_dynamic(
+            self.model, {nn.Linear}, dtype=torch.qint8
+        )
+
+
+class CTranslate2Backend:
+    name = "ctranslate2"
+    # Replicas can't share this backend's weights copy-on-write: CTranslate2
+    # reads them into its own heap and fixes its thread pool at load time, and
+    # that pool doesn't survive fork(). So each replica loads a private copy
+    # in set_threads() -- N replicas hold N copies of the weights -- and the
+    # process they are forked from builds the backend with load=False.
+    loads_in_replica = True
+
+    def __init__(self, model_name, compute_type="int8", threads=0, load=True):
+        try:
+            from faster_whisper import WhisperModel
+        except ImportError as e:
+            raise RuntimeError(
+                "The ctranslate2 backend needs faster-whisper: pip install faster-whisper"
+            ) from e
+        self._model_class = WhisperModel
+        self.model_name = model_name
+        self.compute_type = compute_type
+        self.model = self._load(threads) if load else None
+
+    def _load(self, threads):
+        return self._model_class(self.model_name, device="cpu", compute_type=self.compute_type, cpu_threads=threads)
+
+    def transcribe_batch(self, audios, language=None, short_audio=False, fallback=True, max_tokens=None):
+        # CTranslate2 always encodes the full 30 s window; short_audio is ignored
+        options = {"language": language, "beam_size": 1, "without_timestamps": True}
+        if not fallback:
+            options["temperature"] = 0.0
+        if max_tokens:
+            options["max_new_tokens"] = max_tokens
+        results = []
+        for audio in audios:
+            segments, info = self.model.transcribe(audio, **options)
+            segments = list(segments)
+            results.append({
+                "text": "".join(segment.text for segment in segments),
+                "language": info.language,
+                "language_probability": info.language_probability if language is None else None,
+                "avg_logprob": (sum(s.avg_logprob for s in segments) / len(segments)) if segments else 0.0,
+                "no_speech_prob": max((s.no_speech_prob for s in segments), default=1.0),
+                "compression_ratio": max((s.compression_ratio for s in segments), default=0.0),
+            })
+        return results
+
+    def set_threads(self, threads):
+        # The thread pool is fixed at load time, so this is where a replica loads its copy
+        self.model = None
+        self.model = self._load(threads)
+
+
+class SpeculativeBackend:
+    """
+    A torch backend whose greedy decodes are drafted by a small model and
+    verified by the big one; same transcripts, fewer big-model decoder passes.
+    """
+
+    def __init__(self, target, draft_model_name, draft_tokens=DRAFT_TOKENS):
+        if not isinstance(target, TorchBackend):
+            raise ValueError("Speculative decoding needs the torch or torch-int8 backend")
+        self.target = target
+        self.name = f"{target.name}+speculative"
+        self.model_name = target.model_name
+        self.draft = load_whisper(draft_model_name)
+        check_compatible(target.model, self.draft)
+        self.draft_tokens = draft_tokens
+        self.proposed = 0
+        self.accepted = 0
+
+    def _decode(self, model, audios, options, short_audio=False):
+        results = []
+        for audio in audios:
+            result, stats = speculative_decode(
+                model, self.draft, audio, options.language, self.draft_tokens, short_audio, options.sample_len
+            )
+            self.proposed += stats["proposed"]
+            self.accepted += stats["accepted"]
+            results.append(result)
+        return results
+
+    def transcribe_batch(self, audios, **options):
+        return transcribe_batch(self.target.model, audios, decode=self._decode, **options)
+
+    def set_threads(self, threads):
+        self.target.set_threads(threads)
+
+
+class CascadeBackend:
+    """
+    Transcribe with a small model first and escalate only the clips it is
+    unsure about. Every result gets a "tier" naming the model that answered.
+    """
+
+    def __init__(self, first, final, logprob_threshold=-0.6,
+                 no_speech_threshold=0.5, compression_ratio_threshold=2.2):
+        self.first = first
+        self.final = final
+        self.name = f"cascade({first.name})"
+        self.logprob_threshold = logprob_threshold
+        self.no_speech_threshold = no_speech_threshold
+        self.compression_ratio_threshold = compression_ratio_threshold
+
+    def needs_escalation(self, result):
+        if not result["text"].strip():
+            # The small model heard nothing; VAD already found speech, so double-check
+            return True
+        return (result["avg_logprob"] < self.logprob_threshold
+                or result["no_speech_prob"] > self.no_speech_threshold
+                or result["compression_ratio"] > self.compression_ratio_threshold)
+
+    def transcribe_batch(self, audios, **options):
+        # The small model's temperature fallback would only delay clips that
+        # get escalated anyway; the final tier applies it if asked to
+        results = self.first.transcribe_batch(audios, **dict(options, fallback=False))
+        for result in results:
+            result["tier"] = self.first.model_name
+
+        escalate = [i for i, result in enumerate(results) if self.needs_escalation(result)]
+        if escalate:
+            final_results = self.final.transcribe_batch([audios[i] for i in escalate], **options)
+            for i, result in zip(escalate, final_results):
+                result["tier"] = self.final.model_name
+                results[i] = result
+        return results
+
+    def set_threads(self, threads):
+        self.first.set_threads(threads)
+        self.final.set_threads(threads)
+
+
+BACKENDS = {
+    TorchBackend.name: TorchBackend,
+    TorchInt8Backend.name: TorchInt8Backend,
+    CTranslate2Backend.name: CTranslate2Backend,
+}
+
+
+def load_backend(name, model_name, for_replicas=False):
+    """
+    for_replicas: the backend is about to be forked into replicas that call
+    set_threads(). Backends whose weights can't be shared across fork() then
+    leave loading them to each replica instead of loading a copy here too.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend '{name}', pick one of: {', '.join(BACKENDS)}")
+    if for_replicas and getattr(BACKENDS[name], "loads_in_replica", False):
+        print(f"⚠️ The {name} backend can't share weights between processes; each one loads its own copy")
+        return BACKENDS[name](model_name, load=False)
+    return BACKENDS[name](model_name)
@@ -0,0 +1,227 @@
+import dataclasses
+import math
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import whisper
+import whisper.audio
+from whisper.decoding import DecodingTask
+
+# Same thresholds model.transcribe() uses to decide a decode went wrong
+COMPRESSION_RATIO_THRESHOLD = 2.4
+LOGPROB_THRESHOLD = -1.0
+NO_SPEECH_THRESHOLD = 0.6
+
+
+def needs_fallback(decode_result):
+    """
+    Same checks as whisper's transcribe(): repetitive or low-confidence
+    output gets retried with temperature fallback, silence does not.
+    """
+    if decode_result.no_speech_prob > NO_SPEECH_THRESHOLD and decode_result.avg_logprob < LOGPROB_THRESHOLD:
+        return False
+    return (decode_result.compression_ratio > COMPRESSION_RATIO_THRESHOLD
+            or decode_result.avg_logprob < LOGPROB_THRESHOLD)
+
+
+def is_silence(decode_result):
+    return (decode_result.no_speech_prob > NO_SPEECH_THRESHOLD
+            and decode_result.avg_logprob < LOGPROB_THRESHOLD)
+
+
+def _summarize(result):
+    """
+    Give a model.transcribe() result the same confidence fields as a
+    batched decode, averaged over its segments.
+    """
+    segments = result.get("segments") or []
+    if segments:
+        result["avg_logprob"] = sum(s["avg_logprob"] for s in segments) / len(segments)
+        result["no_speech_prob"] = max(s["no_speech_prob"] for s in segments)
+        result["compression_ratio"] = max(s["compression_ratio"] for s in segments)
+    else:
+        result["avg_logprob"] = 0.0
+        result["no_speech_prob"] = 1.0
+        result["compression_ratio"] = 0.0
+    return result
+
+
+def _as_result(decode_result):
+    text = "" if is_silence(decode_result) else decode_result.text
+    return {
+        "text": text,
+        "language": decode_result.language,
+        # How sure the detection was; None when the language was given
+        "language_probability": (decode_result.language_probs or {}).get(decode_result.language),
+        "avg_logprob": decode_result.avg_logprob,
+        "no_speech_prob": decode_result.no_speech_prob,
+        "compression_ratio": decode_result.compression_ratio,
+    }
+
+
+# Short-clip mode: the encoder produces 50 frames per second of audio
+# (1500 for the full 30 s window). Clips are rounded up to this bucket
+# so the number of distinct encoder shapes stays small.
+ENCODER_FRAMES_PER_SECOND = 50
+SHORT_AUDIO_BUCKET_SECONDS = 2.0
+
+
+def short_audio_samples(n_samples, bucket_seconds=SHORT_AUDIO_BUCKET_SECONDS):
+    """Clip length rounded up to the bucket, capped at the 30 s window"""
+    bucket = int(bucket_seconds * whisper.audio.SAMPLE_RATE)
+    return min(whisper.audio.N_SAMPLES, max(1, math.ceil(n_samples / bucket)) * bucket)
+
+
+def encode_short(model, mel):
+    """
+    AudioEncoder.forward() without the 30 s shape assert: the positional
+    embedding is sliced to the clip's length instead of padding the clip.
+    """
+    encoder = model.encoder
+    x = F.gelu(encoder.conv1(mel))
+    x = F.gelu(encoder.conv2(x))
+    x = x.permute(0, 2, 1)
+    x = (x + encoder.positional_embedding[:x.shape[1]]).to(x.dtype)
+    for block in encoder.blocks:
+        x = block(x)
+    return encoder.ln_post(x)
+
+
+def detect_language_from_features(model, audio_features, tokenizer):
+    """whisper's detect_language(), minus its re-encode of non-30 s features"""
+    n_audio = audio_features.shape[0]
+    x = torch.tensor([[tokenizer.sot]] * n_audio).to(audio_features.device)
+    logits = model.logits(x, audio_features)[:, 0]
+
+    mask = torch.ones(logits.shape[-1], dtype=torch.bool)
+    mask[list(tokenizer.all_language_tokens)] = False
+    logits[:, mask] = -np.inf
+    language_tokens = logits.argmax(dim=-1)
+    probs = logits.softmax(dim=-1).cpu()
+    language_probs = [
+        {c: probs[i, j].item()
+         for j, c in zip(tokenizer.all_language_tokens, tokenizer.all_language_codes)}
+        for i in range(n_audio)
+    ]
+    return language_tokens, language_probs
+
+
+class LanguageProbsDecodingTask(DecodingTask):
+    """DecodingTask whose results keep the detected language probabilities (whisper's drops them)"""
+
+    def run(self, mel):
+        self.language_probs = None
+        results = super().run(mel)
+        if self.language_probs is None:
+            return results
+        return [dataclasses.replace(result, language_probs=probs)
+                for result, probs in zip(results, self.language_probs)]
+
+    def _detect_language(self, audio_features, tokens):
+        languages, self.language_probs = super()._detect_language(audio_features, tokens)
+        return languages, self.language_probs
+
+
+class EncodedDecodingTask(LanguageProbsDecodingTask):
+    """DecodingTask that is handed encoder output of any length"""
+
+    def _get_audio_features(self, audio_features):
+        return audio_features
+
+    def _detect_language(self, audio_features, tokens):
+        languages = [self.options.language] * audio_features.shape[0]
+        lang_probs = None
+        if self.options.language is None:
+            lang_tokens, lang_probs = detect_language_from_features(
+                self.model, audio_features, self.tokenizer
+            )
+            languages = [max(probs, key=probs.get) for probs in lang_probs]
+            tokens[:, self.sot_index + 1] = lang_tokens
+        self.language_probs = lang_probs
+        return languages, lang_probs
+
+
+@torch.no_grad()
+def decode_short(model, audios, options):
+    """
+    Decode clips under 30 s with the encoder's audio context shrunk to the
+    longest clip in the batch (rounded up to SHORT_AUDIO_BUCKET_SECONDS).
+    """
+    n_samples = short_audio_samples(max(len(a) for a in audios))
+    mels = torch.stack([
+        whisper.log_mel_spectrogram(
+            whisper.pad_or_trim(torch.from_numpy(audio), n_samples),
+            n_mels=model.dims.n_mels,
+        )
+        for audio in audios
+    ]).to(model.device)
+    if options.fp16:
+        mels = mels.half()
+    audio_features = encode_short(model, mels)
+    return EncodedDecodingTask(model, options).run(audio_features)
+
+
+def decode_batch(model, audios, options, short_audio=False):
+    """Greedy-decode clips of at most 30 s together; one DecodingResult per clip"""
+    if short_audio:
+        return decode_short(model, audios, options)
+    mels = torch.stack([
+        whisper.log_mel_spectrogram(
+            whisper.pad_or_trim(torch.from_numpy(audio)),
+            n_mels=model.dims.n_mels,
+        )
+        for audio in audios
+    ]).to(model.device)
+    return LanguageProbsDecodingTask(model, options).run(mels)
+
+
+def transcribe_batch(model, audios, language=None, short_audio=False, fallback=True, max_tokens=None,
+                     decode=decode_batch):
+    """
+    Transcribe several clips with one batched encoder + decoder pass.
+
+    audios: list of float32 arrays at 16 kHz (or file paths)
+    language: skip language detection and decode as this language
+    short_audio: shrink the encoder context to the clip length instead of
+    padding every clip to 30 s (see decode_short)
+    fallback: re-run clips whose greedy decode fails whisper's quality
+    checks through model.transcribe() with temperature fallback, so the
+    output matches the unbatched path; without it the greedy result stands
+    max_tokens: stop decoding a clip after this many tokens (whisper's default is 224)
+    decode: swaps out the greedy decode step (e.g. for speculative decoding)
+    Clips that don't fit one 30 s window always go through model.transcribe(),
+    greedy-only when fallback is off.
+    Returns one result dict per clip, in order, with "text", "language",
+    "avg_logprob", "no_speech_prob" and "compression_ratio", plus
+    "language_probability" for clips whose language was detected in one window.
+    """
+    audios = [whisper.audio.load_audio(a) if isinstance(a, str) else a for a in audios]
+    results = [None] * len(audios)
+    fp16 = model.device.type == "cuda"
+    transcribe_options = {"language": language, "fp16": fp16}
+    if not fallback:
+        transcribe_options["temperature"] = 0.0
+    if max_tokens:
+        transcribe_options["sample_len"] = max_tokens
+
+    windowed = []
+    for i, audio in enumerate(audios):
+        if len(audio) <= whisper.audio.N_SAMPLES:
+            windowed.append(i)
+        else:
+            results[i] = _summarize(model.transcribe(audio, **transcribe_options))
+
+    if windowed:
+        options = whisper.DecodingOptions(
+            language=language, without_timestamps=True, fp16=fp16, sample_len=max_tokens
+        )
+        decoded = decode(model, [audios[i] for i in windowed], options, short_audio)
+
+        for i, decode_result in zip(windowed, decoded):
+            if fallback and needs_fallback(decode_result):
+                results[i] = _summarize(model.transcribe(audios[i], **transcribe_options))
+            else:
+                results[i] = _as_result(decode_result)
+
+    return results